@@ -4,3 +4,20 @@ from django import forms
 class MonitoringListForm(forms.Form):
     ra = forms.FloatField()
     dec = forms.FloatField()
+
+
+class CrossMatchForm(forms.Form):
+    # CSV file or FITS table of positions; see tools/catalogue.py
+    catalogue = forms.FileField()
+    # Default matching radius in arcseconds
+    radius = forms.FloatField(required=False, min_value=0)
+
+
+class MonitoringListImportForm(forms.Form):
+    # CSV file, FITS or VOTable of positions; see tools/catalogue.py
+    catalogue = forms.FileField()
+    # Positions within this many arcseconds of an entry already in the
+    # list (or of an earlier position in the file) are skipped; at most
+    # the maximum matching radius of a cross-match, since all pairs of
+    # positions within the radius are compared
+    radius = forms.FloatField(initial=5., min_value=0, max_value=3600)
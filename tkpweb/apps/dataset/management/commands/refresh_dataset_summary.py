@@ -0,0 +1,43 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from tkp.config import config
+from ...tools import dbase
+from ...tools import summary
+
+
+class Command(BaseCommand):
+    args = '[dataset ...]'
+    help = ("Refresh the summaries of the given datasets (default: all "
+            "datasets); only images added since the last refresh are "
+            "processed")
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', default=False,
+                    help="recompute the summaries from scratch"),
+        make_option('--host', help="database host (default from the tkp config)"),
+        make_option('--port', type='int', help="database port"),
+        make_option('--name', help="database name"),
+        make_option('--user', help="database user"),
+        make_option('--password', help="database password"),
+        )
+
+    def handle(self, *args, **options):
+        dblogin = None
+        keys = ('host', 'port', 'name', 'user', 'password')
+        if any(options.get(key) is not None for key in keys):
+            dblogin = dict(config['database'])
+            for key in keys:
+                if options.get(key) is not None:
+                    dblogin[key] = options[key]
+        try:
+            datasets = [int(arg) for arg in args]
+        except ValueError:
+            raise CommandError("dataset ids should be integers")
+        database = dbase.DataBase(dblogin=dblogin)
+        if not datasets:
+            datasets = [dataset['id'] for dataset in database.dataset()]
+        for dataset in datasets:
+            result = summary.refresh(database, dataset,
+                                     rebuild=options['rebuild'])
+            self.stdout.write("dataset %d: %d images, %d sources\n" % (
+                dataset, result.nimages, result.ntotalsources))
@@ -1,3 +1,63 @@
 from django.db import models
 
-# Create your models here.
+
+class DatasetSummary(models.Model):
+    """Precomputed counts and quality control aggregates for a dataset
+
+    The summary is refreshed incrementally (see tools/summary.py): only
+    the images with an id above `last_image`, and the extracted sources
+    in them or with an id above `last_source`, are processed.
+    """
+
+    # The TKP database (cf. tools.dbase.DataBase.key) and dataset
+    host = models.CharField(max_length=255)
+    port = models.IntegerField()
+    database = models.CharField(max_length=255)
+    dataset = models.IntegerField()
+
+    # Watermarks: the highest image id included in the summary, and the
+    # highest extracted source, running catalog source and transient ids
+    # in the database (over all datasets) when it was last refreshed
+    last_image = models.IntegerField(null=True)
+    last_source = models.IntegerField(null=True)
+    last_runcat = models.IntegerField(null=True)
+    last_transient = models.IntegerField(null=True)
+
+    nimages = models.IntegerField(default=0)
+    ntotalsources = models.IntegerField(default=0)
+    nsources = models.IntegerField(default=0)
+    ntransients = models.IntegerField(default=0)
+
+    # Number of extracted sources per image
+    min_sources_per_image = models.IntegerField(null=True)
+    max_sources_per_image = models.IntegerField(null=True)
+
+    # rms (mJy/beam) of all extracted sources in the dataset with a
+    # det_sigma of at least 1e-6; unlike the rms quality control plot,
+    # this is not restricted to the sources in the running catalog
+    rms_count = models.IntegerField(default=0)
+    rms_sum = models.FloatField(default=0.)
+    rms_min = models.FloatField(null=True)
+    rms_max = models.FloatField(null=True)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('host', 'port', 'database', 'dataset'),)
+
+    def __unicode__(self):
+        return u"dataset %d in %s:%d/%s" % (
+            self.dataset, self.host, self.port, self.database)
+
+    @property
+    def mean_sources_per_image(self):
+        return float(self.ntotalsources) / self.nimages if self.nimages else None
+
+    @property
+    def rms_mean(self):
+        return self.rms_sum / self.rms_count if self.rms_count else None
+
+    def counts(self):
+        """The counts, as in the extra_info of DataBase.dataset()"""
+        return {'nimages': self.nimages, 'ntotalsources': self.ntotalsources,
+                'nsources': self.nsources, 'ntransients': self.ntransients}
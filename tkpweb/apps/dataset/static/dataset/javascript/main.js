@@ -1,25 +1,47 @@
 $(function ()
 {
-    $("img#sourceplot_0").load(function(){$("div#lightcurve").css('height', $(this).height())});
-    $("img.thumbnail").hover(
+    // The thumbnails are cells of a single sprite sheet image, "columns"
+    // cells wide, in the order of the lightcurve points
+    var columns = parseInt($("div#lightcurve").attr("columns"));
+    var sprite = $("div#lightcurve").attr("sprite");
+    var large = 320;
+
+    function thumbnail(element, size)
+    {
+	var number = parseInt(element.attr("number"));
+	element.css({
+	    'width': size + 'px',
+	    'height': size + 'px',
+	    'background-image': 'url(' + sprite + ')',
+	    'background-size': (columns * size) + 'px auto',
+	    'background-position': (-(number % columns) * size) + 'px ' +
+		(-Math.floor(number / columns) * size) + 'px',
+	    'image-rendering': 'pixelated'
+	});
+    }
+
+    $("div.thumbnail").each(function () { thumbnail($(this), 20); });
+    $("div.sourceplot").each(function () { thumbnail($(this), large); });
+    $("div#lightcurve").css('height', large);
+    $("div.thumbnail").hover(
         function ()
 	{
-	    $("img#sourceplot_" + $(this).attr("number")).css('display', 'block');
+	    $("div#sourceplot_" + $(this).attr("number")).css('display', 'block');
 	},
 	function ()
 	{
-	    $("img#sourceplot_" + $(this).attr("number")).css('display', 'none');
+	    $("div#sourceplot_" + $(this).attr("number")).css('display', 'none');
 	});
-	
-	$("img.thumbnail").click(
+
+	$("div.thumbnail").click(
 		function ()
 		{
 			if($(this).attr("clicked")=="0"){
-				$(this).attr("height","100%");
+				thumbnail($(this), 80);
 				$(this).attr("clicked","1")
 			}
 			else{
-				$(this).attr("height","20");
+				thumbnail($(this), 20);
 				$(this).attr("clicked","0")
 			}
 		}
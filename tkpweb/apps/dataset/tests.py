@@ -5,7 +5,26 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import json
+import shutil
+import StringIO
+import tempfile
+import numpy
+import pyfits
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.core.urlresolvers import reverse
+from django.core.files.uploadedfile import SimpleUploadedFile
+from .forms import MonitoringListImportForm
+from .tools import api
+from .tools import cache
+from .tools import catalogue
+from .tools import dbase
+from .tools import export
+from .tools import plot
+from .tools import spatial
+from .tools import summary
+from .tools import thumbnail
 
 
 class SimpleTest(TestCase):
@@ -14,3 +33,380 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class SpriteTest(SimpleTestCase):
+    size = 4
+    columns = 5
+
+    def sprite(self, n):
+        # Thumbnail i has value i + 1 in its top left pixel, so that every
+        # cell is non-empty
+        thumbnails = []
+        for i in range(n):
+            data = numpy.zeros((self.size, self.size))
+            data[0, 0] = i + 1
+            thumbnails.append(data)
+        return thumbnail.sprite(thumbnails, self.size, self.columns)
+
+    def test_shape(self):
+        # Always the full number of columns wide, also for a partial row
+        self.assertEqual(self.sprite(2).shape, (4, 20, 4))
+        self.assertEqual(self.sprite(5).shape, (4, 20, 4))
+        self.assertEqual(self.sprite(7).shape, (8, 20, 4))
+
+    def test_cells(self):
+        sheet = self.sprite(7)
+        for i in range(7):
+            row, column = divmod(i, self.columns)
+            cell = sheet[row * self.size:(row + 1) * self.size,
+                         column * self.size:(column + 1) * self.size]
+            self.assertTrue(cell[..., 3].all())
+        # Cells beyond the last thumbnail are transparent
+        self.assertFalse(sheet[4:, 8:, 3].any())
+
+    def test_missing(self):
+        sheet = thumbnail.sprite([None, numpy.ones((4, 4))], 4, 5)
+        self.assertFalse(sheet[:, :4, 3].any())
+        self.assertTrue(sheet[:, 4:8, 3].all())
+
+
+class MemoryCacheTest(SimpleTestCase):
+    def test_lru(self):
+        items = cache.MemoryCache(max_items=2)
+        items.set('a', 1)
+        items.set('b', 2)
+        self.assertEqual(items.get('a'), 1)
+        # 'b' is now the least recently used item
+        items.set('c', 3)
+        self.assertEqual(items.get('b'), None)
+        self.assertEqual(items.get('a'), 1)
+        self.assertEqual(items.get('c'), 3)
+
+
+class DiskCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_set(self):
+        disk = cache.DiskCache(self.directory)
+        key = cache.make_key('plot', 1, (2, 3))
+        self.assertEqual(disk.get(key), None)
+        self.assertEqual(disk.filename(key), None)
+        disk.set(key, "data")
+        self.assertEqual(disk.get(key), "data")
+        with open(disk.filename(key), 'rb') as infile:
+            self.assertEqual(infile.read(), "data")
+
+    def test_cull(self):
+        disk = cache.DiskCache(self.directory, max_size=100, cull_fraction=0.5)
+        for i in range(4):
+            disk.set(str(i), "x" * 30)
+        # Culled to at most 50 bytes, removing the oldest items
+        self.assertTrue(disk.total_size() <= 50)
+        self.assertEqual(disk.get('3'), "x" * 30)
+
+
+class FakeDataBase(object):
+    """The parts of dbase.DataBase used by spatial.source_index()"""
+
+    key = ('localhost', 5432, 'test')
+
+    def __init__(self, ra, decl):
+        self.ra, self.decl = ra, decl
+        self.queries = 0
+
+    def array(self, query, params, dtype):
+        self.queries += 1
+        sources = numpy.zeros(len(self.ra), dtype=dtype)
+        sources['id'] = numpy.arange(len(self.ra))
+        sources['ra'], sources['decl'] = self.ra, self.decl
+        vectors = spatial.unit_vectors(self.ra, self.decl)
+        sources['x'], sources['y'], sources['z'] = vectors.T
+        return sources
+
+
+class SourceIndexCacheTest(SimpleTestCase):
+    def test_version(self):
+        database = FakeDataBase([10., 10.001], [20., 20.])
+        index = spatial.source_index(database, 1, version=(2, 5, 3, None))
+        self.assertEqual(len(index), 2)
+        self.assertTrue(spatial.source_index(
+            database, 1, version=(2, 5, 3, None)) is index)
+        self.assertEqual(database.queries, 1)
+        # New running catalog sources change the version, and the index
+        # is rebuilt
+        database.ra, database.decl = [10., 10.001, 30.], [20., 20., -5.]
+        index = spatial.source_index(database, 1, version=(2, 5, 4, None))
+        self.assertEqual(database.queries, 2)
+        self.assertEqual(len(index), 3)
+        sources, distances = index.cone_search(30., -5., 1. / 3600)
+        self.assertEqual(list(sources['id']), [2])
+
+
+class DatasetRefreshTest(TestCase):
+    def test_forbidden(self):
+        # Rebuilding a summary needs the change_datasetsummary permission
+        response = self.client.post(
+            reverse('dataset:dataset-refresh', kwargs={'id': 1}))
+        self.assertEqual(response.status_code, 403)
+
+
+class PagingTest(SimpleTestCase):
+    columns = dbase.ORDERING['image']
+
+    def test_default(self):
+        condition, clauses, params, reverse = dbase.paging(self.columns)
+        self.assertEqual(condition, "")
+        self.assertEqual(clauses, "ORDER BY im.id ASC")
+        self.assertEqual(params, {})
+        self.assertFalse(reverse)
+
+    def test_order(self):
+        condition, clauses, params, reverse = dbase.paging(
+            self.columns, order='-taustart_ts', limit=10, offset=20)
+        # Ties are broken on id, so that pages do not overlap
+        self.assertEqual(
+            clauses, "ORDER BY im.taustart_ts DESC, im.id DESC LIMIT 10 OFFSET 20")
+
+    def test_after(self):
+        condition, clauses, params, reverse = dbase.paging(
+            self.columns, limit=10, after='5')
+        self.assertEqual(condition, "AND im.id > %(cursor)s")
+        self.assertEqual(params, {'cursor': 5})
+        self.assertEqual(clauses, "ORDER BY im.id ASC LIMIT 10")
+        self.assertFalse(reverse)
+
+    def test_before(self):
+        # Backwards pages are queried in the opposite order, and reversed
+        condition, clauses, params, reverse = dbase.paging(
+            self.columns, order='-id', limit=10, before=5)
+        self.assertEqual(condition, "AND im.id > %(cursor)s")
+        self.assertEqual(clauses, "ORDER BY im.id ASC LIMIT 10")
+        self.assertTrue(reverse)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, dbase.paging, self.columns, order='url')
+        self.assertRaises(ValueError, dbase.paging, self.columns,
+                          after=1, before=2)
+        self.assertRaises(ValueError, dbase.paging, self.columns,
+                          order='taustart_ts', after=1)
+
+
+class ApiFiltersTest(SimpleTestCase):
+    def test_parse(self):
+        filters = api.parse_filters('lightcurves', {
+            'xtrsrc__exact': '12', 'flux__gte': '0.5', 'fields': 'id,flux'})
+        self.assertEqual(sorted(filters),
+                         [('flux', 'gte', 0.5), ('xtrsrc', 'exact', 12)])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, api.parse_filters, 'lightcurves',
+                          {'stokes__exact': 'I'})
+        self.assertRaises(ValueError, api.parse_filters, 'lightcurves',
+                          {'time__gte': 'yesterday'})
+
+
+class JsonValuesTest(SimpleTestCase):
+    def test_array(self):
+        values = api.json_values(numpy.array([1.5, numpy.nan, numpy.inf]))
+        self.assertEqual(values, [1.5, None, None])
+        self.assertEqual(json.dumps(values, allow_nan=False), "[1.5, null, null]")
+        self.assertEqual(api.json_values(numpy.array([1, 2])), [1, 2])
+
+    def test_list(self):
+        self.assertEqual(api.json_values([3, "a", None, float('nan'), 2.5]),
+                         [3, "a", None, None, 2.5])
+
+
+class MatchRowsTest(SimpleTestCase):
+    def test_json(self):
+        sources = numpy.zeros(2, dtype=[
+            ('id', 'i8'), ('ra', 'f8'), ('decl', 'f8'), ('ra_err', 'f8'),
+            ('x', 'f8'), ('y', 'f8'), ('z', 'f8')])
+        sources['id'] = [7, 8]
+        sources['ra'], sources['decl'] = [10., 50.], [20., 20.]
+        # A NULL error, as stored in the index
+        sources['ra_err'] = [numpy.nan, 0.1]
+        vectors = spatial.unit_vectors(sources['ra'], sources['decl'])
+        sources['x'], sources['y'], sources['z'] = vectors.T
+        index = spatial.SourceIndex(sources)
+        positions = catalogue.positions(
+            {'ra': ['10', '30'], 'decl': ['20', '20']}, 5.)
+        nearest, matches = catalogue.cross_match(index, positions)
+        nearest_rows, match_rows = catalogue.match_rows(
+            index, positions, ['id', 'ra_err'], nearest, matches)
+        self.assertEqual(nearest_rows[0][:4], ['1', 10., 20., 5.])
+        self.assertEqual(nearest_rows[0][5:], [7, None])
+        # No source within the radius of the second position
+        self.assertEqual(nearest_rows[1][4:], [None, None, None])
+        self.assertEqual(len(match_rows), 1)
+        self.assertEqual(match_rows[0][0], '1')
+        self.assertEqual(match_rows[0][2:], [7, None])
+        json.dumps([nearest_rows, match_rows], allow_nan=False)
+
+
+class PositionsTest(SimpleTestCase):
+    def test_columns(self):
+        positions = catalogue.positions(
+            {'id': ['a', 'b'], 'raj2000': ['-10', '20'], 'dec': ['0', '45'],
+             'r': ['', '3']}, 5.)
+        self.assertEqual(list(positions['name']), ['a', 'b'])
+        self.assertEqual(list(positions['ra']), [350., 20.])
+        self.assertEqual(list(positions['decl']), [0., 45.])
+        # The default radius for positions without one
+        self.assertEqual(list(positions['radius']), [5., 3.])
+
+    def test_unmatched(self):
+        # Without a radius, the positions are not matched: any radius
+        # column is ignored
+        positions = catalogue.positions(
+            {'ra': numpy.array([1.]), 'decl': numpy.array([2.]),
+             'radius': numpy.array([-1.])}, None)
+        self.assertEqual(list(positions['name']), ['1'])
+        self.assertTrue(numpy.isnan(positions['radius']).all())
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, catalogue.positions, {'ra': ['1']}, 5.)
+        self.assertRaises(ValueError, catalogue.positions,
+                          {'ra': ['1'], 'decl': ['x']}, 5.)
+        self.assertRaises(ValueError, catalogue.positions,
+                          {'ra': ['1'], 'decl': ['91']}, 5.)
+        self.assertRaises(ValueError, catalogue.positions,
+                          {'ra': ['1'], 'decl': ['0'], 'radius': ['0']}, 5.)
+        self.assertRaises(ValueError, catalogue.positions,
+                          {'ra': ['1'], 'decl': ['0']}, 5., max_radius=1.)
+        self.assertRaises(ValueError, catalogue.positions,
+                          {'ra': ['1', '2'], 'decl': ['0', '0']}, 5.,
+                          max_rows=1)
+
+
+class NewPositionsTest(SimpleTestCase):
+    def test_duplicates(self):
+        positions = catalogue.positions(
+            {'ra': ['10', '10.0005', '30', '50'],
+             'decl': ['20', '20', '-5', '60']}, None)
+        # The second position is within 5 arcseconds of the first, the
+        # third of a known position
+        keep = catalogue.new_positions(
+            positions, numpy.array([30.0001, numpy.nan]),
+            numpy.array([-5., numpy.nan]), 5.)
+        self.assertEqual(list(keep), [True, False, False, True])
+
+    def test_no_known(self):
+        positions = catalogue.positions({'ra': ['10'], 'decl': ['20']}, None)
+        keep = catalogue.new_positions(
+            positions, numpy.zeros(0), numpy.zeros(0), 5.)
+        self.assertEqual(list(keep), [True])
+
+
+class MergeIntervalsTest(SimpleTestCase):
+    def test_merge(self):
+        start, end = plot.merge_intervals(numpy.array([5., 0., 2., 10., 9.]),
+                                          numpy.array([6., 3., 4., 11., 10.]))
+        # [0, 3) and [2, 4) overlap; adjacent intervals are merged too
+        self.assertEqual(list(start), [0., 5., 9.])
+        self.assertEqual(list(end), [4., 6., 11.])
+
+    def test_contained(self):
+        start, end = plot.merge_intervals(numpy.array([0., 1., 5.]),
+                                          numpy.array([10., 2., 6.]))
+        self.assertEqual(list(start), [0.])
+        self.assertEqual(list(end), [10.])
+
+    def test_single(self):
+        start, end = plot.merge_intervals(numpy.array([1.]), numpy.array([2.]))
+        self.assertEqual((list(start), list(end)), ([1.], [2.]))
+
+
+class FakeListings(object):
+    """A database with an extracted source listing, for the exports"""
+
+    def __init__(self, dtype):
+        self.data = numpy.zeros(3, dtype=dtype)
+        self.data['id'] = [1, 2, 3]
+        self.data['runcat'] = [10, -1, 10]
+        self.kwargs = None
+
+    def extractedsource(self, **kwargs):
+        self.kwargs = kwargs
+        return self.data
+
+
+class ExportTest(SimpleTestCase):
+    def setUp(self):
+        self.database = FakeListings(export.ARRAYS['extractedsource'][0])
+
+    def test_npy(self):
+        response = export.export_npy(self.database, 'extractedsource',
+                                     'sources', dataset=1)
+        self.assertEqual(self.database.kwargs['dataset'], 1)
+        data = numpy.load(StringIO.StringIO(response.content))
+        # One row per extracted source
+        self.assertEqual(list(data['id']), [1, 2, 3])
+        self.assertEqual(list(data['runcat']), [10, -1, 10])
+        self.assertTrue('sources.npy' in response['Content-Disposition'])
+
+    def test_fits(self):
+        self.database.data['f_int'] = [0.5, 1., 2.]
+        response = export.export_fits(self.database, 'extractedsource',
+                                      'sources')
+        hdulist = pyfits.open(StringIO.StringIO(response.content))
+        table = hdulist[1].data
+        self.assertEqual(list(table.field('id')), [1, 2, 3])
+        self.assertEqual(list(table.field('runcat')), [10, -1, 10])
+        self.assertEqual(list(table.field('f_int')), [0.5, 1., 2.])
+
+    def test_csv_close(self):
+        # Closing the CSV rows (as the response does) closes the listing
+        closed = []
+
+        def items():
+            try:
+                for i in range(10):
+                    yield {'id': i}
+            finally:
+                closed.append(True)
+
+        rows = export.csv_rows(items(), [('id', export.text)], batchsize=1)
+        rows.next()
+        rows.next()
+        rows.close()
+        self.assertEqual(closed, [True])
+
+    def test_csv_rows(self):
+        items = [{'id': 1, 'runcat': 10, 'ra': 1.23456}, {'id': 2, 'ra': 2.}]
+        lines = "".join(export.csv_rows(
+            items, export.CSV_COLUMNS['extractedsource'][:3])).splitlines()
+        self.assertEqual(lines, ["id,runcat,ra", "1,10,1.235", "2,,2.000"])
+
+
+class UnqueriedDataBase(object):
+    """A database that fails on any query"""
+
+    key = ('localhost', 5432, 'test')
+
+    def __getattr__(self, name):
+        raise AssertionError("queried the database: %s" % name)
+
+
+class SummariesTest(TestCase):
+    def test_not_summarised(self):
+        # Summaries are not built while serving a page
+        self.assertEqual(summary.summaries(UnqueriedDataBase(), [1, 2]), {})
+
+
+class MonitoringListImportFormTest(SimpleTestCase):
+    def form(self, radius):
+        return MonitoringListImportForm(
+            {'radius': radius},
+            {'catalogue': SimpleUploadedFile('positions.csv', 'ra,decl\n1,2\n')})
+
+    def test_radius(self):
+        self.assertTrue(self.form('5').is_valid())
+        self.assertTrue(self.form('3600').is_valid())
+        self.assertFalse(self.form('3601').is_valid())
+        self.assertFalse(self.form('-1').is_valid())
@@ -0,0 +1,309 @@
+"""
+Queries for the JSON API
+
+Every resource of the API is a query over one or more tables, with a
+fixed set of named columns (see RESOURCES). Clients select the columns
+they need with ?fields=: only those columns are selected in the query,
+so that neither the database nor the client handles any others. The
+rows can be restricted with filters on some of the columns
+(?<column>__exact=, __gte=, __lte=, __gt=, __lt=), and are returned one
+page at a time, ordered and paged as the HTML listings are (see
+dbase.paging()).
+"""
+
+import numpy
+from django.utils.dateparse import parse_datetime
+from .dbase import paging
+
+
+def timestamp(value):
+    """Parse an ISO 8601 date and time for a filter"""
+    result = parse_datetime(value)
+    if result is None:
+        raise ValueError("invalid timestamp: %s" % value)
+    return result
+
+
+def json_values(values):
+    """Convert a row or column of values (a list or numpy array) to a
+    list that can be serialised as JSON: floating point values that are
+    not finite (NaN stands for NULL in arrays; see dbase.column_array())
+    become None, since JSON has no representation for them"""
+    if isinstance(values, numpy.ndarray):
+        if values.dtype.kind == 'f':
+            return numpy.where(numpy.isfinite(values), values, None).tolist()
+        values = values.tolist()
+    return [None if isinstance(value, float) and not numpy.isfinite(value)
+            else value for value in values]
+
+
+# The resources of the API. For each:
+#
+#  - tables: the FROM clause of the query;
+#  - dataset: the column to restrict on for a single dataset;
+#  - columns: the name and SQL expression of every available column, in
+#    their default order; 'id' is used as the paging cursor, and must be
+#    unique over the rows of the resource;
+#  - filters: the columns that filters can be applied to, and the
+#    function to convert the filter values with.
+RESOURCES = {
+    'datasets': {
+        'tables': "dataset ds",
+        'dataset': "ds.id",
+        'columns': [
+            ('id', 'ds.id'),
+            ('rerun', 'ds.rerun'),
+            ('type', 'ds.type'),
+            ('process_ts', 'ds.process_ts'),
+            ('description', 'ds.description'),
+            ],
+        'filters': {'id': int, 'process_ts': timestamp},
+        },
+    'images': {
+        'tables': "image im JOIN skyregion sky ON sky.id = im.skyrgn",
+        'dataset': "im.dataset",
+        'columns': [
+            ('id', 'im.id'),
+            ('dataset', 'im.dataset'),
+            ('band', 'im.band'),
+            ('taustart_ts', 'im.taustart_ts'),
+            ('tau_time', 'im.tau_time'),
+            ('freq_eff', 'im.freq_eff'),
+            ('freq_bw', 'im.freq_bw'),
+            ('centre_ra', 'sky.centre_ra'),
+            ('centre_decl', 'sky.centre_decl'),
+            ('url', 'im.url'),
+            ],
+        'filters': {'id': int, 'taustart_ts': timestamp, 'tau_time': float,
+                    'freq_eff': float},
+        },
+    'transients': {
+        'tables': """\
+transient t
+  JOIN runningcatalog rc ON rc.id = t.runcat
+  JOIN extractedsource x ON x.id = t.trigger_xtrsrc
+  JOIN image i ON i.id = x.image""",
+        'dataset': "rc.dataset",
+        'columns': [
+            ('id', 't.id'),
+            ('runcat', 't.runcat'),
+            ('trigger_xtrsrc', 't.trigger_xtrsrc'),
+            ('dataset', 'rc.dataset'),
+            ('band', 't.band'),
+            ('freq_eff', 'i.freq_eff'),
+            ('siglevel', 't.siglevel'),
+            ('v_int', 't.V_int'),
+            ('eta_int', 't.eta_int'),
+            ('t_start', 't.t_start'),
+            ('wm_ra', 'rc.wm_ra'),
+            ('wm_decl', 'rc.wm_decl'),
+            ('wm_ra_err', 'rc.wm_ra_err'),
+            ('wm_decl_err', 'rc.wm_decl_err'),
+            ('datapoints', 'rc.datapoints'),
+            ],
+        'filters': {'id': int, 't_start': timestamp, 'siglevel': float,
+                    'v_int': float, 'eta_int': float, 'freq_eff': float},
+        },
+    'sources': {
+        'tables': "runningcatalog rc",
+        'dataset': "rc.dataset",
+        'columns': [
+            ('id', 'rc.id'),
+            ('xtrsrc', 'rc.xtrsrc'),
+            ('dataset', 'rc.dataset'),
+            ('datapoints', 'rc.datapoints'),
+            ('wm_ra', 'rc.wm_ra'),
+            ('wm_decl', 'rc.wm_decl'),
+            ('wm_ra_err', 'rc.wm_ra_err'),
+            ('wm_decl_err', 'rc.wm_decl_err'),
+            ],
+        'filters': {'id': int, 'datapoints': int, 'wm_ra': float,
+                    'wm_decl': float},
+        },
+    # One row per extracted source: an extracted source can be associated
+    # with more than one source, so runcat is the first of those (by id);
+    # use the lightcurves resource for all associations
+    'extractedsources': {
+        'tables': """\
+extractedsource ex
+  JOIN image im ON im.id = ex.image""",
+        'dataset': "im.dataset",
+        'columns': [
+            ('id', 'ex.id'),
+            ('image', 'ex.image'),
+            ('dataset', 'im.dataset'),
+            ('runcat', """\
+(SELECT MIN(ax.runcat)
+          FROM assocxtrsource ax
+         WHERE ax.xtrsrc = ex.id)"""),
+            ('taustart_ts', 'im.taustart_ts'),
+            ('ra', 'ex.ra'),
+            ('decl', 'ex.decl'),
+            ('ra_err', 'ex.ra_err'),
+            ('decl_err', 'ex.decl_err'),
+            ('det_sigma', 'ex.det_sigma'),
+            ('f_peak', 'ex.f_peak'),
+            ('f_peak_err', 'ex.f_peak_err'),
+            ('f_int', 'ex.f_int'),
+            ('f_int_err', 'ex.f_int_err'),
+            ('semimajor', 'ex.semimajor'),
+            ('semiminor', 'ex.semiminor'),
+            ('pa', 'ex.pa'),
+            ],
+        'filters': {'id': int, 'image': int, 'runcat': int,
+                    'taustart_ts': timestamp, 'ra': float, 'decl': float,
+                    'det_sigma': float, 'f_peak': float, 'f_int': float},
+        },
+    'monitoringlist': {
+        'tables': """\
+monitoringlist ml
+  LEFT OUTER JOIN runningcatalog rc ON rc.id = ml.runcat""",
+        'dataset': "ml.dataset",
+        'columns': [
+            ('id', 'ml.id'),
+            ('runcat', 'ml.runcat'),
+            ('dataset', 'ml.dataset'),
+            ('userentry', 'ml.userentry'),
+            # Blind entries take the position of their source
+            ('ra', 'CASE WHEN ml.userentry THEN ml.ra ELSE rc.wm_ra END'),
+            ('decl', 'CASE WHEN ml.userentry THEN ml.decl ELSE rc.wm_decl END'),
+            ],
+        'filters': {'id': int, 'runcat': int},
+        },
+    # The points of all lightcurves (cf. DataBase.lightcurves()), one row
+    # per point, that is, per association of an extracted source with a
+    # source; filter on runcat for the lightcurves of single sources
+    'lightcurves': {
+        'tables': """\
+assocxtrsource ax
+  JOIN runningcatalog rc ON rc.id = ax.runcat
+  JOIN extractedsource ex ON ex.id = ax.xtrsrc
+  JOIN image im ON im.id = ex.image""",
+        'dataset': "rc.dataset",
+        'columns': [
+            ('id', 'ax.id'),
+            ('runcat', 'ax.runcat'),
+            ('xtrsrc', 'ax.xtrsrc'),
+            ('time', 'im.taustart_ts'),
+            ('tau', 'im.tau_time'),
+            ('flux', 'ex.f_int'),
+            ('flux_err', 'ex.f_int_err'),
+            ('band', 'im.band'),
+            ('stokes', 'im.stokes'),
+            ('freq', 'im.freq_eff'),
+            ],
+        'filters': {'id': int, 'runcat': int, 'xtrsrc': int,
+                    'time': timestamp, 'flux': float},
+        },
+    }
+
+
+# Comparison operators of the filters
+OPERATORS = {
+    'exact': '=',
+    'gte': '>=',
+    'lte': '<=',
+    'gt': '>',
+    'lt': '<',
+    }
+
+
+def parse_filters(resource, params):
+    """Obtain the filters for a resource from request parameters
+
+    Args:
+
+        resource (string): name of the resource (key into RESOURCES).
+
+        params (dict-like): the request parameters; only those of the
+            form <column>__<operator> are used.
+
+    Returns:
+
+        list of (column, operator, value) tuples.
+
+    Raises:
+
+        ValueError: for a filter on an unknown column or with an invalid
+            value.
+    """
+
+    filters = []
+    for key, value in params.items():
+        name, separator, operator = key.rpartition('__')
+        if not separator or operator not in OPERATORS:
+            continue
+        if name not in RESOURCES[resource]['filters']:
+            raise ValueError("can't filter on %s" % name)
+        filters.append(
+            (name, operator, RESOURCES[resource]['filters'][name](value)))
+    return filters
+
+
+def select(database, resource, fields=None, dataset=None, filters=(),
+           **page):
+    """Obtain (a page of) the rows of a resource
+
+    Args:
+
+        database (dbase.DataBase): database to query.
+
+        resource (string): name of the resource (key into RESOURCES).
+
+    Kwargs:
+
+        fields (list of strings or None): the columns to select; all
+            columns if None.
+
+        dataset (int or None): limit the rows to the given dataset.
+
+        filters (list): filters, as (column, operator, value)
+            tuples; see parse_filters().
+
+        Any further keyword arguments (order, limit, after, before and
+        offset) select a single, ordered page of the rows; see
+        dbase.paging().
+
+    Returns:
+
+        (list): the selected rows, as lists of the values of the fields
+            in the given order.
+
+    Raises:
+
+        ValueError: for unknown fields or invalid paging arguments.
+    """
+
+    definition = RESOURCES[resource]
+    columns = dict(definition['columns'])
+    if fields is None:
+        fields = [name for name, expression in definition['columns']]
+    unknown = [name for name in fields if name not in columns]
+    if unknown:
+        raise ValueError("unknown fields: %s" % ", ".join(unknown))
+    condition, clauses, params, reverse = paging(columns, **page)
+    conditions = []
+    if dataset is not None:
+        conditions.append("AND %s = %%(dsid)s" % definition['dataset'])
+        params['dsid'] = dataset
+    for i, (name, operator, value) in enumerate(filters):
+        conditions.append("AND %s %s %%(filter%d)s" % (
+            columns[name], OPERATORS[operator], i))
+        params['filter%d' % i] = value
+    query = """\
+SELECT %s
+  FROM %s
+ WHERE 1 = 1
+ %s %s
+%s""" % ("\n      ,".join(["%s AS %s" % (columns[name], name)
+                           for name in fields]),
+         definition['tables'], " ".join(conditions), condition, clauses)
+    cursor = database.db.connection.cursor()
+    try:
+        cursor.execute(query, params)
+        rows = [list(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    if reverse:
+        rows.reverse()
+    return rows
@@ -0,0 +1,231 @@
+"""
+Caches for rendered plots and other derived data
+
+Two backends are available, with the same get()/set() interface for
+byte strings:
+
+- DiskCache stores each item as a file in a directory, and keeps the
+  total size of the directory below a maximum by removing the least
+  recently used files.
+
+- DjangoCache stores the items in one of the caches configured for
+  Django, which then takes care of eviction.
+
+The cache for plots is configured through PLOT_CACHE in the settings;
+see plot_cache().
+
+MemoryCache keeps arbitrary (unserialised) objects in the memory of the
+process, for derived data that is cheap to store but expensive to
+obtain, such as arrays computed from the database.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from tkpweb import settings
+
+
+def make_key(*parts):
+    """Create a cache key from any number of (repr-able) parts"""
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+class DiskCache(object):
+    """A size-bounded least-recently-used cache of files in a directory
+
+    Every access of an item updates the modification time of its file;
+    when the total size exceeds max_size, the files with the oldest
+    modification times are removed until the size is below
+    `cull_fraction` of the maximum. Several processes can share the same
+    directory: files are written atomically, and each process keeps an
+    estimate of the total size, which is corrected whenever it culls.
+    """
+
+    suffix = ".cache"
+
+    def __init__(self, directory, max_size=500 * 1024 * 1024,
+                 cull_fraction=0.9):
+        self.directory = directory
+        self.max_size = max_size
+        self.cull_fraction = cull_fraction
+        self.size = None
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Return the item for key, or None if not cached"""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as infile:
+                data = infile.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def filename(self, key):
+        """Return the name of the file with the item for key, or None if
+        not cached
+
+        The file may be removed by a later cull, but files that are open
+        remain readable.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def set(self, key, data):
+        """Store the item for key"""
+        self.store(key, lambda outfile: outfile.write(data))
+
+    def set_file(self, key, infile):
+        """Store the contents of a file(-like object) for key, without
+        reading it into memory at once; returns the name of the stored
+        file, or None if it could not be stored"""
+        return self.store(key, lambda outfile: shutil.copyfileobj(infile, outfile))
+
+    def store(self, key, write):
+        handle, tmppath = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as outfile:
+                write(outfile)
+            size = os.path.getsize(tmppath)
+            os.rename(tmppath, self.path(key))
+        except (IOError, OSError):
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            return None
+        with self.lock:
+            if self.size is None:
+                self.size = self.total_size()
+            else:
+                self.size += size
+            if self.size > self.max_size:
+                self.cull()
+        return self.path(key)
+
+    def files(self):
+        """Return (mtime, size, path) for all items in the cache"""
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def total_size(self):
+        return sum([size for mtime, size, path in self.files()])
+
+    def cull(self):
+        """Remove the least recently used items until the total size is
+        below cull_fraction * max_size"""
+        files = sorted(self.files())
+        size = sum([size for mtime, size, path in files])
+        for mtime, filesize, path in files:
+            if size <= self.cull_fraction * self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            size -= filesize
+        self.size = size
+
+
+class DjangoCache(object):
+    """Store items in one of Django's configured caches"""
+
+    def __init__(self, alias='default', timeout=None):
+        try:
+            from django.core.cache import caches
+            self.cache = caches[alias]
+        except ImportError:
+            # Django < 1.7
+            from django.core.cache import get_cache
+            self.cache = get_cache(alias)
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, data):
+        if self.timeout is None:
+            self.cache.set(key, data)
+        else:
+            self.cache.set(key, data, self.timeout)
+
+
+class MemoryCache(object):
+    """A least-recently-used cache of at most max_items objects, in the
+    memory of the process"""
+
+    def __init__(self, max_items=100):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the item for key, or None if not cached"""
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is not None:
+                self.items[key] = item
+        return item
+
+    def set(self, key, item):
+        """Store the item for key"""
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = item
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+
+def create_cache(config):
+    """Create a cache from a configuration dict (cf. PLOT_CACHE in the
+    settings); returns None if the cache is not enabled"""
+    if not config.get("enabled", True):
+        return None
+    if config.get("backend", "disk") == "django":
+        return DjangoCache(config.get("alias", "default"),
+                           config.get("timeout"))
+    return DiskCache(config["directory"],
+                     config.get("max_size", 500 * 1024 * 1024))
+
+
+PLOT_CACHE = getattr(settings, 'PLOT_CACHE', {
+    "enabled": True,
+    "backend": "disk",
+    "directory": os.path.join(tempfile.gettempdir(), "tkpweb-plots"),
+    })
+
+_plot_cache = None
+
+
+def plot_cache():
+    """Return the (process-wide) cache for rendered plots, or None if
+    plot caching is disabled"""
+    global _plot_cache
+    if _plot_cache is None:
+        _plot_cache = create_cache(PLOT_CACHE)
+    return _plot_cache
@@ -0,0 +1,274 @@
+"""
+Uploaded catalogues of positions, and cross-matching them with a dataset
+
+A catalogue is a CSV file (with a header line), a FITS binary table or
+(if astropy is available) a VOTable, with at least the columns ra and
+decl (or dec) in degrees, and optionally a name (or id) and a matching
+radius in arcseconds for every position. The columns are read as whole
+arrays and validated at once, and matched against the KD-tree of the
+sources in the dataset (see spatial.source_index()) in a single pass
+for all positions.
+"""
+
+import csv
+import numpy
+import pyfits
+from xml.parsers.expat import ExpatError
+from .api import json_values
+from .spatial import position_index
+try:
+    from astropy.io.votable import parse_single_table
+except ImportError:
+    # VOTables are not supported
+    parse_single_table = None
+
+
+# Alternative names of the catalogue columns
+COLUMN_NAMES = {
+    'name': ('name', 'id', 'source'),
+    'ra': ('ra', 'raj2000'),
+    'decl': ('decl', 'dec', 'dej2000'),
+    'radius': ('radius', 'r'),
+    }
+
+
+def read_csv(infile):
+    """Read the columns of a CSV file with a header line, as a dict of
+    (lower case) column name: list of strings"""
+
+    reader = csv.reader(infile)
+    try:
+        header = [name.strip().lower() for name in reader.next()]
+    except StopIteration:
+        raise ValueError("empty file")
+    rows = [row for row in reader if row]
+    if any(len(row) != len(header) for row in rows):
+        raise ValueError("rows do not match the header")
+    columns = zip(*rows) or [()] * len(header)
+    return dict(zip(header, [list(column) for column in columns]))
+
+
+def read_fits(infile):
+    """Read the columns of the first table in a FITS file, as a dict of
+    (lower case) column name: array"""
+
+    hdulist = pyfits.open(infile)
+    try:
+        for hdu in hdulist:
+            if isinstance(hdu, (pyfits.BinTableHDU, pyfits.TableHDU)):
+                return dict([(name.lower(), numpy.array(hdu.data.field(name)))
+                             for name in hdu.columns.names])
+    finally:
+        hdulist.close()
+    raise ValueError("no table in FITS file")
+
+
+def read_votable(infile):
+    """Read the columns of the first table in a VOTable, as a dict of
+    (lower case) column name: array"""
+
+    table = parse_single_table(infile).array
+    return dict([(name.lower(), numpy.ma.filled(table[name], numpy.nan)
+                  if table[name].dtype.kind == 'f' else numpy.array(table[name]))
+                 for name in table.dtype.names])
+
+
+# Readers by file name extension
+READERS = {
+    'csv': read_csv,
+    'txt': read_csv,
+    'fits': read_fits,
+    'fit': read_fits,
+    }
+if parse_single_table is not None:
+    READERS.update({'xml': read_votable, 'vot': read_votable})
+
+
+def read_table(infile, filename):
+    """Read the columns of an uploaded table; the format is determined by
+    the file name extension (see READERS)
+
+    Raises:
+
+        ValueError: for an unsupported or unreadable file.
+    """
+
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension not in READERS:
+        raise ValueError("unsupported file type: %s" % filename)
+    try:
+        return READERS[extension](infile)
+    except (IOError, csv.Error, ExpatError), e:
+        # Malformed files, in the errors of the various parsers
+        raise ValueError("unreadable %s file: %s" % (extension, e))
+
+
+def column(table, name):
+    """Return the column of a table with one of the names for name (see
+    COLUMN_NAMES), or None"""
+    for alias in COLUMN_NAMES[name]:
+        if alias in table:
+            return table[alias]
+    return None
+
+
+def float_column(values, name):
+    try:
+        return numpy.array(
+            [numpy.nan if value == '' else value for value in values]
+            if isinstance(values, list) else values, dtype=float)
+    except ValueError:
+        raise ValueError("non-numeric values in column %s" % name)
+
+
+def positions(table, radius, max_radius=None, max_rows=None):
+    """Obtain the positions from a table (see read_table())
+
+    Args:
+
+        table (dict): the columns.
+
+        radius (float or None): matching radius in arcseconds for
+            positions without one; None if the positions are not
+            matched, in which case any radius column is ignored.
+
+    Kwargs:
+
+        max_radius (float or None): maximum matching radius.
+
+        max_rows (int or None): maximum number of positions.
+
+    Returns:
+
+        numpy structured array with fields name, ra, decl and radius.
+
+    Raises:
+
+        ValueError: for missing columns, or invalid values in any row.
+    """
+
+    ra, decl = column(table, 'ra'), column(table, 'decl')
+    if ra is None or decl is None:
+        raise ValueError("the table needs ra and decl columns")
+    ra, decl = float_column(ra, 'ra'), float_column(decl, 'decl')
+    if max_rows is not None and len(ra) > max_rows:
+        raise ValueError("too many rows (at most %d)" % max_rows)
+    result = numpy.empty(len(ra), dtype=[('name', 'S64'), ('ra', 'f8'),
+                                         ('decl', 'f8'), ('radius', 'f8')])
+    result['ra'] = ra
+    result['decl'] = decl
+    names = column(table, 'name')
+    if names is not None:
+        result['name'] = names
+    else:
+        result['name'] = numpy.arange(1, len(ra) + 1).astype('S64')
+    radii = column(table, 'radius')
+    if radius is None:
+        result['radius'] = numpy.nan
+    elif radii is not None:
+        radii = float_column(radii, 'radius')
+        result['radius'] = numpy.where(numpy.isnan(radii), radius, radii)
+    else:
+        result['radius'] = radius
+
+    invalid = ~(numpy.isfinite(result['ra']) & numpy.isfinite(result['decl']) &
+                (result['decl'] >= -90) & (result['decl'] <= 90))
+    if radius is not None:
+        invalid |= ~(result['radius'] > 0)
+        if max_radius is not None:
+            invalid |= result['radius'] > max_radius
+    if invalid.any():
+        raise ValueError("invalid position or radius in rows %s" % ", ".join(
+            [str(row) for row in numpy.flatnonzero(invalid)[:10] + 1]))
+    result['ra'] %= 360
+    return result
+
+
+def cross_match(index, positions):
+    """Match positions against the sources of a spatial.SourceIndex
+
+    Args:
+
+        index (spatial.SourceIndex): the sources.
+
+        positions (numpy.ndarray): see positions().
+
+    Returns:
+
+        (nearest, matches): nearest is the index of the nearest source
+        within the radius of every position (-1 if none) and its
+        distance in arcseconds; matches are all sources within the
+        radius of every position, as arrays of the index of the
+        position, the index of the source and the distance, ordered by
+        position and distance.
+    """
+
+    radius = positions['radius'] / 3600.
+    nearest = index.nearest(positions['ra'], positions['decl'], radius)
+    matches = index.within(positions['ra'], positions['decl'], radius)
+    return nearest, matches
+
+
+def match_rows(index, positions, fields, nearest, matches):
+    """Convert the result of cross_match() to rows that can be serialised
+    as JSON (see api.json_values())
+
+    Args:
+
+        index (spatial.SourceIndex): the sources.
+
+        positions (numpy.ndarray): see positions().
+
+        fields (list of strings): the fields of the sources to include.
+
+        nearest, matches: see cross_match().
+
+    Returns:
+
+        (nearest_rows, match_rows): for every position, its name, ra,
+        decl, radius, and the distance and fields of the nearest source
+        (None if there is none); and for every match, the name of the
+        position, the distance and the fields of the source.
+    """
+
+    nearest, distances = nearest
+    matched, indices, separations = matches
+    found = nearest >= 0
+    columns = [json_values(positions[name])
+               for name in ('name', 'ra', 'decl', 'radius')]
+    columns.append(json_values(numpy.where(found, distances, numpy.nan)))
+    for name in fields:
+        column = numpy.empty(len(positions), dtype=object)
+        column[found] = json_values(index.sources[name][nearest[found]])
+        columns.append(column.tolist())
+    nearest_rows = [list(row) for row in zip(*columns)]
+
+    columns = [json_values(positions['name'][matched]),
+               json_values(separations)]
+    columns.extend([json_values(index.sources[name][indices])
+                    for name in fields])
+    return nearest_rows, [list(row) for row in zip(*columns)]
+
+
+def new_positions(positions, ra, decl, radius):
+    """Find the positions that are not duplicates of known positions
+
+    A position is a duplicate if it is within radius (in arcseconds) of
+    one of the known positions (arrays ra and decl in degrees), or of a
+    position earlier in the list.
+
+    Returns:
+
+        boolean array, True for the positions that are not duplicates.
+    """
+
+    radius = radius / 3600.
+    known = numpy.isfinite(ra) & numpy.isfinite(decl)
+    indices, distances = position_index(ra[known], decl[known]).nearest(
+        positions['ra'], positions['decl'], radius)
+    keep = indices < 0
+    matched, others, distances = position_index(
+        positions['ra'], positions['decl']).within(
+        positions['ra'], positions['decl'], radius)
+    keep[matched[others < matched]] = False
+    return keep
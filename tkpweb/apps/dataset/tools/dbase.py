@@ -1,15 +1,565 @@
 import tkp.database as tkpdb
+from tkp.config import config
 from scipy.stats import chisqprob
 from .image import open_image
+from .cache import MemoryCache
 from tkpweb import settings
-import datetime
+import itertools
+import math
+import numpy
+
+
+# Grouped subqueries for the extra dataset information: each returns one
+# (dataset, n) row per dataset, so that the counts for all datasets are
+# obtained with a single query, instead of one query per dataset per count.
+# The second item is the column to restrict on for a single dataset.
+DATASET_COUNTS = {
+    'ntransients': ("""\
+SELECT rc.dataset AS dataset, COUNT(*) AS n
+  FROM transient tr, runningcatalog rc
+ WHERE tr.runcat = rc.id""", "rc.dataset"),
+    'nimages': ("""\
+SELECT im.dataset AS dataset, COUNT(*) AS n
+  FROM image im
+ WHERE im.dataset IS NOT NULL""", "im.dataset"),
+    'nsources': ("""\
+SELECT rc.dataset AS dataset, COUNT(*) AS n
+  FROM runningcatalog rc
+ WHERE rc.dataset IS NOT NULL""", "rc.dataset"),
+    'ntotalsources': ("""\
+SELECT im.dataset AS dataset, COUNT(*) AS n
+  FROM extractedsource ex, image im
+ WHERE ex.image = im.id""", "im.dataset"),
+    }
+
+
+# Columns that the listings can be ordered on: maps the name used for the
+# ordering (e.g., in the ?order= parameter of a page) to the SQL
+# expression in the listing query. Each listing is also ordered on its
+# 'id' column, which serves as the (keyset) cursor for paging.
+ORDERING = {
+    'image': {
+        'id': 'im.id',
+        'taustart_ts': 'im.taustart_ts',
+        'tau_time': 'im.tau_time',
+        'freq_eff': 'im.freq_eff',
+        'freq_bw': 'im.freq_bw',
+        'centre_ra': 'sky.centre_ra',
+        'centre_decl': 'sky.centre_decl',
+        },
+    'transient': {
+        'id': 't.id',
+        'runcat': 't.runcat',
+        'band': 't.band',
+        'freq_eff': 'i.freq_eff',
+        'siglevel': 't.siglevel',
+        'v_int': 't.V_int',
+        'eta_int': 't.eta_int',
+        't_start': 't.t_start',
+        'wm_ra': 'rc.wm_ra',
+        'wm_decl': 'rc.wm_decl',
+        'npoints': 'COALESCE(npt.npoints, 0)',
+        },
+    'source': {
+        'id': 'rc.id',
+        'runcat': 'rc.id',
+        'wm_ra': 'rc.wm_ra',
+        'wm_decl': 'rc.wm_decl',
+        'wm_ra_err': 'rc.wm_ra_err',
+        'wm_decl_err': 'rc.wm_decl_err',
+        'datapoints': 'rc.datapoints',
+        },
+    'extractedsource': {
+        'id': 'ex.id',
+        # The first associated source, so that there is one row per
+        # extracted source
+        'runcat': ('(SELECT MIN(ax.runcat) FROM assocxtrsource ax'
+                   ' WHERE ax.xtrsrc = ex.id)'),
+        'image': 'ex.image',
+        'ra': 'ex.ra',
+        'decl': 'ex.decl',
+        'ra_err': 'ex.ra_err',
+        'decl_err': 'ex.decl_err',
+        'det_sigma': 'ex.det_sigma',
+        'f_peak': 'ex.f_peak',
+        'f_peak_err': 'ex.f_peak_err',
+        'f_int': 'ex.f_int',
+        'f_int_err': 'ex.f_int_err',
+        },
+    }
+
+
+def column_array(values, dtype):
+    """Convert a column of query results to a numpy array, replacing
+    NULL values by a suitable value for dtype"""
+    if dtype.kind in 'iu':
+        values = [-1 if value is None else value for value in values]
+    elif dtype.kind in 'SU':
+        values = ['' if value is None else value for value in values]
+    return numpy.array(values, dtype=dtype)
+
+
+# Fields of a lightcurve as numpy structured array, for the points as
+# returned by DataBase.lightcurve()
+LIGHTCURVE_DTYPE = [
+    ('time', 'M8[us]'),
+    ('tau', 'f8'),
+    ('flux', 'f8'),
+    ('flux_err', 'f8'),
+    ('xtrsrc', 'i8'),
+    ('band', 'i8'),
+    ('stokes', 'O'),
+    ('freq', 'f8'),
+    ]
+
+
+def lightcurve_array(lightcurve):
+    """Convert a lightcurve (a list of points) to a structured array with
+    LIGHTCURVE_DTYPE; arrays are returned as is"""
+    if isinstance(lightcurve, numpy.ndarray):
+        return lightcurve
+    dtype = numpy.dtype(LIGHTCURVE_DTYPE)
+    array = numpy.empty(len(lightcurve), dtype=dtype)
+    if lightcurve:
+        for name, column in zip(dtype.names, zip(*lightcurve)):
+            array[name] = column_array(column, dtype[name])
+    return array
+
+
+# Points of several lightcurves, as returned by DataBase.lightcurves():
+# as LIGHTCURVE_DTYPE, but without object fields, so that the points can
+# be stored in binary formats
+LIGHTCURVES_DTYPE = [(name, 'S8' if dtype == 'O' else dtype)
+                     for name, dtype in LIGHTCURVE_DTYPE]
+
+
+# Mid-point times and integration times of the images in a dataset, as
+# returned by DataBase.image_times()
+IMAGE_TIMES_DTYPE = [
+    ('time', 'M8[us]'),
+    ('tau', 'f8'),
+    ]
+
+# Image times per (database, dataset), with the image_version() they
+# were obtained for; the same for every source in a dataset
+_image_times = MemoryCache(max_items=50)
+
+
+# Names of server-side cursors; see DataBase.batch_cursor()
+_cursor_ids = itertools.count()
+
+
+# Catalogues for cone searches: the tables to query, the alias of the
+# table with the positions (ra, decl, the unit vector x, y, z, and the
+# declination zone), the column to restrict on for a single dataset, and
+# the columns returned for each source, with their types (as for
+# array()).
+CONE_SEARCH = {
+    'runningcatalog': {
+        'tables': "runningcatalog rc",
+        'alias': "rc",
+        'dataset': "rc.dataset",
+        'columns': [
+            ('id', 'rc.id', 'i8'),
+            ('dataset', 'rc.dataset', 'i8'),
+            ('ra', 'rc.wm_ra', 'f8'),
+            ('decl', 'rc.wm_decl', 'f8'),
+            ('ra_err', 'rc.wm_ra_err', 'f8'),
+            ('decl_err', 'rc.wm_decl_err', 'f8'),
+            ('datapoints', 'rc.datapoints', 'i8'),
+            ],
+        },
+    'extractedsource': {
+        'tables': "extractedsource ex JOIN image im ON im.id = ex.image",
+        'alias': "ex",
+        'dataset': "im.dataset",
+        'columns': [
+            ('id', 'ex.id', 'i8'),
+            ('dataset', 'im.dataset', 'i8'),
+            ('image', 'ex.image', 'i8'),
+            ('ra', 'ex.ra', 'f8'),
+            ('decl', 'ex.decl', 'f8'),
+            ('ra_err', 'ex.ra_err', 'f8'),
+            ('decl_err', 'ex.decl_err', 'f8'),
+            ('det_sigma', 'ex.det_sigma', 'f8'),
+            ('f_peak', 'ex.f_peak', 'f8'),
+            ('f_int', 'ex.f_int', 'f8'),
+            ],
+        },
+    }
+
+
+def unit_vector(ra, decl):
+    """Cartesian coordinates (x, y, z) on the unit sphere of a position
+    in degrees, as in the x, y and z columns of the database"""
+    ra, decl = math.radians(ra), math.radians(decl)
+    return (math.cos(decl) * math.cos(ra), math.cos(decl) * math.sin(ra),
+            math.sin(decl))
+
+
+class Record(object):
+    """A row of query results, with dict-like access to its columns
+
+    The index of column names is shared by all records of a query, and
+    the row is kept as returned by the database, so that no dict is
+    built for every row. Values set on a record (including new keys) are
+    stored with the record itself, without affecting the row.
+    """
+
+    __slots__ = ('_index', '_row', '_extra')
+
+    def __init__(self, index, row):
+        self._index = index
+        self._row = row
+        self._extra = None
+
+    def __getitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        return self._row[self._index[key]]
+
+    def __setitem__(self, key, value):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __contains__(self, key):
+        return key in self._index or (
+            self._extra is not None and key in self._extra)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = self._index.keys()
+        if self._extra:
+            keys.extend([key for key in self._extra if key not in self._index])
+        return keys
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def update(self, other):
+        for key, value in dict(other).iteritems():
+            self[key] = value
+
+
+def records(description, rows, aliases=None):
+    """Generate a Record for every row of a query
+
+    Args:
+
+        description (dict): column name to index in the rows.
+
+        rows (iterable): the rows.
+
+    Kwargs:
+
+        aliases (dict or None): additional names for columns, as alias:
+            column name; these are added to the shared index, instead
+            of to every record.
+    """
+
+    index = dict(description)
+    for alias, key in (aliases or {}).iteritems():
+        index[alias] = index[key]
+    for row in rows:
+        yield Record(index, row)
+
+
+def paging(columns, order=None, limit=None, after=None, before=None,
+           offset=None):
+    """Create the ordering and paging clauses for a listing query
+
+    Args:
+
+        columns (dict): the columns that can be ordered on; see
+            ORDERING.
+
+    Kwargs:
+
+        order (string or None): name of the column to order on,
+            optionally prefixed by a '-' for descending order. Defaults
+            to ordering on id.
+
+        limit (int or None): maximum number of rows to return.
+
+        after, before (int or None): keyset cursors. Only rows that come
+            after (before) the row with the given id are returned. The
+            cursors can only be used when ordering on id.
+
+        offset (int or None): number of rows to skip. Use this instead
+            of the cursors when ordering on another column than id.
+
+    Returns:
+
+        (tuple): a WHERE condition (starting with 'AND'), the ORDER BY
+            and LIMIT clauses, the parameters for the condition, and a
+            boolean indicating whether the fetched rows should be
+            reversed. The latter is the case when paging backwards
+            (with 'before'), which is done by querying in the opposite
+            direction.
+
+    Raises:
+
+        ValueError: for an unknown column or an invalid combination of
+            arguments.
+    """
+
+    order = order or 'id'
+    descending = order.startswith('-')
+    name = order.lstrip('-')
+    if name not in columns:
+        raise ValueError("can't order on %s" % name)
+    if after is not None and before is not None:
+        raise ValueError("use either after or before, not both")
+    condition = ""
+    params = {}
+    reverse = False
+    if after is not None or before is not None:
+        if columns[name] != columns['id']:
+            raise ValueError("paging with a cursor requires ordering on id")
+        if before is not None:
+            # Query backwards from the cursor
+            reverse = True
+            descending = not descending
+        params['cursor'] = int(after if after is not None else before)
+        condition = "AND %s %s %%(cursor)s" % (
+            columns['id'], '<' if descending else '>')
+    direction = 'DESC' if descending else 'ASC'
+    clauses = "ORDER BY %s %s" % (columns[name], direction)
+    if columns[name] != columns['id']:
+        clauses += ", %s %s" % (columns['id'], direction)
+    if limit is not None:
+        clauses += " LIMIT %d" % int(limit)
+    if offset:
+        clauses += " OFFSET %d" % int(offset)
+    return condition, clauses, params, reverse
 
 
 class DataBase(object):
 
-    def __init__(self, dblogin=None):
+    def __init__(self, dblogin=None, db=None):
+        """Use the given connection (tkp.database.DataBase), or connect
+        to the database given by dblogin (the default database if None)
+        """
         self.dblogin = dblogin
-        self.db = tkpdb.DataBase(**dblogin) if dblogin else tkpdb.DataBase()
+        if db is None:
+            db = tkpdb.DataBase(**dblogin) if dblogin else tkpdb.DataBase()
+        self.db = db
+
+    @property
+    def key(self):
+        """Identify the database, for use in cache keys"""
+        dblogin = self.dblogin or config['database']
+        return (dblogin['host'], dblogin['port'], dblogin['name'])
+
+    def dataset_version(self, dataset):
+        """Return a stamp that changes whenever images are added to (or
+        removed from) a dataset, or sources or transients are added to
+        it
+
+        The stamp is the number of images and the highest id of the
+        images, running catalog sources and transients of the dataset.
+        Data derived from a dataset (such as plots, or the spatial index
+        of its sources) can be cached under a key that includes this
+        stamp. It is obtained on every request for such data, so it
+        avoids extractedsource, which has far more rows than the other
+        tables: extracted sources added to existing images without
+        adding any source or transient do not change it.
+        """
+        self.db.cursor.execute("""\
+SELECT (SELECT COUNT(*) FROM image WHERE dataset = %(dsid)s)
+      ,(SELECT MAX(id) FROM image WHERE dataset = %(dsid)s)
+      ,(SELECT MAX(id) FROM runningcatalog WHERE dataset = %(dsid)s)
+      ,(SELECT MAX(tr.id)
+          FROM transient tr, runningcatalog rc
+         WHERE tr.runcat = rc.id
+           AND rc.dataset = %(dsid)s)
+""", {'dsid': dataset})
+        return tuple(self.db.cursor.fetchone())
+
+    def image_version(self, dataset):
+        """Return a stamp that changes whenever images are added to (or
+        removed from) a dataset: the number of images and the highest
+        image id, which are the first two items of dataset_version()"""
+        return tuple(self.db.getone(
+            "SELECT COUNT(*), MAX(id) FROM image WHERE dataset = %s",
+            dataset))
+
+    def dataset_versions(self):
+        """Return the image_version() of all datasets (with images) at
+        once, as a dict"""
+        return dict((row[0], tuple(row[1:])) for row in self.db.get(
+            "SELECT dataset, COUNT(*), MAX(id) FROM image GROUP BY dataset"))
+
+    def image_count(self, dataset, last_image):
+        """Return the number of images in a dataset up to and including
+        image id last_image"""
+        return self.db.getone(
+            "SELECT COUNT(*) FROM image WHERE dataset = %s AND id <= %s",
+            dataset, last_image)[0]
+
+    def latest_ids(self):
+        """Return the highest extracted source, running catalog source
+        and transient ids in the database (over all datasets); 0 for
+        empty tables"""
+        return tuple(self.db.getone("""\
+SELECT (SELECT COALESCE(MAX(id), 0) FROM extractedsource)
+      ,(SELECT COALESCE(MAX(id), 0) FROM runningcatalog)
+      ,(SELECT COALESCE(MAX(id), 0) FROM transient)
+"""))
+
+    def changed_datasets(self, xtrsrc, runcat, transient):
+        """Return the set of datasets with extracted sources, running
+        catalog sources or transients with an id above the given ones
+        (see latest_ids())
+
+        Only the rows above these ids are scanned, through the primary
+        keys of the tables.
+        """
+        self.db.cursor.execute("""\
+SELECT im.dataset
+  FROM extractedsource ex, image im
+ WHERE ex.image = im.id
+   AND ex.id > %(xtrsrc)s
+UNION
+SELECT rc.dataset
+  FROM runningcatalog rc
+ WHERE rc.id > %(runcat)s
+UNION
+SELECT rc.dataset
+  FROM transient tr, runningcatalog rc
+ WHERE tr.runcat = rc.id
+   AND tr.id > %(transient)s
+""", {'xtrsrc': xtrsrc, 'runcat': runcat, 'transient': transient})
+        return set([row[0] for row in self.db.cursor.fetchall()])
+
+    def dataset_increment(self, dataset, upto, after=None, after_source=None):
+        """Return the counts and quality control aggregates for the
+        images with an id above after (all images if None) in a dataset,
+        and for the extracted sources in those images or with an id
+        above after_source, up to and including extracted source id upto
+
+        Returns a dict with:
+
+            - nimages, last_image (the highest image id; None if there
+              are no such images);
+
+            - min_sources_per_image, max_sources_per_image: for these
+              images;
+
+            - ntotalsources: the number of these extracted sources, of
+              which `late` are in images with an id up to after;
+
+            - rms_count, rms_sum, rms_min, rms_max: for the rms
+              (20000 * f_peak / det_sigma) of these extracted sources
+              with a det_sigma of at least 1e-6.
+
+        Only the given images and extracted sources are scanned.
+        """
+
+        params = {'dsid': dataset, 'upto': upto,
+                  'after': -1 if after is None else after,
+                  'after_source': -1 if after_source is None else after_source}
+        self.db.cursor.execute("""\
+SELECT COUNT(*)
+      ,MAX(im.id)
+      ,MIN(COALESCE(nsrc.n, 0))
+      ,MAX(COALESCE(nsrc.n, 0))
+  FROM image im
+       LEFT OUTER JOIN (SELECT ex.image AS image, COUNT(*) AS n
+                          FROM extractedsource ex, image im1
+                         WHERE ex.image = im1.id
+                           AND im1.dataset = %(dsid)s
+                           AND im1.id > %(after)s
+                           AND ex.id <= %(upto)s
+                         GROUP BY ex.image
+                       ) AS nsrc
+       ON nsrc.image = im.id
+ WHERE im.dataset = %(dsid)s
+   AND im.id > %(after)s
+""", params)
+        nimages, last_image, min_sources, max_sources = self.db.cursor.fetchone()
+        # The sources in the new images, and those added to earlier
+        # images since the last increment, as two index-friendly parts
+        self.db.cursor.execute("""\
+SELECT COUNT(*)
+      ,SUM(src.late)
+      ,COUNT(src.rms)
+      ,SUM(src.rms)
+      ,MIN(src.rms)
+      ,MAX(src.rms)
+  FROM (SELECT 0 AS late
+              ,CASE WHEN ex.det_sigma >= 1e-6
+                    THEN 20000 * ex.f_peak / ex.det_sigma
+               END AS rms
+          FROM extractedsource ex, image im
+         WHERE ex.image = im.id
+           AND im.dataset = %(dsid)s
+           AND im.id > %(after)s
+           AND ex.id <= %(upto)s
+        UNION ALL
+        SELECT 1 AS late
+              ,CASE WHEN ex.det_sigma >= 1e-6
+                    THEN 20000 * ex.f_peak / ex.det_sigma
+               END AS rms
+          FROM extractedsource ex, image im
+         WHERE ex.image = im.id
+           AND im.dataset = %(dsid)s
+           AND im.id <= %(after)s
+           AND ex.id > %(after_source)s
+           AND ex.id <= %(upto)s
+       ) AS src
+""", params)
+        (ntotalsources, late, rms_count, rms_sum, rms_min,
+         rms_max) = self.db.cursor.fetchone()
+        return {'nimages': nimages, 'last_image': last_image,
+                'ntotalsources': ntotalsources, 'late': late or 0,
+                'min_sources_per_image': min_sources,
+                'max_sources_per_image': max_sources,
+                'rms_count': rms_count, 'rms_sum': rms_sum or 0.,
+                'rms_min': rms_min, 'rms_max': rms_max}
+
+    def sources_per_image(self, dataset, last_image, upto):
+        """Return the minimum and maximum number of extracted sources
+        (up to and including id upto) per image, over the images of a
+        dataset up to and including image id last_image"""
+        self.db.cursor.execute("""\
+SELECT MIN(COALESCE(nsrc.n, 0))
+      ,MAX(COALESCE(nsrc.n, 0))
+  FROM image im
+       LEFT OUTER JOIN (SELECT ex.image AS image, COUNT(*) AS n
+                          FROM extractedsource ex, image im1
+                         WHERE ex.image = im1.id
+                           AND im1.dataset = %(dsid)s
+                           AND im1.id <= %(last_image)s
+                           AND ex.id <= %(upto)s
+                         GROUP BY ex.image
+                       ) AS nsrc
+       ON nsrc.image = im.id
+ WHERE im.dataset = %(dsid)s
+   AND im.id <= %(last_image)s
+""", {'dsid': dataset, 'last_image': last_image, 'upto': upto})
+        return tuple(self.db.cursor.fetchone())
 
     def dataset(self, id=None, extra_info=()):
         """Get information on one or more datasets form the database
@@ -37,10 +587,14 @@ class DataBase(object):
                 will be transformed into a set, to filter out double
                 strings.
 
+                All counts are obtained in the same query as the
+                datasets themselves, so the number of queries does not
+                depend on the number of datasets.
+
          Returns:
 
-            (list): A list of dicts; each list item corresponds to a
-                single database row, while each dict contains the values
+            (list): A list of dict-like Records; each item corresponds to a
+                single database row, while each record contains the values
                 for the columns (with the column names the keys; some
                 column values are available twice, with a different
                 key). For a single dataset, the returned value is a
@@ -48,48 +602,31 @@ class DataBase(object):
         """
 
         extra_info = set(extra_info)
+        columns = ["ds.*"]
+        joins = []
+        for key in sorted(extra_info.intersection(DATASET_COUNTS)):
+            query, column = DATASET_COUNTS[key]
+            if id is not None:
+                query += "\n   AND %s = %%(dsid)s" % column
+            query += "\n GROUP BY %s" % column
+            columns.append("COALESCE(cnt_%s.n, 0) AS %s" % (key, key))
+            joins.append(
+                "LEFT OUTER JOIN (%s) AS cnt_%s\n  ON cnt_%s.dataset = ds.id" %
+                (query, key, key))
+        query = "SELECT %s\n  FROM dataset ds\n%s" % (
+            "\n      ,".join(columns), "\n".join(joins))
         if id is not None:  # id = 0 could be valid for some databases
-            self.db.execute("""SELECT * FROM dataset WHERE id = %s""", id)
-        else:
-            self.db.execute("""SELECT * FROM dataset""")
+            query += "\n WHERE ds.id = %(dsid)s"
+        self.db.cursor.execute(query, {'dsid': id})
         description = dict(
             [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        datasets = []
-        for row in self.db.cursor.fetchall():
-            datasets.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-            # Format into slightly nicer keys
-            for key1, key2 in zip(
-                ['id', 'process_ts'],
-                ['id', 'processdate']):
-                datasets[-1][key2] = datasets[-1][key1]
-            if 'ntransients' in extra_info:
-                query = """\
-SELECT COUNT(*) FROM transient tr, runningcatalog rc
-WHERE tr.runcat = rc.id AND rc.dataset = %s"""
-                datasets[-1]['ntransients'] = self.db.getone(
-                    query, datasets[-1]['id'])[0]
-            if 'nimages' in extra_info:
-                query = """\
-SELECT COUNT(*) FROM image WHERE dataset = %s"""
-                datasets[-1]['nimages'] = self.db.getone(
-                    query, datasets[-1]['id'])[0]
-            if 'nsources' in extra_info:
-                query = """\
-SELECT COUNT(*) FROM runningcatalog WHERE dataset = %s"""
-                datasets[-1]['nsources'] = self.db.getone(
-                    query, datasets[-1]['id'])[0]
-            if 'ntotalsources' in extra_info:
-                query = """\
-SELECT COUNT(*) FROM extractedsource ex, image im
-WHERE ex.image = im.id and im.dataset = %s"""
-                datasets[-1]['ntotalsources'] = self.db.getone(
-                    query, datasets[-1]['id'])[0]
-        return datasets
-
-
-    def image(self, id=None, dataset=None, extra_info=()):
+        # Format into slightly nicer keys
+        return list(records(description, self.db.cursor.fetchall(),
+                            aliases={'processdate': 'process_ts'}))
+
+
+    def image(self, id=None, dataset=None, extra_info=(), batchsize=None,
+              dtype=None, **page):
         """Get information on one or more datasets form the database
 
         Kwargs:
@@ -113,10 +650,27 @@ WHERE ex.image = im.id and im.dataset = %s"""
                 will be transformed into a set, to filter out double
                 strings.
 
+                The extra information is joined onto the image query, so
+                the number of queries does not depend on the number of
+                images.
+
+            batchsize (int or None): if given, return an iterator that
+                fetches the rows in batches of this size, instead of a
+                list. Use this for listings too large to hold in memory.
+
+            dtype (numpy.dtype or None): if given, return the listing
+                as a numpy structured array with the fields of dtype,
+                instead of a list. The fields are filled directly from
+                the corresponding columns; see array().
+
+            Any further keyword arguments (order, limit, after, before
+            and offset) select a single, ordered page of the listing;
+            see paging().
+
          Returns:
 
-            (list): A list of dicts; each list item corresponds to a
-                single database row, while each dict contains the values
+            (list): A list of dict-like Records; each item corresponds to a
+                single database row, while each record contains the values
                 for the columns (with the column names the keys; some
                 column values are available twice, with a different
                 key). For a single image, the returned value is a
@@ -124,55 +678,70 @@ WHERE ex.image = im.id and im.dataset = %s"""
         """
 
         extra_info = set(extra_info)
-        basic_query = """SELECT im.*
-                              ,sky.centre_ra
-                              ,sky.centre_decl
-                         FROM image im
-                             ,skyregion sky
-                         WHERE sky.id = im.skyrgn """
-        if id is not None:  # id = 0 could be valid for some databases
-            if dataset is not None:
-                extra_clauses = """AND im.id = %(imgid)s 
-                                   AND im.dataset = %(dsid)s"""
-                self.db.cursor.execute(basic_query + extra_clauses,
-                                {'imgid':id, 'dsid':dataset})
-            else:
-                extra_clauses = """AND im.id = %(imgid)s """
-                self.db.cursor.execute(basic_query + extra_clauses,
-                                {'imgid':id})
-        else:
-            if dataset is not None:
-                extra_clauses = """AND im.dataset = %(dsid)s"""
-                self.db.cursor.execute(basic_query + extra_clauses,
-                                {'dsid':dataset})
-            else:
-                self.db.cursor.execute(basic_query)
 
-        description = dict(
-            [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        images = []
-        for row in self.db.cursor.fetchall():
-            images.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-
-            if 'ntotalsources' in extra_info:
-                query = """\
-SELECT COUNT(*) FROM extractedsource WHERE image = %s"""
-                images[-1]['ntotalsources'] = self.db.getone(
-                    query, images[-1]['id'])[0]
-            if 'reject' in extra_info:
-                query = "select description, comment " \
-                        "from rejection, rejectreason " \
-                        "where rejection.rejectreason = rejectreason.id and image=%s"
-                result = self.db.getone(query, images[-1]['id'])
-                if result:
-                    reason = ": ".join(result)
-                    images[-1]['reject'] = reason
-        return images
-
-
-    def transient(self, id=None, dataset=None):
+        def conditions(alias):
+            # The same restrictions apply to the main and the subqueries
+            clauses = []
+            if id is not None:  # id = 0 could be valid for some databases
+                clauses.append("AND %s.id = %%(imgid)s" % alias)
+            if dataset is not None:
+                clauses.append("AND %s.dataset = %%(dsid)s" % alias)
+            return " ".join(clauses)
+
+        condition, clauses, params, reverse = paging(ORDERING['image'], **page)
+        params.update({'imgid': id, 'dsid': dataset})
+        columns = ["im.*", "sky.centre_ra", "sky.centre_decl"]
+        joins = []
+        if 'ntotalsources' in extra_info:
+            columns.append("COALESCE(nsrc.ntotalsources, 0) AS ntotalsources")
+            joins.append("""\
+LEFT OUTER JOIN (SELECT ex.image AS image, COUNT(*) AS ntotalsources
+                   FROM extractedsource ex, image im1
+                  WHERE ex.image = im1.id
+                  %s
+                  GROUP BY ex.image) AS nsrc
+  ON nsrc.image = im.id""" % conditions('im1'))
+        if 'reject' in extra_info:
+            columns.extend(["rej.description AS reject_description",
+                            "rej.comment AS reject_comment"])
+            # Only the first rejection of an image, so that there is
+            # one row per image
+            joins.append("""\
+LEFT OUTER JOIN (SELECT rj.image AS image, rr.description, rj.comment
+                   FROM rejection rj, rejectreason rr,
+                        (SELECT rj1.image AS image, MIN(rj1.id) AS id
+                           FROM rejection rj1, image im2
+                          WHERE rj1.image = im2.id
+                          %s
+                          GROUP BY rj1.image) AS rjmin
+                  WHERE rj.id = rjmin.id
+                    AND rj.rejectreason = rr.id) AS rej
+  ON rej.image = im.id""" % conditions('im2'))
+        query = """\
+SELECT %s
+  FROM image im
+  JOIN skyregion sky ON sky.id = im.skyrgn
+%s
+ WHERE 1 = 1
+ %s %s
+%s""" % ("\n      ,".join(columns), "\n".join(joins),
+         conditions('im'), condition, clauses)
+
+        def convert(description, rows):
+            for image in records(description, rows):
+                if 'reject' in extra_info:
+                    reason = (image['reject_description'],
+                              image['reject_comment'])
+                    if reason[0] is not None:
+                        image['reject'] = ": ".join(
+                            [item for item in reason if item])
+                yield image
+
+        return self._rows(query, params, convert, reverse, batchsize, dtype)
+
+
+    def transient(self, id=None, dataset=None, batchsize=None, dtype=None,
+                  **page):
         """Get information on one or more datasets form the database
 
         Kwargs:
@@ -184,135 +753,96 @@ SELECT COUNT(*) FROM extractedsource WHERE image = %s"""
             dataset (int or None): limit image(s) to given dataset, if
                 any.
 
+            batchsize (int or None): if given, return an iterator that
+                fetches the rows in batches of this size, instead of a
+                list. Use this for listings too large to hold in memory.
+
+            dtype (numpy.dtype or None): if given, return the listing
+                as a numpy structured array with the fields of dtype,
+                instead of a list. The fields are filled directly from
+                the corresponding columns; see array().
+
+            Any further keyword arguments (order, limit, after, before
+            and offset) select a single, ordered page of the listing;
+            see paging().
+
          Returns:
 
-            (list): A list of dicts; each list item corresponds to a
-                single database row, while each dict contains the values
+            (list): A list of dict-like Records; each item corresponds to a
+                single database row, while each record contains the values
                 for the columns (with the column names the keys; some
                 column values are available twice, with a different
                 key). For a single image, the returned value is a
                 single-element list.
+
+                Each transient includes 'npoints', the actual number of
+                datapoints (including those from sub-detection level
+                monitoring observations), which is obtained in the same
+                query.
         """
 
-        if id is not None:  # id = 0 could be valid for some databases
-            if dataset is not None:
-                self.db.execute("""\
-                    SELECT t.id
-                          ,t.runcat
-                          ,t.trigger_xtrsrc
-                          ,i.freq_eff
-                          ,t.band
-                          ,t.siglevel
-                          ,t.V_int
-                          ,t.eta_int
-                          ,t.t_start
-                          ,rc.datapoints
-                          ,rc.wm_ra
-                          ,rc.wm_ra_err
-                          ,rc.wm_decl
-                          ,rc.wm_decl_err 
-                      FROM runningcatalog as rc
-                          ,transient t
-                          ,extractedsource x
-                          ,image i
-                     WHERE t.id = %s 
-                       AND rc.dataset = %s 
-                       AND t.runcat = rc.id
-                       AND t.trigger_xtrsrc = x.id
-                       AND x.image = i.id
-                       AND i.dataset = %s
-                    """, id, dataset, dataset)
-            else:
-                self.db.execute("""\
-                    SELECT transient.*
-                          ,rc.datapoints
-                          ,rc.wm_ra
-                          ,rc.wm_ra_err
-                          ,rc.wm_decl
-                          ,rc.wm_decl_err 
-                      FROM runningcatalog as rc
-                          ,transient 
-                     WHERE transient.id = %s 
-                       AND transient.runcat = rc.id
-                    """, id)
-        else:
+        def conditions(transient, runningcatalog):
+            # The runningcatalog entry fixes the dataset of a transient,
+            # so there is no need to also restrict on the image dataset.
+            clauses = []
+            if id is not None:  # id = 0 could be valid for some databases
+                clauses.append("AND %s.id = %%(trid)s" % transient)
             if dataset is not None:
-                self.db.execute("""\
-                    SELECT t.id
-                          ,t.runcat
-                          ,t.trigger_xtrsrc
-                          ,i.freq_eff
-                          ,t.band
-                          ,t.siglevel
-                          ,t.V_int
-                          ,t.eta_int
-                          ,t.t_start
-                          ,rc.datapoints
-                          ,rc.wm_ra
-                          ,rc.wm_ra_err
-                          ,rc.wm_decl
-                          ,rc.wm_decl_err
-                          ,npt.npoints
-                      FROM runningcatalog as rc
-                          ,transient t
-                          ,extractedsource x
-                          ,image i
-                          ,(SELECT a.runcat as id, COUNT(a.runcat) as npoints
-                            FROM assocxtrsource a
-                                ,runningcatalog rc
-                            WHERE rc.dataset = %s
-                              AND a.runcat = rc.id
-                            GROUP BY a.runcat) as npt
-                     WHERE rc.dataset = %s
-                       AND t.runcat = rc.id
-                       AND t.trigger_xtrsrc = x.id
-                       AND x.image = i.id
-                       AND i.dataset = %s
-                       AND npt.id = rc.id
-                    """, dataset, dataset, dataset)
-            else:
-                self.db.execute("""\
-                    SELECT transient.*
-                          ,rc.datapoints
-                          ,rc.wm_ra
-                          ,rc.wm_ra_err
-                          ,rc.wm_decl
-                          ,rc.wm_decl_err 
-                      FROM runningcatalog as rc
-                          ,transient 
-                     WHERE transient.runcat = rc.id
-                    """)
-
+                clauses.append("AND %s.dataset = %%(dsid)s" % runningcatalog)
+            return " ".join(clauses)
 
-        description = dict(
-            [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        transients = []
-        rows = self.db.cursor.fetchall()
-        for row in rows:
-            transients.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-            # Obtain the actual number of datapoints, including those from
-            # sub-detection level monitoring observations
-            # This is already done in one of the queries above: here, we
-            # handle the other cases.
-            # TODO: Shift this into the above queries.
-            if not "npoints" in transients[-1]:
-                transients[-1]['npoints'] = self.db.getone(
-                    "SELECT COUNT(*) FROM assocxtrsource WHERE runcat = %s",
-                    transients[-1]['runcat'])[0]
-
-            # TODO: FEEDBACK: Why is the siglevel recalculated. This was
-            # already done and stored in the transient table
-            # Calculate the significance level (note: here we do need rc.datapoints,
-            # instead of the above npoints)
-            #n = transients[-1]['datapoints']
-            #transients[-1]['siglevel'] = chisqprob(
-            #    transients[-1]['siglevel'] * n, n)
-        return transients
-
-
-    def source(self, runcat=None, dataset=None):
+        condition, clauses, params, reverse = paging(
+            ORDERING['transient'], **page)
+        params.update({'trid': id, 'dsid': dataset})
+        query = """\
+SELECT t.id
+      ,t.runcat
+      ,t.trigger_xtrsrc
+      ,i.freq_eff
+      ,t.band
+      ,t.siglevel
+      ,t.V_int
+      ,t.eta_int
+      ,t.t_start
+      ,rc.dataset
+      ,rc.datapoints
+      ,rc.wm_ra
+      ,rc.wm_ra_err
+      ,rc.wm_decl
+      ,rc.wm_decl_err
+      ,COALESCE(npt.npoints, 0) AS npoints
+  FROM transient t
+  JOIN runningcatalog rc ON rc.id = t.runcat
+  JOIN extractedsource x ON x.id = t.trigger_xtrsrc
+  JOIN image i ON i.id = x.image
+  LEFT OUTER JOIN (SELECT a.runcat AS runcat, COUNT(*) AS npoints
+                     FROM assocxtrsource a
+                    WHERE a.runcat IN (SELECT t1.runcat
+                                         FROM transient t1, runningcatalog rc1
+                                        WHERE t1.runcat = rc1.id
+                                        %s)
+                    GROUP BY a.runcat) AS npt
+    ON npt.runcat = t.runcat
+ WHERE 1 = 1
+ %s %s
+%s""" % (conditions('t1', 'rc1'), conditions('t', 'rc'), condition, clauses)
+
+        def convert(description, rows):
+            for transient in records(description, rows):
+                # TODO: FEEDBACK: Why is the siglevel recalculated. This was
+                # already done and stored in the transient table
+                # Calculate the significance level (note: here we do need rc.datapoints,
+                # instead of the above npoints)
+                #n = transient['datapoints']
+                #transient['siglevel'] = chisqprob(
+                #    transient['siglevel'] * n, n)
+                yield transient
+
+        return self._rows(query, params, convert, reverse, batchsize, dtype)
+
+
+    def source(self, runcat=None, dataset=None, batchsize=None, dtype=None,
+               **page):
         """Get information on one or sources from the database
 
         The sources obtained are those in the runningcatalog; these are the
@@ -327,10 +857,23 @@ SELECT COUNT(*) FROM extractedsource WHERE image = %s"""
             dataset (int or None): limit image(s) to given dataset, if
                 any.
 
+            batchsize (int or None): if given, return an iterator that
+                fetches the rows in batches of this size, instead of a
+                list. Use this for listings too large to hold in memory.
+
+            dtype (numpy.dtype or None): if given, return the listing
+                as a numpy structured array with the fields of dtype,
+                instead of a list. The fields are filled directly from
+                the corresponding columns; see array().
+
+            Any further keyword arguments (order, limit, after, before
+            and offset) select a single, ordered page of the listing;
+            see paging().
+
          Returns:
 
-            (list): A list of dicts; each list item corresponds to a
-                single database row, while each dict contains the values
+            (list): A list of dict-like Records; each item corresponds to a
+                single database row, while each record contains the values
                 for the columns (with the column names the keys; some
                 column values are available twice, with a different
                 key). For a single image, the returned value is a
@@ -338,34 +881,33 @@ SELECT COUNT(*) FROM extractedsource WHERE image = %s"""
         """
         #NB In new schema Runcat --> Dataset. 
         #Need only condition on one of these.
-        
+
+        condition, clauses, params, reverse = paging(
+            ORDERING['source'], **page)
         if runcat is not None:  # id = 0 could be valid for some databases
-            self.db.execute("""
-            SELECT * 
-            FROM runningcatalog
-            WHERE id = %s""", runcat)
+            params['runcat'] = runcat
+            extra_condition = "AND rc.id = %(runcat)s"
         elif dataset is not None:
-            self.db.execute("""\
-            SELECT * 
-            FROM runningcatalog 
-            WHERE dataset = %s""", dataset)
+            params['dsid'] = dataset
+            extra_condition = "AND rc.dataset = %(dsid)s"
         else: #Gotta catch em all
-            self.db.execute("""\
-            SELECT * FROM runningcatalog""")
-            
-        description = dict(
-            [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        sources = []
-        for row in self.db.cursor.fetchall():
-            sources.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
+            extra_condition = ""
+        query = """\
+SELECT rc.*
+  FROM runningcatalog rc
+ WHERE 1 = 1
+ %s %s
+%s""" % (extra_condition, condition, clauses)
+
+        def convert(description, rows):
             # Duplicate dictionary key 'id' as more explicit 'runcat'
-            sources[-1]['runcat'] = sources[-1]['id']
-        return sources
+            return records(description, rows, aliases={'runcat': 'id'})
+
+        return self._rows(query, params, convert, reverse, batchsize, dtype)
 
 
-    def extractedsource(self, id=None, dataset=None, image=None):
+    def extractedsource(self, id=None, dataset=None, image=None,
+                        batchsize=None, dtype=None, **page):
         """Get information on one or more extractedsources from the
         database
 
@@ -382,10 +924,23 @@ SELECT COUNT(*) FROM extractedsource WHERE image = %s"""
                 image is not in the dataset, an empty list will be
                 returned.
 
+            batchsize (int or None): if given, return an iterator that
+                fetches the rows in batches of this size, instead of a
+                list. Use this for listings too large to hold in memory.
+
+            dtype (numpy.dtype or None): if given, return the listing
+                as a numpy structured array with the fields of dtype,
+                instead of a list. The fields are filled directly from
+                the corresponding columns; see array().
+
+            Any further keyword arguments (order, limit, after, before
+            and offset) select a single, ordered page of the listing;
+            see paging().
+
          Returns:
 
-            (list): A list of dicts; each list item corresponds to a
-                single database row, while each dict contains the values
+            (list): A list of dict-like Records; each item corresponds to a
+                single database row, while each record contains the values
                 for the columns (with the column names the keys; some
                 column values are available twice, with a different
                 key). For a single image, the returned value is a
@@ -393,100 +948,410 @@ SELECT COUNT(*) FROM extractedsource WHERE image = %s"""
 
             Note important keys:
             'id' : extracted source id
-            'assoc_id' : Unique id for associated source.
+            'runcat' : id of the associated source; the first (by id)
+                if there are several, so that there is one row per
+                extracted source.
             'image': if of image from which source extracted
         """
 
         partial_query = """\
-        SELECT ex.*, im.dataset as dataset, ax.runcat as runcat
+        SELECT ex.*, im.dataset as dataset, %s as runcat
         FROM 
-            extractedsource ex LEFT JOIN assocxtrsource ax
-                        on ex.id = ax.xtrsrc,
+            extractedsource ex,
             image im
         WHERE ex.image = im.id
-        """
+        """ % ORDERING['extractedsource']['runcat']
         
         #NB: image.id implies -> Dataset
         #    xtrsrc.id implies -> Image.
         #Therefore, we need only condition 
         #on the *best* information. (xtrsrc > image > dataset)
 
+        condition, clauses, q_args, reverse = paging(
+            ORDERING['extractedsource'], **page)
         if id is not None:  # id = 0 could be valid for some databases
-            q_args = (id,)
+            q_args['xtrsrc'] = id
             extra_condition ="""
-            AND ex.id = %s  
+            AND ex.id = %(xtrsrc)s
             """
         elif image is not None:
-            q_args = (image,)
+            q_args['image'] = image
             extra_condition ="""  
-            AND ex.image = %s 
+            AND ex.image = %(image)s
             """
         elif dataset is not None: #image is None
-            q_args = (dataset,)
+            q_args['dsid'] = dataset
             extra_condition ="""  
-            AND im.dataset = %s 
+            AND im.dataset = %(dsid)s
             """
         else: ##All none. Simply return all extracted sources.
             extra_condition = ''
-            q_args=()
-                    
-        self.db.cursor.execute(partial_query+extra_condition, q_args)
+
+
+        return self._rows(
+            partial_query + extra_condition + condition + "\n" + clauses,
+            q_args, records, reverse, batchsize, dtype)
+
+    def _rows(self, query, params, convert, reverse=False, batchsize=None,
+              dtype=None):
+        """Execute a listing query and convert the resulting rows
+
+        Args:
+
+            query, params: the query and its parameters.
+
+            convert (callable): generator function, called with the
+                column description (a dict of column name to index) and
+                an iterable over the rows, that yields the listing
+                items.
+
+        Kwargs:
+
+            reverse (bool): reverse the order of the rows.
+
+            batchsize (int or None): see iterate().
+
+            dtype (numpy.dtype or None): see array(); convert is not
+                used in this case.
+
+        Returns:
+
+            (list, iterator or numpy.ndarray): the listing items; an
+                iterator if a batchsize is given, an array if a dtype is
+                given.
+        """
+
+        if dtype is not None:
+            array = self.array(query, params, dtype, batchsize or 10000)
+            return array[::-1] if reverse else array
+        if batchsize is not None:
+            if reverse:
+                raise ValueError("can't iterate over a reversed listing")
+            return self.iterate(query, params, convert, batchsize)
+        self.db.cursor.execute(query, params)
         description = dict(
             [(d[0], i) for i, d in enumerate(self.db.cursor.description)])
-        sources = []
-        for row in self.db.cursor.fetchall():
-            sources.append(
-                dict([(key, row[column])
-                      for key, column in description.iteritems()]))
-        return sources
+        rows = self.db.cursor.fetchall()
+        if reverse:
+            rows.reverse()
+        return list(convert(description, rows))
+
+    def batch_cursor(self, batchsize):
+        """Return a new cursor that fetches rows from the server in
+        batches of batchsize
+
+        psycopg2 transfers the complete result of a query to the client
+        on execute() with an ordinary cursor; a named (server-side)
+        cursor is used instead, which fetches the rows as they are
+        requested. The MonetDB driver already fetches the rows in
+        blocks of the arraysize of the cursor.
+        """
+
+        connection = self.db.connection
+        if type(connection).__module__.startswith('psycopg2'):
+            # Without a transaction to live in, the cursor needs to be
+            # held beyond the implicit commit
+            cursor = connection.cursor(
+                "tkpweb_%d" % _cursor_ids.next(),
+                withhold=bool(getattr(connection, 'autocommit', False)))
+            cursor.itersize = batchsize
+        else:
+            cursor = connection.cursor()
+        cursor.arraysize = batchsize
+        return cursor
+
+    def iterate(self, query, params, convert, batchsize=1000):
+        """Iterate over the results of a query, without holding them all
+        in memory
+
+        The rows are fetched in batches of `batchsize` through a
+        separate cursor (see batch_cursor()), so that other queries can
+        be executed while iterating; the cursor is closed once the
+        iteration finishes. See _rows() for the arguments.
+        """
+
+        cursor = self.batch_cursor(batchsize)
+        try:
+            cursor.execute(query, params)
+            # A server-side cursor only has a description after the
+            # first fetch
+            first = cursor.fetchmany(batchsize)
+            description = dict(
+                [(d[0], i) for i, d in enumerate(cursor.description)])
+
+            def fetch():
+                rows = first
+                while rows:
+                    for row in rows:
+                        yield row
+                    rows = cursor.fetchmany(batchsize)
+
+            for item in convert(description, fetch()):
+                yield item
+        finally:
+            cursor.close()
+
+    def array(self, query, params, dtype, batchsize=10000):
+        """Obtain the results of a query as a numpy structured array
+
+        The rows are fetched in batches, and each batch is transposed
+        into columns, which are converted to the type of the field with
+        the same name in dtype; columns without a corresponding field
+        are skipped. NULL values become NaN for floating point fields,
+        NaT for datetimes, -1 for integers and empty strings for string
+        fields.
+        """
+
+        dtype = numpy.dtype(dtype)
+        cursor = self.batch_cursor(batchsize)
+        try:
+            cursor.execute(query, params)
+            # A server-side cursor only has a description after the
+            # first fetch
+            rows = cursor.fetchmany(batchsize)
+            description = dict(
+                [(d[0], i) for i, d in enumerate(cursor.description)])
+            missing = set(dtype.names) - set(description)
+            if missing:
+                raise ValueError("columns not in query: %s" %
+                                 ", ".join(sorted(missing)))
+            batches = []
+            while rows:
+                columns = zip(*rows)
+                batch = numpy.empty(len(rows), dtype=dtype)
+                for name in dtype.names:
+                    batch[name] = column_array(
+                        columns[description[name]], dtype[name])
+                batches.append(batch)
+                rows = cursor.fetchmany(batchsize)
+        finally:
+            cursor.close()
+        if not batches:
+            return numpy.empty(0, dtype=dtype)
+        return numpy.concatenate(batches)
 
 
     def monitoringlist(self, dataset):
-        monlist_entries =  tkpdb.utils.columns_from_table(self.db.connection,
-                                              'monitoringlist', 
-                                              where={"dataset":dataset})
-        
-        #Replace empty ra, dec with runcat weighted means for blind entries
-        for m in monlist_entries:
-            if m['userentry']==False:
-                runcat_entry = tkpdb.utils.columns_from_table(
-                                              self.db.connection,
-                                              'runningcatalog',
-                                              keywords=['wm_ra','wm_decl'],
-                                              where={'id':m['runcat']}
-                                              )[0]
-#                print runcat_entry
-                m['ra']=runcat_entry['wm_ra']
-                m['decl']=runcat_entry['wm_decl'] 
-        return monlist_entries
-    
-    
+        """Get the monitoring list of a dataset
+
+        Blind entries (those not entered by a user) have no position of
+        their own: they take the weighted mean position of their source,
+        which is obtained in the same query.
+        """
+
+        query = """\
+SELECT ml.*
+      ,rc.wm_ra AS runcat_ra
+      ,rc.wm_decl AS runcat_decl
+  FROM monitoringlist ml
+  LEFT OUTER JOIN runningcatalog rc ON rc.id = ml.runcat
+ WHERE ml.dataset = %(dsid)s
+"""
+
+        def convert(description, rows):
+            for entry in records(description, rows):
+                if entry['userentry'] == False:
+                    entry['ra'] = entry['runcat_ra']
+                    entry['decl'] = entry['runcat_decl']
+                yield entry
+
+        return self._rows(query, {'dsid': dataset}, convert)
+
     def update_monitoringlist(self, ra, dec, dataset):
+        """Add a position to the monitoring list of a dataset"""
+        self.add_monitoringlist([(ra, dec)], dataset)
+
+    def add_monitoringlist(self, positions, dataset, batchsize=1000):
+        """Add several positions ((ra, dec) pairs) to the monitoring list
+        of a dataset, in a single transaction
+
+        The positions are inserted batchsize at a time; if any batch
+        fails, none of the positions are added.
+        """
+
+        if not len(positions):
+            return
         query = """\
 INSERT INTO monitoringlist
 (xtrsrc, ra, decl, dataset, userentry)
 VALUES (-1, %s, %s, %s, TRUE)"""
-        self.db.execute(query, ra, dec, dataset)
+        rows = [(float(ra), float(dec), dataset) for ra, dec in positions]
+        cursor = self.db.connection.cursor()
+        try:
+            for start in xrange(0, len(rows), batchsize):
+                cursor.executemany(query, rows[start:start + batchsize])
+        except:
+            self.db.connection.rollback()
+            raise
+        finally:
+            cursor.close()
         self.db.commit()
 
     def delete_monitoringlist(self, sources):
-        for source in sources:
-            self.db.execute(
-                "DELETE FROM monitoringlist WHERE monitorid = %s", source)
-            self.db.commit()
+        """Remove entries from the monitoring list, with a single
+        statement"""
+
+        if not sources:
+            return
+        self.db.execute(
+            "DELETE FROM monitoringlist WHERE monitorid IN (%s)" %
+            ", ".join(["%s"] * len(sources)), *sources)
+        self.db.commit()
 
     def lightcurve(self, srcid):
         lc = tkpdb.ExtractedSource(id=srcid, database=self.db).lightcurve()
         return lc
 
 
-    def image_times(self, dataset):
-        image_times = self.db.get(
-            "SELECT taustart_ts, tau_time FROM image WHERE dataset = %s",
-            dataset)
+    def lightcurves(self, dataset, runcats=None):
+        """Get the lightcurves of all sources in a dataset, or of some of
+        them, with a single query
+
+        Args:
+
+            dataset (int): dataset id.
+
+        Kwargs:
+
+            runcats (list of ints or None): runningcatalog ids of the
+                sources; all sources in the dataset if None.
+
+        Returns:
+
+            (runcats, offsets, points): runcats is an array with the
+            runningcatalog ids of the sources that have points, in
+            ascending order; the points (structured array with
+            LIGHTCURVES_DTYPE, ordered by time) of source runcats[i]
+            are points[offsets[i]:offsets[i+1]].
+        """
+
+        params = {'dataset': dataset}
+        condition = ""
+        if runcats is not None:
+            if not len(runcats):
+                return (numpy.empty(0, dtype='i8'), numpy.zeros(1, dtype='i8'),
+                        numpy.empty(0, dtype=LIGHTCURVES_DTYPE))
+            condition = "AND ax.runcat IN (%s)" % ", ".join(
+                ["%d" % int(runcat) for runcat in runcats])
+        query = """\
+SELECT ax.runcat AS runcat
+      ,im.taustart_ts AS time
+      ,im.tau_time AS tau
+      ,ex.f_int AS flux
+      ,ex.f_int_err AS flux_err
+      ,ex.id AS xtrsrc
+      ,im.band AS band
+      ,im.stokes AS stokes
+      ,im.freq_eff AS freq
+  FROM assocxtrsource ax
+  JOIN runningcatalog rc ON rc.id = ax.runcat
+  JOIN extractedsource ex ON ex.id = ax.xtrsrc
+  JOIN image im ON im.id = ex.image
+ WHERE rc.dataset = %%(dataset)s
+ %s
+ ORDER BY ax.runcat, im.taustart_ts
+""" % condition
+        rows = self.array(query, params,
+                          [('runcat', 'i8')] + LIGHTCURVES_DTYPE)
+        points = numpy.empty(len(rows), dtype=LIGHTCURVES_DTYPE)
+        for name in points.dtype.names:
+            points[name] = rows[name]
+        # The first point of every lightcurve
+        starts = numpy.flatnonzero(
+            numpy.r_[True, rows['runcat'][1:] != rows['runcat'][:-1]]
+            )[:len(rows)]
+        offsets = numpy.append(starts, len(rows)).astype('i8')
+        return rows['runcat'][starts], offsets, points
+
+    def cone_search(self, ra, decl, radius, dataset=None,
+                    catalogue='runningcatalog', dtype=None):
+        """Get the sources within a radius around a position
+
+        Only the declination zones (the integer degrees of declination,
+        stored with every source) that overlap with the cone are
+        scanned; the sources in these zones are selected on the angle
+        to the centre of the cone, obtained from their unit vectors.
+
+        Args:
+
+            ra, decl (float): centre of the cone, in degrees.
+
+            radius (float): radius of the cone, in degrees.
+
+        Kwargs:
+
+            dataset (int or None): limit the sources to a dataset.
+
+            catalogue (string): 'runningcatalog' (the unique sources) or
+                'extractedsource' (all detections); see CONE_SEARCH.
+
+            dtype (numpy.dtype or None): if given, return the sources as
+                a numpy structured array with the fields of dtype; see
+                array().
+
+        Returns:
+
+            (list): A list of dict-like Records with the columns of the
+                catalogue (see CONE_SEARCH) and the 'distance' to the
+                centre in arcseconds, ordered by distance.
+        """
+
+        definition = CONE_SEARCH[catalogue]
+        x, y, z = unit_vector(ra, decl)
+        params = {
+            'x': x, 'y': y, 'z': z,
+            'cosradius': math.cos(math.radians(radius)),
+            'zonemin': int(math.floor(max(decl - radius, -90.))),
+            'zonemax': int(math.floor(min(decl + radius, 90.))),
+            'dsid': dataset,
+            }
+        alias = definition['alias']
+        condition = ""
+        if dataset is not None:
+            condition = "AND %s = %%(dsid)s" % definition['dataset']
+        query = """\
+SELECT %(columns)s
+      ,3600 * DEGREES(2 * ASIN(SQRT( (%(a)s.x - %%(x)s) * (%(a)s.x - %%(x)s)
+                                   + (%(a)s.y - %%(y)s) * (%(a)s.y - %%(y)s)
+                                   + (%(a)s.z - %%(z)s) * (%(a)s.z - %%(z)s)
+                                   ) / 2)) AS distance
+  FROM %(tables)s
+ WHERE %(a)s.zone BETWEEN %%(zonemin)s AND %%(zonemax)s
+   AND %(a)s.x * %%(x)s + %(a)s.y * %%(y)s + %(a)s.z * %%(z)s >= %%(cosradius)s
+   %(condition)s
+ ORDER BY distance
+""" % {'columns': "\n      ,".join(
+            ["%s AS %s" % (expression, name)
+             for name, expression, type in definition['columns']]),
+       'a': alias, 'tables': definition['tables'], 'condition': condition}
+        return self._rows(query, params, records, dtype=dtype)
+
+    def image_times(self, dataset, version=None):
+        """Return the mid-point times and integration times (in seconds)
+        of the images in a dataset, as structured array with
+        IMAGE_TIMES_DTYPE
+
+        The result is cached in the process, and reused for as long as
+        the image_version() of the dataset is unchanged; pass version
+        (the image_version() or dataset_version()) if it is known
+        already, to save a query.
+        """
+
+        if version is None:
+            version = self.image_version(dataset)
+        # Only the images matter
+        version = tuple(version[:2])
+        key = self.key + (int(dataset),)
+        cached = _image_times.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        image_times = self.array(
+            "SELECT taustart_ts AS time, tau_time AS tau FROM image "
+            "WHERE dataset = %(dataset)s ORDER BY taustart_ts",
+            {'dataset': dataset}, IMAGE_TIMES_DTYPE)
         # Make the dates mid-point
-        image_times = [(taustart_ts + datetime.timedelta(seconds=tau_time/2),
-                        tau_time) for taustart_ts, tau_time in image_times]
+        image_times['time'] += (image_times['tau'] * 5e5).astype('m8[us]')
+        _image_times.set(key, (version, image_times))
         return image_times
 
     def thumbnail(self, srcid):
@@ -502,3 +1367,20 @@ WHERE ex.id = %s
   AND ex.image = im.id
 """, srcid)
         return ra, dec, filename
+
+    def thumbnails(self, srcids):
+        """Get thumbnail information for several sources at once
+
+        Returns a dict of srcid: (ra, dec, image filename)
+        """
+
+        if not srcids:
+            return {}
+        query = """\
+SELECT ex.id, ex.ra, ex.decl, im.url
+FROM extractedsource ex, image im
+WHERE ex.id IN (%s)
+  AND ex.image = im.id
+""" % ", ".join(["%s"] * len(srcids))
+        return dict((row[0], tuple(row[1:]))
+                    for row in self.db.get(query, *srcids))
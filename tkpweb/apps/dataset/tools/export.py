@@ -0,0 +1,329 @@
+"""
+Export complete listings from the database
+
+Unlike the HTML pages, which show one page of a listing at a time, the
+exports contain all rows of a listing. For CSV, the rows are read from
+the database in batches and written to the response as they arrive, so
+that memory use does not depend on the size of the listing. The binary
+formats (numpy .npy/.npz files and FITS binary tables) contain typed
+columns, which are filled directly from the query results.
+"""
+
+import csv
+import json
+import StringIO
+import numpy
+import pyfits
+from django.http import HttpResponse
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5: a plain response streams an iterator as well
+    StreamingHttpResponse = HttpResponse
+
+
+# Number of rows fetched from the database, and written to the response,
+# at a time
+BATCHSIZE = 5000
+
+
+def fixed(precision, prefix=1.):
+    """Format a value in fixed-point notation, after dividing it by
+    prefix (cf. the prefixformat template filter)"""
+    def format(value):
+        return "%.*f" % (precision, value / prefix)
+    return format
+
+
+def isodate(value):
+    return value.isoformat()
+
+
+def text(value):
+    return unicode(value).encode('utf-8')
+
+
+# Columns of the CSV exports for each listing: the key in the listing
+# items, and a format function. These follow the columns of the HTML
+# pages. Like the listings, the exports have one row per item: for an
+# extracted source associated with several sources, runcat is the first
+# of those (see DataBase.extractedsource()).
+CSV_COLUMNS = {
+    'image': [
+        ('id', text),
+        ('centre_ra', fixed(3)),
+        ('centre_decl', fixed(3)),
+        ('taustart_ts', isodate),
+        ('tau_time', text),
+        ('freq_eff', fixed(3, 1e6)),
+        ('freq_bw', fixed(3, 1e6)),
+        ('ntotalsources', text),
+        ('reject', text),
+        ],
+    'transient': [
+        ('id', text),
+        ('wm_ra', fixed(3)),
+        ('wm_decl', fixed(3)),
+        ('t_start', isodate),
+        ('siglevel', fixed(3)),
+        ('band', text),
+        ('freq_eff', fixed(3, 1e6)),
+        ('eta_int', fixed(2)),
+        ('v_int', fixed(4)),
+        ('npoints', text),
+        ('runcat', text),
+        ],
+    'source': [
+        ('runcat', text),
+        ('wm_ra', fixed(3)),
+        ('wm_decl', fixed(3)),
+        ('wm_ra_err', fixed(3)),
+        ('wm_decl_err', fixed(3)),
+        ('datapoints', text),
+        ],
+    'extractedsource': [
+        ('id', text),
+        ('runcat', text),
+        ('ra', fixed(3)),
+        ('decl', fixed(3)),
+        ('ra_err', fixed(3)),
+        ('decl_err', fixed(3)),
+        ('det_sigma', fixed(3)),
+        ('f_peak', fixed(3, 1e-3)),
+        ('f_peak_err', fixed(3, 1e-3)),
+        ('f_int', fixed(3, 1e-3)),
+        ('f_int_err', fixed(3, 1e-3)),
+        ],
+    }
+
+
+def csv_rows(items, columns, batchsize=BATCHSIZE):
+    """Generate CSV text for the listing items, in chunks of batchsize
+    rows
+
+    The header line is generated before the first item is requested, so
+    that it can be sent to the client before the query has finished.
+    Closing the generator closes items.
+    """
+
+    buffer = StringIO.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([key for key, format in columns])
+    yield buffer.getvalue()
+    buffer.truncate(0)
+    try:
+        for i, item in enumerate(items):
+            writer.writerow([
+                "" if item.get(key) is None else format(item[key])
+                for key, format in columns])
+            if (i + 1) % batchsize == 0:
+                yield buffer.getvalue()
+                buffer.truncate(0)
+        yield buffer.getvalue()
+    finally:
+        # Closing the rows closes their cursor (see DataBase.iterate()),
+        # also when the response is closed before all rows were sent
+        if hasattr(items, 'close'):
+            items.close()
+
+
+def export_csv(database, listing, filename, **kwargs):
+    """Stream a complete listing as a CSV file
+
+    Args:
+
+        database (dbase.DataBase): database to obtain the listing from.
+
+        listing (string): name of the listing (the DataBase method).
+
+        filename (string): file name for the client, without extension.
+
+    Further keyword arguments are passed to the DataBase method.
+    """
+
+    items = getattr(database, listing)(batchsize=BATCHSIZE, **kwargs)
+    response = StreamingHttpResponse(
+        csv_rows(items, CSV_COLUMNS[listing]), content_type="text/csv")
+    response['Content-Disposition'] = (
+        'attachment; filename="%s.csv"' % filename)
+    return response
+
+
+# Fields of the binary exports for each listing, and any extra arguments
+# for the listing that are required to obtain these fields. Datetimes
+# are stored with microsecond resolution; NULL integers become -1.
+ARRAYS = {
+    'image': (
+        [('id', 'i8'),
+         ('dataset', 'i8'),
+         ('band', 'i8'),
+         ('centre_ra', 'f8'),
+         ('centre_decl', 'f8'),
+         ('taustart_ts', 'M8[us]'),
+         ('tau_time', 'f8'),
+         ('freq_eff', 'f8'),
+         ('freq_bw', 'f8'),
+         ('ntotalsources', 'i8')],
+        {'extra_info': ['ntotalsources']}),
+    'transient': (
+        [('id', 'i8'),
+         ('runcat', 'i8'),
+         ('trigger_xtrsrc', 'i8'),
+         ('dataset', 'i8'),
+         ('band', 'i8'),
+         ('freq_eff', 'f8'),
+         ('siglevel', 'f8'),
+         ('v_int', 'f8'),
+         ('eta_int', 'f8'),
+         ('t_start', 'M8[us]'),
+         ('wm_ra', 'f8'),
+         ('wm_decl', 'f8'),
+         ('wm_ra_err', 'f8'),
+         ('wm_decl_err', 'f8'),
+         ('datapoints', 'i8'),
+         ('npoints', 'i8')],
+        {}),
+    'source': (
+        [('id', 'i8'),
+         ('xtrsrc', 'i8'),
+         ('dataset', 'i8'),
+         ('datapoints', 'i8'),
+         ('wm_ra', 'f8'),
+         ('wm_decl', 'f8'),
+         ('wm_ra_err', 'f8'),
+         ('wm_decl_err', 'f8')],
+        {}),
+    'extractedsource': (
+        [('id', 'i8'),
+         ('image', 'i8'),
+         ('dataset', 'i8'),
+         ('runcat', 'i8'),
+         ('ra', 'f8'),
+         ('decl', 'f8'),
+         ('ra_err', 'f8'),
+         ('decl_err', 'f8'),
+         ('det_sigma', 'f8'),
+         ('f_peak', 'f8'),
+         ('f_peak_err', 'f8'),
+         ('f_int', 'f8'),
+         ('f_int_err', 'f8'),
+         ('semimajor', 'f8'),
+         ('semiminor', 'f8'),
+         ('pa', 'f8')],
+        {}),
+    }
+
+
+def listing_array(database, listing, **kwargs):
+    """Obtain a complete listing as a numpy structured array"""
+    dtype, extra = ARRAYS[listing]
+    kwargs.update(extra)
+    return getattr(database, listing)(dtype=dtype, **kwargs)
+
+
+def binary_response(data, filename, content_type="application/octet-stream"):
+    response = HttpResponse(data, content_type=content_type)
+    response['Content-Disposition'] = (
+        'attachment; filename="%s"' % filename)
+    return response
+
+
+def export_npy(database, listing, filename, **kwargs):
+    """Export a complete listing as a numpy structured array (.npy)
+
+    Load with numpy.load(); see export_csv() for the arguments.
+    """
+
+    data = listing_array(database, listing, **kwargs)
+    output = StringIO.StringIO()
+    numpy.save(output, data)
+    return binary_response(output.getvalue(), "%s.npy" % filename)
+
+
+def export_npz(database, listing, filename, **kwargs):
+    """Export a complete listing as a compressed archive of columns (.npz)
+
+    Each field of the listing is stored as a separate array, so that
+    individual columns can be loaded without reading the others.
+    """
+
+    data = listing_array(database, listing, **kwargs)
+    output = StringIO.StringIO()
+    numpy.savez_compressed(
+        output, **dict([(name, data[name]) for name in data.dtype.names]))
+    return binary_response(output.getvalue(), "%s.npz" % filename)
+
+
+def export_fits(database, listing, filename, **kwargs):
+    """Export a complete listing as a FITS binary table
+
+    FITS has no datetime type: datetimes are stored as ISO 8601 strings.
+    The table has one row per item of the listing, as for the other
+    formats (see CSV_COLUMNS).
+    """
+
+    data = listing_array(database, listing, **kwargs)
+    fields = []
+    for name in data.dtype.names:
+        if data.dtype[name].kind == 'M':
+            fields.append((name, 'S26'))
+        else:
+            fields.append((name, data.dtype[name]))
+    table = numpy.empty(len(data), dtype=fields)
+    for name in data.dtype.names:
+        if data.dtype[name].kind == 'M':
+            table[name] = numpy.datetime_as_string(data[name])
+        else:
+            table[name] = data[name]
+    output = StringIO.StringIO()
+    pyfits.HDUList(
+        [pyfits.PrimaryHDU(), pyfits.BinTableHDU(table)]).writeto(output)
+    return binary_response(output.getvalue(), "%s.fits" % filename,
+                           content_type="application/fits")
+
+
+# Available export formats
+FORMATS = {
+    'csv': export_csv,
+    'npy': export_npy,
+    'npz': export_npz,
+    'fits': export_fits,
+    }
+
+
+def lightcurves_npz(runcats, offsets, points, filename):
+    """Export lightcurves (see DataBase.lightcurves()) as a compressed
+    archive with the arrays runcat and offsets, and one flat array per
+    field of the points"""
+
+    arrays = dict([(name, points[name]) for name in points.dtype.names])
+    arrays.update({'runcat': runcats, 'offsets': offsets})
+    output = StringIO.StringIO()
+    numpy.savez_compressed(output, **arrays)
+    return binary_response(output.getvalue(), "%s.npz" % filename)
+
+
+def lightcurves_json(runcats, offsets, points, filename):
+    """Export lightcurves as a JSON object with the same (flat) arrays as
+    lightcurves_npz(); datetimes are ISO 8601 strings, NaN becomes null"""
+
+    columns = {'runcat': runcats.tolist(), 'offsets': offsets.tolist()}
+    for name in points.dtype.names:
+        column = points[name]
+        if column.dtype.kind == 'M':
+            column = numpy.datetime_as_string(column)
+        elif column.dtype.kind == 'f':
+            column = numpy.where(numpy.isnan(column), None, column)
+        columns[name] = column.tolist()
+    response = HttpResponse(json.dumps(columns, separators=(',', ':')),
+                            content_type="application/json")
+    response['Content-Disposition'] = (
+        'attachment; filename="%s.json"' % filename)
+    return response
+
+
+# Available export formats for lightcurves
+LIGHTCURVE_FORMATS = {
+    'npz': lightcurves_npz,
+    'json': lightcurves_json,
+    }
@@ -1,4 +1,8 @@
 import os
+import math
+import numpy
+import pyfits
+import pywcs
 from tkp.database import DataBase
 from tkp.utility.accessors import DataAccessor
 from tkp.utility.accessors import FitsImage
@@ -39,3 +43,92 @@ def open_image(url, database=None):
     else:
         raise ValueError("unable to fetch url")
     return image
+
+
+class FitsSections(object):
+    """Read sections of the image in a FITS file
+
+    The file is memory mapped, and only the requested pixels are read
+    from it, so that the time and memory needed do not depend on the
+    size of the image. Instead of a file name, a seekable file-like
+    object can be given, which is then read from directly. Only the
+    first plane of any further axes (such as frequency and Stokes) is
+    used.
+    """
+
+    def __init__(self, filename):
+        self.hdulist = pyfits.open(filename, mode='readonly',
+                                   memmap=isinstance(filename, basestring))
+        hdu = self.hdulist[0]
+        self.header = hdu.header
+        self.section = hdu.section
+        self.plane = (0,) * (self.header['NAXIS'] - 2)
+        self.shape = (self.header['NAXIS1'], self.header['NAXIS2'])
+        self.wcs = pywcs.WCS(self.header, naxis=2)
+
+    def close(self):
+        self.hdulist.close()
+
+    def cutout(self, position, boxsize):
+        """Return the data within boxsize pixels of position (ra, dec)
+
+        As for the tkp image accessors, the data is indexed [x, y].
+        """
+
+        x, y = self.wcs.wcs_sky2pix([position], 0)[0]
+        x, y = int(round(x)), int(round(y))
+        xs = slice(max(x - boxsize, 0), max(min(x + boxsize, self.shape[0]), 0))
+        ys = slice(max(y - boxsize, 0), max(min(y + boxsize, self.shape[1]), 0))
+        return numpy.array(self.section[self.plane + (ys, xs)]).transpose()
+
+    def overview(self, maxsize=1024):
+        """Return the image downsampled to at most maxsize pixels along
+        each axis, as an HDU with a correspondingly adjusted WCS
+
+        The image is downsampled by taking every n-th pixel of every
+        n-th row, so only those rows are read.
+        """
+
+        step = max(int(math.ceil(max(self.shape) / float(maxsize))), 1)
+        data = numpy.array([self.section[self.plane + (y, slice(None))][::step]
+                            for y in range(0, self.shape[1], step)])
+        wcs = self.wcs.deepcopy()
+        # Pixel p (1-based) of the image is pixel (p - 1) / step + 1 of
+        # the overview
+        wcs.wcs.crpix = (wcs.wcs.crpix - 1) / step + 1
+        if wcs.wcs.has_cd():
+            wcs.wcs.cd = wcs.wcs.cd * step
+        else:
+            wcs.wcs.cdelt = wcs.wcs.cdelt * step
+        return pyfits.PrimaryHDU(data, header=wcs.to_header())
+
+
+class AccessorSections(object):
+    """Read sections of an image through the tkp image accessors
+
+    This reads the complete image, and serves as the fallback for image
+    formats other than FITS (i.e., CASA images).
+    """
+
+    def __init__(self, image):
+        self.image = image
+
+    def close(self):
+        pass
+
+    def cutout(self, position, boxsize):
+        x, y = self.image.wcs.s2p(position)
+        x, y = int(round(x)), int(round(y))
+        shape = self.image.data.shape
+        return self.image.data[max(x - boxsize, 0):min(x + boxsize, shape[0]),
+                               max(y - boxsize, 0):min(y + boxsize, shape[1])]
+
+
+def open_sections(filename):
+    """Open an image file for reading sections; see FitsSections"""
+    if os.path.isdir(filename):
+        # Likely a CASA image
+        return AccessorSections(CasaImage(filename))
+    elif os.path.exists(filename):
+        return FitsSections(filename)
+    raise Exception("Image file not available")
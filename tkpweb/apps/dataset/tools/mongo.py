@@ -1,25 +1,97 @@
-from tkpweb.settings import MONGODB
+"""
+Access to images stored in MongoDB (GridFS)
+
+All requests in a process share a single connection (which pools its
+sockets), and fetched images are kept in a size-bounded local cache,
+keyed on the MD5 checksum of the stored file, so that repeatedly used
+images are only downloaded once. The checksum of a file name is kept in
+memory for a short time (md5_timeout seconds), so that a cached image
+is served without contacting MongoDB at all; a file replaced in GridFS
+is picked up once that time has passed. Files larger than the maximum
+file size of the cache are not downloaded at all: they are read in
+place, where reading a section of an image only fetches the GridFS
+chunks containing it.
+"""
+
+import os
+import time
+import tempfile
+import threading
+import pyfits
 from pymongo import Connection
 from gridfs import GridFS
-from contextlib import closing
-from tempfile import mkstemp
-from os import fdopen
-import pyfits
+from tkpweb.settings import MONGODB
+from .cache import DiskCache
+from .cache import MemoryCache
+
+
+# Configuration of the local cache of fetched images
+MONGODB_CACHE = {
+    "directory": os.path.join(tempfile.gettempdir(), "tkpweb-images"),
+    "max_size": 2 * 1024 * 1024 * 1024,
+    "max_file_size": 256 * 1024 * 1024,
+    "md5_timeout": 60,
+    }
+MONGODB_CACHE.update(MONGODB.get("cache", {}))
+
+_lock = threading.Lock()
+_gridfs = None
+_cache = None
+
+# (expiry time, MD5 checksum) of recently fetched files, by file name
+_md5s = MemoryCache(max_items=10000)
+
+
+def gridfs():
+    """Return the (process-wide) GridFS of the image database"""
+    global _gridfs
+    with _lock:
+        if _gridfs is None:
+            connection = Connection(
+                host=MONGODB["host"], port=MONGODB["port"],
+                max_pool_size=MONGODB.get("max_pool_size", 10))
+            _gridfs = GridFS(connection[MONGODB["database"]])
+    return _gridfs
+
+
+def image_cache():
+    """Return the (process-wide) local cache of fetched images"""
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = DiskCache(MONGODB_CACHE["directory"],
+                               MONGODB_CACHE["max_size"])
+    return _cache
 
-def fetch_hdu_from_mongo(filename):
-    if MONGODB["enabled"]:
-        with closing(
-            Connection(host=MONGODB["host"], port=MONGODB["port"])
-        ) as mongo_connection:
-            gfs = GridFS(mongo_connection[MONGODB["database"]])
-            return pyfits.open(gfs.get_version(filename), mode="readonly")
 
 def fetch_file_from_mongo(filename):
+    """Return a local copy of an image file, or, for files too large for
+    the cache, a seekable file-like object reading it from GridFS
+
+    Local copies must not be removed by the caller.
+    """
+
+    cache = image_cache()
+    known = _md5s.get(filename)
+    if known is not None and known[0] > time.time():
+        path = cache.filename(known[1])
+        if path is not None:
+            return path
+    gridout = gridfs().get_version(filename)
+    if gridout.length > MONGODB_CACHE["max_file_size"]:
+        return gridout
+    _md5s.set(filename, (time.time() + MONGODB_CACHE["md5_timeout"],
+                         gridout.md5))
+    path = cache.filename(gridout.md5)
+    if path is None:
+        path = cache.set_file(gridout.md5, gridout)
+        if path is None:
+            # Unable to store the file; read it from GridFS instead
+            gridout.seek(0)
+            return gridout
+    return path
+
+
+def fetch_hdu_from_mongo(filename):
     if MONGODB["enabled"]:
-        handle, tempfilename = mkstemp()
-        with fdopen(handle, "w") as output, closing(
-            Connection(host=MONGODB["host"], port=MONGODB["port"])
-        ) as mongo_connection:
-            gfs = GridFS(mongo_connection[MONGODB["database"]])
-            output.write(gfs.get_version(filename).read())
-        return tempfilename
+        return pyfits.open(fetch_file_from_mongo(filename), mode="readonly")
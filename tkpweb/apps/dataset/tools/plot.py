@@ -2,29 +2,49 @@ import os
 import StringIO
 import base64
 import datetime
-import time
 import numpy
 import aplpy
-import pyfits
 import math
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.patches import Rectangle
-from matplotlib.collections import PatchCollection
-from tkp.utility import accessors
+from .dbase import lightcurve_array
+from .dbase import IMAGE_TIMES_DTYPE
+from .image import FitsSections
+from .image import open_sections
+from .cache import plot_cache
+from .cache import make_key
 
 
 from tkpweb.settings import MONGODB
 if MONGODB["enabled"]:
-    from .mongo import fetch_hdu_from_mongo
     from .mongo import fetch_file_from_mongo
 
 
 class Plot(object):
+    """Base class for plots
 
-    def __init__(self, response=None, size=(5, 5)):
+    A plot is rendered either into the given response, or, without a
+    response, into a base64-encoded data URI.
+
+    If a cache_key is given, the rendered image is stored in the plot
+    cache (see cache.plot_cache()), and subsequent renders with the same
+    key, class, size and format reuse the stored image without plotting.
+    The key should therefore identify the plotted data, including a
+    version stamp for data that can still change (see
+    DataBase.dataset_version()).
+
+    The plot() method can return False to indicate there was nothing to
+    plot, in which case render() returns None. If plotting failed in a
+    way that may not be permanent (e.g., an image file was temporarily
+    unavailable), plot() should also set `cacheable` to False.
+    """
+
+    def __init__(self, response=None, size=(5, 5), cache_key=None):
         self.size = size
         self.response = response
+        self.cache_key = cache_key
+        self.cacheable = True
         self.image = None
 
     def pre(self):
@@ -39,24 +59,62 @@ class Plot(object):
         self.figure = Figure(figsize=self.size)
         self.canvas = FigureCanvasAgg(self.figure)
 
-    def output(self, format='png'):
-        if self.response:
-             self.canvas.print_figure(self.response, format=format)
-             self.image = self.response
+    def print_figure(self, format='png'):
+        """Return the figure as an image (a string of bytes)"""
         memfig = StringIO.StringIO()
-        self.canvas.print_figure(memfig, format=format, transparent=True)
-        encoded_png = StringIO.StringIO()
-        encoded_png.write('data:image/%s;base64,\n' % format)
-        encoded_png.write(base64.b64encode(memfig.getvalue()))
-        self.image = encoded_png.getvalue()
+        # Inline images are transparent, so they blend into the page
+        self.canvas.print_figure(memfig, format=format,
+                                 transparent=self.response is None)
+        return memfig.getvalue()
+
+    def output(self, data, format='png'):
+        if not data:
+            # Nothing was plotted
+            self.image = None
+        elif self.response:
+            self.response.write(data)
+            self.image = self.response
+        else:
+            encoded_png = StringIO.StringIO()
+            encoded_png.write('data:image/%s;base64,\n' % format)
+            encoded_png.write(base64.b64encode(data))
+            self.image = encoded_png.getvalue()
+
+    def cached(self, format='png'):
+        """Output the image from the plot cache, if it is there
+
+        Returns True if the image was cached, in which case `image` is
+        set as by render(), and the data for the plot need not be
+        obtained at all.
+        """
+        cache = plot_cache() if self.cache_key is not None else None
+        if not cache:
+            return False
+        data = cache.get(self.key(format))
+        if data is None:
+            return False
+        self.output(data, format=format)
+        return True
+
+    def key(self, format='png'):
+        return make_key(self.__class__.__name__, self.size, format,
+                        self.response is None, self.cache_key)
 
     def render(self, *args, **kwargs):
         format = kwargs.pop('format', 'png')
+        if self.cached(format=format):
+            return self.image
         self.pre()
         self.setup()
-        self.plot(*args, **kwargs)
-        self.output(format=format)
+        if self.plot(*args, **kwargs) is False:
+            data = ''
+        else:
+            data = self.print_figure(format=format)
+        self.output(data, format=format)
         self.post()
+        cache = plot_cache() if self.cache_key is not None else None
+        if cache and self.cacheable:
+            cache.set(self.key(format), data)
         return self.image
 
     def plot(self, *args, **kwargs):
@@ -66,18 +124,27 @@ class Plot(object):
 
 class ImagePlot(Plot):
 
+    # Maximum number of pixels along either axis of the plotted image;
+    # larger images are downsampled (see image.FitsSections.overview())
+    maxsize = 1024
+
     def plot(self, dbimage, scale=0.9, plotsources=None, database=None):
         try:
             if MONGODB["enabled"]:
-                hdu = fetch_hdu_from_mongo(dbimage['url'])
+                sections = FitsSections(fetch_file_from_mongo(dbimage['url']))
             elif os.path.exists(dbimage['url']):
-                hdu = pyfits.open(dbimage['url'], readonly=True)
+                sections = FitsSections(dbimage['url'])
             else:
                 raise Exception("FITS file not available")
+            try:
+                hdu = sections.overview(maxsize=self.maxsize)
+            finally:
+                sections.close()
         except Exception, e:
             # Unable to access file
             print e
-            return
+            self.cacheable = False
+            return False
 
         image = aplpy.FITSFigure(hdu, figure=self.figure, auto_refresh=False)
 
@@ -96,36 +163,22 @@ class ImagePlot(Plot):
 class ThumbnailPlot(Plot):
 
     def plot(self, filename, position, boxsize=(40, 40)):
-        # Guess the file format from the extension
         try:
             if MONGODB["enabled"]:
-                fits = fetch_file_from_mongo(filename)
-                image = accessors.FitsImage(fits)
-            elif os.path.isdir(filename):
-                # Likely a CASA image
-                image = accessors.CasaImage(filename)
-            elif os.path.exists(filename):
-                image = accessors.FitsImage(filename)
+                image = FitsSections(fetch_file_from_mongo(filename))
             else:
-                raise Exception("Image file not available")
+                # Guess the file format from the file name
+                image = open_sections(filename)
         except Exception, e:
             # Unable to access file
             print e
-            return
-
-        # Convert the input coordinates to the pixel coordinates
-        x, y = image.wcs.s2p(position)
-        box = (
-            (
-                x-boxsize[0] if x-boxsize[0] > 0 else 0,
-                x+boxsize[0] if x+boxsize[0] < image.data.shape[0] else image.data.shape[0] - 1
-            ),
-            (
-                y-boxsize[0] if y-boxsize[0] > 0 else 0,
-                y+boxsize[0] if y+boxsize[0] < image.data.shape[0] else image.data.shape[0] - 1
-            )
-        )
-        thumbnail = image.data[box[0][0]:box[0][1],box[1][0]:box[1][1]]
+            self.cacheable = False
+            return False
+
+        try:
+            thumbnail = image.cutout(position, boxsize[0])
+        finally:
+            image.close()
         axes = self.figure.add_subplot(1, 1, 1)
         axes.get_xaxis().set_visible(False)
         axes.get_yaxis().set_visible(False)
@@ -133,68 +186,96 @@ class ThumbnailPlot(Plot):
             axes.imshow(thumbnail)
             self.figure.subplots_adjust(bottom=0, left=0, top=1, right=1)
 
-        # If we created a temporary file, better clean it up
-        if "fits" in locals():
-            os.unlink(fits)
+
+def merge_intervals(start, end):
+    """Merge overlapping intervals [start, end); returns the start and
+    end of the merged intervals, sorted"""
+
+    order = numpy.argsort(start)
+    start, end = start[order], end[order]
+    reach = numpy.maximum.accumulate(end)
+    # An interval starts a new merged interval if it starts after all
+    # previous intervals have ended
+    first = numpy.flatnonzero(numpy.r_[True, start[1:] > reach[:-1]])
+    return start[first], numpy.maximum.reduceat(end, first)
 
 
 class LightcurvePlot(Plot):
 
     def plot(self, lc, T0=None, images=None, trigger_index=None):
-        times = numpy.array([time.mktime(point[0].timetuple()) for point in lc])
-        tau_times = [point[1]/2. for point in lc]
-        fluxes = [point[2] for point in lc]
-        errors = [point[3] for point in lc]
-        bands = [point[5] for point in lc]
-        stokes = [point[6] for point in lc]
-        bandnames = ["%.1f MHz" % (point[7] / 1e6,) for point in lc]
-
-        # colors to use for band labeling.
-        colors = 'bgrcmykw'
-
-        # This makes a mapping from band ID to (color, name)
-        unique_bands = list(set(zip(bands, bandnames)))
-        mapping_list = []
-        for index, (band,name) in enumerate(unique_bands):
-            color = colors[index % len(colors)]
-            mapping_list.append((band, (color, name)))
-        mapping = dict(mapping_list)
-
-        ecolor = [mapping[x][0] for x in bands]
+        """Plot a lightcurve
+
+        Args:
+
+            lc: list of lightcurve points (as returned by
+                DataBase.lightcurve()) or structured array (see
+                dbase.lightcurve_array()).
+
+        Kwargs:
+
+            T0 (datetime or None): zero point of the time axis; defaults
+                to the start of the day of the first point or image.
+
+            images (list, array or None): (mid-point time, integration
+                time) of the images in the dataset, as returned by
+                DataBase.image_times(); their coverage is shaded.
+
+            trigger_index (int or None): index of the point to mark.
+        """
+
+        lc = lightcurve_array(lc)
+        if not len(lc):
+            return False
+        if images is not None and len(images):
+            images = numpy.asarray(images, dtype=IMAGE_TIMES_DTYPE)
+        else:
+            images = None
 
         if T0 is None:
-            tmin = sorted(times)[0]
-            if images:
-                tmin2 = time.mktime(sorted(zip(*images)[0])[0].timetuple())
-                if tmin2  < tmin:
-                    tmin = tmin2
-            tmin = datetime.datetime.fromtimestamp(tmin)
-            T0 = datetime.datetime(tmin.year, tmin.month, tmin.day, 0, 0, 0)
-        tdiff = T0 - datetime.datetime(1970, 1, 1)
-        tdiff = (tdiff.microseconds + (tdiff.seconds + tdiff.days * 86400) * 1e6) / 1e6
-        times -= tdiff
+            tmin = lc['time'].min()
+            if images is not None:
+                tmin = min(tmin, images['time'].min())
+            T0 = tmin.astype('M8[D]').astype(datetime.datetime)
+            T0 = datetime.datetime(T0.year, T0.month, T0.day)
+        t0 = numpy.datetime64(T0, 'us')
+
+        def seconds(times):
+            return (times - t0).astype('m8[us]').astype(float) / 1e6
+
+        times = seconds(lc['time'])
+        fluxes = lc['flux']
+
+        # colors to use for band labeling, in order of frequency
+        colors = numpy.array(list('bgrcmykw'))
+        bands, first, index = numpy.unique(
+            lc['band'], return_index=True, return_inverse=True)
+        names = ["%.1f MHz" % (freq / 1e6,) for freq in lc['freq'][first]]
+        order = numpy.argsort(lc['freq'][first])
+        band_colors = colors[numpy.argsort(order) % len(colors)]
+        ecolor = band_colors[index]
+
         axes = self.figure.add_subplot(1, 1, 1)
-        axes.errorbar(x=times, y=fluxes, yerr=errors, xerr=numpy.array(tau_times)/2., fmt='bo')
+        axes.errorbar(x=times, y=fluxes, yerr=lc['flux_err'],
+                      xerr=lc['tau'] / 4., fmt='bo')
         axes.scatter(x=times, y=fluxes, color=ecolor, zorder=100)
 
         # construct legend
-        sorted_mapping = sorted(mapping.values(), key=lambda x: x[1])
-        band_colors, band_names = zip(*sorted_mapping)
-        legend_elements = [Rectangle((0, 0), 1, 1, fc=c) for c in band_colors]
-        axes.legend(legend_elements, band_names, loc='best')
+        legend_elements = [Rectangle((0, 0), 1, 1, fc=band_colors[i])
+                           for i in order]
+        axes.legend(legend_elements, [names[i] for i in order], loc='best')
 
         if trigger_index is not None:
             axes.errorbar(x=times[trigger_index], y=fluxes[trigger_index], fmt='o', mec='r', ms=15., mfc='None')
         ylimits = axes.get_ylim()
-        if images:
-            images = zip(*images)
-            x = numpy.array([time.mktime(x.timetuple()) for x in images[0]]) - tdiff
-            xerr = numpy.array(images[1])/2.
-            patches = [Rectangle((xx - xxerr, ylimits[0]), xxerr, ylimits[1]-ylimits[0])
-                    for xx, xxerr in zip(x, xerr)]
-            patches = PatchCollection(patches, alpha=0.3, linewidth=0, visible=True, color='r')
-            axes.add_collection(patches)
+        if images is not None:
+            # Coverage of the images, merged into as few intervals as
+            # possible and drawn as a single collection
+            middle = seconds(images['time'])
+            start, end = merge_intervals(middle - images['tau'] / 2.,
+                                         middle + images['tau'] / 2.)
+            axes.broken_barh(zip(start, end - start),
+                             (ylimits[0], ylimits[1] - ylimits[0]),
+                             facecolors='r', alpha=0.3, linewidth=0)
+            axes.set_ylim(ylimits)
         axes.set_xlabel('Seconds since %s' % T0.strftime('%Y-%m-%dT%H:%M:%S'))
         axes.set_ylabel('Flux (Jy)')
-
-
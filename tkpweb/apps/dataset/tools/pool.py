@@ -0,0 +1,159 @@
+"""
+Pool of database connections
+
+Connecting to the database takes longer than most queries for a page,
+and every connection takes a connection slot on the database server.
+Instead of connecting for every request, views acquire a connection from
+a process-wide pool, and release it when the response is complete.
+
+Connections are pooled per database and user, as given by the login
+details in the session (see the database app), so that switching
+databases keeps working.
+"""
+
+import time
+import threading
+import tkp.database as tkpdb
+from tkp.config import config
+from tkpweb import settings
+
+
+DATABASE_POOL = getattr(settings, 'DATABASE_POOL', {
+    # Maximum number of connections (in use and idle) per database
+    "max_size": 10,
+    # Idle connections are closed after this many seconds
+    "max_idle": 300,
+    # Connections idle for longer than this many seconds are checked
+    # before they are handed out again
+    "check_after": 30,
+    # Maximum number of seconds to wait for a connection when all are in
+    # use
+    "timeout": 30,
+    })
+
+
+def close(db):
+    try:
+        db.connection.close()
+    except Exception:
+        # Already closed or broken
+        pass
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of tkp database connections"""
+
+    def __init__(self, max_size=10, max_idle=300, check_after=30, timeout=30):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        # Idle connections per key, as (time of release, connection),
+        # most recently released last
+        self.idle = {}
+        # Number of open connections (in use and idle) per key
+        self.size = {}
+
+    @staticmethod
+    def key(dblogin):
+        dblogin = dblogin or config['database']
+        return (dblogin['host'], dblogin['port'], dblogin['name'],
+                dblogin['user'])
+
+    def acquire(self, dblogin=None):
+        """Return a connection (tkp.database.DataBase) for the given
+        login details, or the default database if None
+
+        Raises RuntimeError if no connection becomes available within
+        the timeout.
+        """
+
+        key = self.key(dblogin)
+        deadline = time.time() + self.timeout
+        while True:
+            with self.condition:
+                self.evict()
+                while (not self.idle.get(key) and
+                       self.size.get(key, 0) >= self.max_size):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RuntimeError(
+                            "no database connection available for %s:%s/%s" %
+                            key[:3])
+                    self.condition.wait(remaining)
+                    self.evict()
+                if self.idle.get(key):
+                    released, db = self.idle[key].pop()
+                else:
+                    released, db = None, None
+                    self.size[key] = self.size.get(key, 0) + 1
+            if db is None:
+                try:
+                    return tkpdb.DataBase(**dblogin) if dblogin else tkpdb.DataBase()
+                except:
+                    self.discard(key, None)
+                    raise
+            if time.time() - released < self.check_after or self.healthy(db):
+                return db
+            self.discard(key, db)
+
+    def release(self, db, dblogin=None):
+        """Return a connection obtained with acquire() to the pool"""
+
+        key = self.key(dblogin)
+        try:
+            # End any open transaction
+            db.connection.rollback()
+        except Exception:
+            self.discard(key, db)
+            return
+        with self.condition:
+            self.idle.setdefault(key, []).append((time.time(), db))
+            self.condition.notify()
+
+    def discard(self, key, db):
+        """Close a connection that is no longer usable"""
+
+        if db is not None:
+            close(db)
+        with self.condition:
+            self.size[key] -= 1
+            self.condition.notify()
+
+    def healthy(self, db):
+        try:
+            cursor = db.connection.cursor()
+            try:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            finally:
+                cursor.close()
+        except Exception:
+            return False
+        return True
+
+    def evict(self):
+        """Close the connections that have been idle for too long; the
+        caller must hold the lock"""
+
+        oldest = time.time() - self.max_idle
+        for key, idle in self.idle.items():
+            while idle and idle[0][0] < oldest:
+                released, db = idle.pop(0)
+                close(db)
+                self.size[key] -= 1
+                self.condition.notify()
+
+
+_pool = None
+_lock = threading.Lock()
+
+
+def connection_pool():
+    """Return the (process-wide) connection pool"""
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ConnectionPool(**DATABASE_POOL)
+    return _pool
@@ -3,12 +3,11 @@ Quality control checks
 Based on tkp/database/qcplots.py
 """
 
-import StringIO
-import base64
 import numpy
 from textwrap import dedent
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import LogNorm
+from matplotlib import dates
+from matplotlib.collections import LineCollection
 from .plot import Plot
 
 """NB All functions in this module overlap with those in
@@ -18,135 +17,244 @@ TO DO: Refactor the relevant functions so the code is only in one place.
 """
 
 
+class RmsDistancePlot(Plot):
+    """Plot the rms of extracted sources in given dataset vs their
+    distance from the field centre.
+
+    Up to `threshold` sources are plotted individually. For more sources,
+    the database bins them into a 2D histogram of `bins` (distance, rms)
+    bins, which is shown as a density image; only the bin counts are
+    transferred, so the cost of the plot depends on the number of bins,
+    not on the number of sources.
+    """
+
+    threshold = 10000
+    bins = (100, 100)
+
+    # Distance from the field centre and rms of the sources
+    query = """\
+    SELECT 3600* DEGREES(2 * ASIN(SQRT( (ex.x - rc.x) * (ex.x - rc.x)
+                                      + (ex.y - rc.y) * (ex.y - rc.y)
+                                      + (ex.z - rc.z) * (ex.z - rc.z)
+                                      ) / 2)) AS centr_img_dist_deg
+          ,COALESCE (
+              CASE WHEN det_sigma < 1e-6 THEN 0.0 END,
+              CASE WHEN det_sigma >= 1e-6 THEN 20000 * ex.f_peak / ex.det_sigma END
+           ) as rms_mJy
+      FROM extractedsource ex
+          ,image im
+          ,runningcatalog rc
+     WHERE ex.image = im.id
+       AND im.dataset = rc.dataset
+       AND rc.dataset = %(dsid)s
+       AND rc.xtrsrc = ex.id
+    """
+
+    def plot(self, database, dsid, dist_arcsec_cutoff=36000, threshold=None):
+        if threshold is None:
+            threshold = self.threshold
+        params = {'dsid': dsid, 'cutoff': dist_arcsec_cutoff}
+        sources = dedent("""\
+        SELECT *
+          FROM (%s) t
+         WHERE centr_img_dist_deg < %%(cutoff)s
+        """) % dedent(self.query)
+        database.db.cursor.execute(
+            "SELECT COUNT(*), MAX(centr_img_dist_deg), MIN(rms_mJy), MAX(rms_mJy)"
+            " FROM (%s) s" % sources, params)
+        count, dist_max, rms_min, rms_max = database.db.cursor.fetchone()
+        if not count:
+            return False
+
+        axes = self.figure.add_subplot(1, 1, 1)
+        if count <= threshold:
+            database.db.cursor.execute(sources, params)
+            dist_deg, rms = zip(*database.db.cursor.fetchall())
+            axes.scatter(dist_deg, rms, c='r', s=20, edgecolor='r')
+            axes.set_ylim(ymin=0)
+            axes.grid(True)
+        else:
+            self.plot_density(axes, database, sources, params,
+                              (0., dist_max), (min(rms_min, 0.), rms_max))
+        axes.set_xlabel(r'Distance from Pointing Centre (deg)', size='x-large')
+        axes.set_ylabel(r'rms (mJy/beam)', size='x-large')
+        axes.set_xlim(xmin=0)
+
+    def plot_density(self, axes, database, sources, params, xrange, yrange):
+        """Plot the sources as a 2D histogram, binned by the database"""
+
+        nx, ny = self.bins
+        # Widen the bins slightly, so that the maxima fall in the last bin
+        dx = (xrange[1] - xrange[0]) / nx * 1.000001 or 1.
+        dy = (yrange[1] - yrange[0]) / ny * 1.000001 or 1.
+        params = dict(params, x0=xrange[0], y0=yrange[0], dx=dx, dy=dy)
+        database.db.cursor.execute(dedent("""\
+        SELECT i, j, COUNT(*)
+          FROM (SELECT FLOOR((centr_img_dist_deg - %%(x0)s) / %%(dx)s) AS i
+                      ,FLOOR((rms_mJy - %%(y0)s) / %%(dy)s) AS j
+                  FROM (%s) s
+                 WHERE rms_mJy IS NOT NULL
+               ) b
+         GROUP BY i, j
+        """) % sources, params)
+        rows = database.db.cursor.fetchall()
+        i, j, n = [numpy.array(column, dtype=float) for column in zip(*rows)]
+        i = numpy.clip(i, 0, nx - 1).astype(int)
+        j = numpy.clip(j, 0, ny - 1).astype(int)
+        counts = numpy.bincount(j * nx + i, weights=n, minlength=nx * ny)
+        counts = counts.reshape(ny, nx)
+        image = axes.imshow(
+            numpy.ma.masked_equal(counts, 0), origin='lower', aspect='auto',
+            interpolation='nearest', norm=LogNorm(),
+            extent=(xrange[0], xrange[0] + nx * dx,
+                    yrange[0], yrange[0] + ny * dy))
+        colorbar = self.figure.colorbar(image, ax=axes)
+        colorbar.set_label('Number of sources')
+
+
 def plot_rms_distance_from_fieldcentre(
     database, dsid, dist_arcsec_cutoff=36000, response=None,
-    size=(8, 8)):
+    size=(8, 8), cache_key=None):
     """Plot the rms of extracted sources in given dataset vs their
-    distance from the field centre."""
+    distance from the field centre.
 
-    query = """\
-    SELECT *
-    FROM (SELECT ex.image
-                ,ex.id as xtrsrcid1
-                ,3600* DEGREES(2 * ASIN(SQRT( (ex.x - rc.x) * (ex.x - rc.x)
-                                            + (ex.y - rc.y) * (ex.y - rc.y)
-                                            + (ex.z - rc.z) * (ex.z - rc.z)
-                                            ) / 2)) AS centr_img_dist_deg
-                ,COALESCE (
-                    CASE WHEN det_sigma < 1e-6 THEN 0.0 END,
-                    CASE WHEN det_sigma >= 1e-6 THEN 20000 * ex.f_peak / ex.det_sigma END
-                 ) as rms_mJy
-            FROM extractedsource ex
-                ,image im
-                ,runningcatalog rc
-           WHERE ex.image = im.id
-             AND im.dataset = rc.dataset
-             AND rc.dataset = %s
-             AND rc.xtrsrc = ex.id
-          ) t
-    WHERE centr_img_dist_deg < %s
-    ORDER BY centr_img_dist_deg
+    Returns the response, a data URI, or None if there are no sources;
+    see RmsDistancePlot.
     """
-    query = dedent(query)
-    database.db.cursor.execute(query, (dsid, dist_arcsec_cutoff))
-    results = zip(*database.db.get(query, dsid, dist_arcsec_cutoff))
-
-    if not results:
-        return None
-    dist_deg, rms = results[2], results[3]
-
-    figure = Figure(figsize=size)
-    canvas = FigureCanvasAgg(figure)
-    axes = figure.add_subplot(1, 1, 1)
-    axes.scatter(dist_deg, rms, c='r', s=20, edgecolor='r')
-    axes.set_xlabel(r'Distance from Pointing Centre (deg)', size='x-large')
-    axes.set_ylabel(r'rms (mJy/beam)', size='x-large')
-    axes.set_xlim(xmin=0)
-    axes.set_ylim(ymin=0)
-    axes.grid(True)
-
-    if response:
-        canvas.print_figure(response, format='png')
-        return response
-    memfig = StringIO.StringIO()
-    canvas.print_figure(memfig, format='png')
-    encoded_png = StringIO.StringIO()
-    encoded_png.write('data:image/png;base64,\n')
-    encoded_png.write(base64.b64encode(memfig.getvalue()))
-    return encoded_png.getvalue()
+
+    return RmsDistancePlot(response=response, size=size,
+                           cache_key=cache_key).render(
+        database, dsid, dist_arcsec_cutoff=dist_arcsec_cutoff)
+
+
+def stairs(edges, values):
+    """Return the vertices (x, y) of a step curve, with values[i]
+    between edges[i] and edges[i + 1]"""
+    return numpy.repeat(edges, 2)[1:-1], numpy.repeat(values, 2)
+
+
+def minmax(x, y, ncolumns):
+    """Downsample y(x), with x sorted, to the minimum and maximum of y in
+    each of ncolumns columns of equal width in x
+
+    Returns the centres of the (non-empty) columns, and the minima and
+    maxima in them.
+    """
+
+    edges = numpy.linspace(x[0], x[-1], ncolumns + 1)
+    column = numpy.clip(numpy.searchsorted(edges, x, side='right') - 1,
+                        0, ncolumns - 1)
+    # Since x is sorted, each column is a contiguous run
+    starts = numpy.flatnonzero(numpy.r_[True, column[1:] != column[:-1]])
+    centres = (edges[column[starts]] + edges[column[starts] + 1]) / 2.
+    return (centres, numpy.minimum.reduceat(y, starts),
+            numpy.maximum.reduceat(y, starts))
 
 
 class HistSourcesPerImagePlot(Plot):
+    """Number of extracted sources per image
+
+    Modes:
+
+        - 'time': against the start time of the images;
 
-    def plot(self, database, dsid):
-        def autolabel(axes, rects, taustart):
-            # Call this to label each rectangle in the historgram with its
-            # height and the image start time.
-            # Does not scale to large numbers of images: the plot becomes
-            # unreadable.
-            i = 0
-            for rect in rects:
-                height = rect.get_height()
-                print height
-                axes.text(rect.get_x() + rect.get_width() / 2., 1.05 * height, int(height),
-                         rotation='horizontal', ha='center', va='bottom')
-                axes.text(rect.get_x() + rect.get_width() / 2., 0.05 * height, taustart[i].isoformat(),
-                         rotation='vertical', ha='center', va='bottom')
-                i += 1
+        - 'image': against the image number, in order of start time;
 
+        - 'distribution': histogram of the number of sources per image.
+
+    When there are more images than pixels along the x-axis, the images
+    are downsampled to the range (minimum to maximum) of the number of
+    sources in each pixel column, so that the cost of the plot does not
+    depend on the number of images.
+    """
+
+    def plot(self, database, dsid, mode='time'):
         query = """\
-SELECT id
-      ,taustart_ts
-      ,nsources
-FROM image
-    ,(SELECT x1.image
-            ,COUNT(*) as nsources
-      FROM extractedsource x1
-          ,image im1
-      WHERE x1.image = im1.id
-        AND dataset = %s
-      GROUP BY x1.image
-     ) t1
-WHERE t1.image = id
+SELECT im.taustart_ts
+      ,COALESCE(t1.nsources, 0)
+  FROM image im
+       LEFT OUTER JOIN (SELECT x1.image
+                              ,COUNT(*) as nsources
+                          FROM extractedsource x1
+                              ,image im1
+                         WHERE x1.image = im1.id
+                           AND im1.dataset = %(dsid)s
+                         GROUP BY x1.image
+                       ) t1
+       ON t1.image = im.id
+ WHERE im.dataset = %(dsid)s
+ ORDER BY im.taustart_ts, im.id
 """
-        results = zip(*database.db.get(query, dsid))
+        database.db.cursor.execute(query, {'dsid': dsid})
+        results = database.db.cursor.fetchall()
         if not results:
-            return None
-        imageid = results[0]
-        taustart_ts = results[1]
-        nsources = results[2]
+            return False
+        taustart_ts, nsources = zip(*results)
+        nsources = numpy.array(nsources, dtype=float)
 
         axes = self.figure.add_subplot(1, 1, 1)
-        width = 0.8
-        ind = numpy.arange(len(imageid))
-        rects = axes.bar(ind, nsources, width, color='r')
-        axes.set_xlabel(r'Image')
-        axes.set_ylabel(r'Number of Sources')
+        if mode == 'distribution':
+            nbins = int(min(nsources.max() - nsources.min() + 1, 100))
+            counts, edges = numpy.histogram(nsources, bins=nbins)
+            x, y = stairs(edges, counts)
+            axes.fill_between(x, 0, y, color='r', alpha=0.5, linewidth=0)
+            axes.plot(x, y, color='r')
+            axes.set_xlabel(r'Number of Sources')
+            axes.set_ylabel(r'Number of Images')
+        else:
+            if mode == 'time':
+                x = dates.date2num(taustart_ts)
+                axes.set_xlabel(r'Image start time (UTC)')
+                axes.xaxis_date()
+                self.figure.autofmt_xdate()
+            else:
+                x = numpy.arange(len(nsources), dtype=float)
+                axes.set_xlabel(r'Image')
+            width = int(self.figure.get_figwidth() * self.figure.dpi)
+            if len(x) > width:
+                x, low, high = minmax(x, nsources, width)
+                axes.fill_between(x, low, high, color='r', alpha=0.5,
+                                  linewidth=0)
+                axes.plot(x, high, color='r')
+            else:
+                x, y = stairs(numpy.r_[x, x[-1]], nsources)
+                axes.fill_between(x, 0, y, color='r', alpha=0.5, linewidth=0)
+                axes.plot(x, y, color='r')
+            axes.set_ylabel(r'Number of Sources')
+        axes.set_ylim(ymin=0)
         axes.grid(True)
 
 
 class ScatterPosAllCounterpartsPlot(Plot):
+    """Plot positions of all counterparts for all (unique) sources for
+    the given dataset.
+
+    The positions of all (unique) sources in the running catalog are at
+    the centre, whereas the positions of all their associated sources
+    are scattered around the central point. Axes are in arcsec relative
+    to the running catalog position.
 
-    def plot(self, database, dsid):
-        """Plot positions of all counterparts for all (unique) sources for
-        the given dataset.
+    Up to `threshold` associations are plotted individually, with error
+    bars; more are shown as a hexagonally binned density. If there are
+    more than `sample` associations, the database returns only a regular
+    sample of them (every n-th extracted source id), so that the cost of
+    the plot is bounded for any dataset. Both can be given to plot().
+    """
 
-        The positions of all (unique) sources in the running catalog are
-        at the centre, whereas the positions of all their associated
-        sources are scattered around the central point.  Axes are in
-        arcsec relative to the running catalog position.
-        """
+    threshold = 5000
+    sample = 500000
+    gridsize = 60
 
+    def plot(self, database, dsid, threshold=None, sample=None):
+        if threshold is None:
+            threshold = self.threshold
+        if sample is None:
+            sample = self.sample
         query = """\
-SELECT x.id
-      ,x.ra
-      ,x.decl
-      ,3600 * (x.ra - r.wm_ra) as ra_dist_arcsec
+SELECT 3600 * (x.ra - r.wm_ra) as ra_dist_arcsec
       ,3600 * (x.decl - r.wm_decl) as decl_dist_arcsec
-      ,x.ra_err/2
-      ,x.decl_err/2
-      ,r.wm_ra_err/2
-      ,r.wm_decl_err/2
+      ,x.ra_err/2 as ra_err
+      ,x.decl_err/2 as decl_err
   FROM assocxtrsource a
       ,extractedsource x
       ,runningcatalog r
@@ -154,32 +262,43 @@ SELECT x.id
  WHERE a.runcat = r.id
    AND a.xtrsrc = x.id
    AND x.image = im1.id
-   AND im1.dataset = %s
-
+   AND im1.dataset = %(dsid)s
 """
-        results = zip(*database.db.get(query, dsid))
-
-        if not results:
-            return None
-        xtrsrc_id = results[0]
-        ra = results[1]
-        decl = results[2]
-        ra_dist_arcsec = results[3]
-        decl_dist_arcsec = results[4]
-        ra_err = results[5]
-        decl_err = results[6]
-        wm_ra_err = results[7]
-        wm_decl_err = results[8]
+        params = {'dsid': dsid}
+        database.db.cursor.execute(
+            "SELECT COUNT(*) FROM (%s) t" % query, params)
+        count = database.db.cursor.fetchone()[0]
+        if not count:
+            return False
+        if count > sample:
+            query += "   AND MOD(x.id, %(step)s) = 0\n"
+            params['step'] = int(numpy.ceil(count / float(sample)))
+        data = database.array(query, params, dtype=[
+            ('ra_dist_arcsec', 'f8'), ('decl_dist_arcsec', 'f8'),
+            ('ra_err', 'f8'), ('decl_err', 'f8')])
+        x, y = data['ra_dist_arcsec'], data['decl_dist_arcsec']
+        if not len(data) or numpy.isnan(x).all():
+            return False
+        lim = 1 + int(numpy.trunc(numpy.nanmax(numpy.abs(numpy.r_[x, y]))))
 
         axes = self.figure.add_subplot(1, 1, 1)
-        axes.errorbar(ra_dist_arcsec, decl_dist_arcsec, xerr=ra_err, yerr=decl_err,
-                      fmt='+', color='b', label="xtr")
+        if count <= threshold:
+            # All error bars as a single collection
+            xerr, yerr = data['ra_err'], data['decl_err']
+            segments = numpy.concatenate([
+                numpy.dstack([[x - xerr, x + xerr], [y, y]]).transpose(1, 0, 2),
+                numpy.dstack([[x, x], [y - yerr, y + yerr]]).transpose(1, 0, 2)])
+            axes.add_collection(LineCollection(segments, colors='b'))
+            axes.plot(x, y, '+', color='b', label="xtr")
+        else:
+            valid = ~(numpy.isnan(x) | numpy.isnan(y))
+            image = axes.hexbin(x[valid], y[valid], gridsize=self.gridsize,
+                                bins='log', mincnt=1,
+                                extent=(-lim, lim, -lim, lim))
+            colorbar = self.figure.colorbar(image, ax=axes)
+            colorbar.set_label('log10(number of sources)')
         axes.set_xlabel(r'RA (arcsec)')
         axes.set_ylabel(r'DEC (arcsec)')
-        lim = 1 + max(int(numpy.trunc(max(abs(min(ra_dist_arcsec)),
-                                          abs(max(ra_dist_arcsec))))),
-                      int(numpy.trunc(max(abs(min(decl_dist_arcsec)),
-                                          abs(max(decl_dist_arcsec))))))
         axes.set_xlim(xmin= -lim, xmax=lim)
         axes.set_ylim(ymin= -lim, ymax=lim)
         axes.grid(False)
@@ -0,0 +1,185 @@
+"""
+In-process spatial index of the sources in a dataset
+
+DataBase.cone_search() answers a single query in the database. For
+repeated queries on the same dataset (e.g., following up several alerts,
+or matching a list of positions), the positions of all its sources are
+obtained once and put in a KD-tree on their unit vectors, which is kept
+in memory for as long as the dataset is unchanged (see
+DataBase.dataset_version()). A cone on the sphere is then a ball around
+the unit vector of its centre, with the chord of the radius as its
+radius.
+"""
+
+import numpy
+from scipy.spatial import cKDTree
+from .cache import MemoryCache
+from .dbase import CONE_SEARCH
+
+
+def unit_vectors(ra, decl):
+    """Unit vectors (an array of shape (n, 3)) of positions in degrees"""
+    ra, decl = numpy.radians(ra), numpy.radians(decl)
+    return numpy.column_stack((numpy.cos(decl) * numpy.cos(ra),
+                               numpy.cos(decl) * numpy.sin(ra),
+                               numpy.sin(decl)))
+
+
+def chord(radius):
+    """Length of the chord of an angle in degrees on the unit sphere"""
+    return 2 * numpy.sin(numpy.radians(radius) / 2)
+
+
+def angle(chord):
+    """Angle in arcseconds corresponding to a chord on the unit sphere"""
+    return 3600 * numpy.degrees(2 * numpy.arcsin(numpy.minimum(chord / 2, 1)))
+
+
+class SourceIndex(object):
+    """KD-tree of a set of sources
+
+    Args:
+
+        sources (numpy.ndarray): structured array of the sources, with
+            their unit vectors in the fields x, y and z.
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.tree = None
+        if len(sources):
+            self.tree = cKDTree(numpy.column_stack(
+                (sources['x'], sources['y'], sources['z'])))
+
+    def __len__(self):
+        return len(self.sources)
+
+    def cone_search(self, ra, decl, radius):
+        """Return the sources within radius (in degrees) around a position
+        (as for DataBase.cone_search()), and their distances (in
+        arcseconds); both ordered by distance"""
+
+        if self.tree is None:
+            return self.sources, numpy.zeros(0)
+        centre = unit_vectors(ra, decl)[0]
+        indices = numpy.array(
+            self.tree.query_ball_point(centre, chord(radius)), dtype=int)
+        vectors = self.tree.data[indices]
+        distances = angle(numpy.sqrt(((vectors - centre) ** 2).sum(axis=1)))
+        order = numpy.argsort(distances)
+        return self.sources[indices[order]], distances[order]
+
+    def nearest(self, ra, decl, radius):
+        """Find the nearest source within radius (in degrees; a single
+        value, or one per position) for each of several positions
+        (arrays of ra and decl in degrees)
+
+        Returns:
+
+            (indices, distances): the index into sources of the nearest
+                source and its distance in arcseconds for each position;
+                the index is -1 (and the distance infinite) where there
+                is no source within the radius.
+        """
+
+        chords = chord(numpy.zeros(len(ra)) + radius)
+        if self.tree is None or not len(ra):
+            return (numpy.zeros(len(ra), dtype=int) - 1,
+                    numpy.zeros(len(ra)) + numpy.inf)
+        # Search up to the largest radius, and drop the sources beyond
+        # the radius of their position afterwards
+        separations, indices = self.tree.query(
+            unit_vectors(ra, decl), distance_upper_bound=chords.max())
+        found = numpy.isfinite(separations) & (separations <= chords)
+        indices = numpy.where(found, indices, -1)
+        distances = numpy.where(
+            found, angle(numpy.where(found, separations, 0)), numpy.inf)
+        return indices, distances
+
+    def within(self, ra, decl, radius):
+        """Find all sources within radius (in degrees; a single value, or
+        one per position) of each of several positions (arrays of ra and
+        decl in degrees)
+
+        Returns:
+
+            (positions, indices, distances): for every match, the index
+                of the position, the index into sources of the source,
+                and their distance in arcseconds; ordered by position and
+                distance.
+        """
+
+        chords = chord(numpy.zeros(len(ra)) + radius)
+        if self.tree is None or not len(ra):
+            return (numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int),
+                    numpy.zeros(0))
+        vectors = unit_vectors(ra, decl)
+        neighbours = self.tree.query_ball_point(vectors, chords.max())
+        counts = numpy.array([len(found) for found in neighbours], dtype=int)
+        indices = numpy.zeros(counts.sum(), dtype=int)
+        if len(indices):
+            indices = numpy.concatenate(
+                [numpy.array(found, dtype=int) for found in neighbours])
+        positions = numpy.repeat(numpy.arange(len(ra)), counts)
+        separations = numpy.sqrt(
+            ((self.tree.data[indices] - vectors[positions]) ** 2).sum(axis=1))
+        keep = separations <= chords[positions]
+        positions, indices, separations = (
+            positions[keep], indices[keep], separations[keep])
+        order = numpy.lexsort((separations, positions))
+        return positions[order], indices[order], angle(separations[order])
+
+
+def position_index(ra, decl):
+    """Return a SourceIndex of positions (arrays of ra and decl in
+    degrees) that are not in the database"""
+    vectors = unit_vectors(ra, decl)
+    sources = numpy.empty(len(vectors), dtype=[
+        ('ra', 'f8'), ('decl', 'f8'), ('x', 'f8'), ('y', 'f8'), ('z', 'f8')])
+    sources['ra'], sources['decl'] = ra, decl
+    sources['x'], sources['y'], sources['z'] = vectors.T
+    return SourceIndex(sources)
+
+
+# Indexes per (database, catalogue, dataset), with the dataset_version()
+# they were built for
+_indexes = MemoryCache(max_items=10)
+
+
+def source_index(database, dataset, catalogue='runningcatalog', version=None):
+    """Return the (cached) SourceIndex of the sources in a dataset
+
+    Args:
+
+        database (dbase.DataBase): database of the dataset.
+
+        dataset (int): dataset id.
+
+    Kwargs:
+
+        catalogue (string): 'runningcatalog' or 'extractedsource'; see
+            dbase.CONE_SEARCH.
+
+        version (tuple or None): the dataset_version() of the dataset,
+            if known already.
+    """
+
+    if version is None:
+        version = database.dataset_version(dataset)
+    key = database.key + (catalogue, int(dataset))
+    cached = _indexes.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    definition = CONE_SEARCH[catalogue]
+    alias = definition['alias']
+    columns = definition['columns'] + [
+        (name, "%s.%s" % (alias, name), 'f8') for name in ('x', 'y', 'z')]
+    query = "SELECT %s\n  FROM %s\n WHERE %s = %%(dsid)s" % (
+        "\n      ,".join(["%s AS %s" % (expression, name)
+                          for name, expression, type in columns]),
+        definition['tables'], definition['dataset'])
+    sources = database.array(query, {'dsid': dataset},
+                             [(name, type) for name, expression, type in columns])
+    index = SourceIndex(sources)
+    _indexes.set(key, (version, index))
+    return index
@@ -0,0 +1,203 @@
+"""
+Precomputed dataset summaries
+
+The counts for a dataset (images, sources, transients) and its quality
+control aggregates are stored in DatasetSummary, and refreshed
+incrementally: only the images added since the last refresh (those with
+an id above the image watermark), their extracted sources, and the
+extracted sources added to earlier images (those with an id above the
+source watermark) are scanned. The unique sources and transients are
+counted anew on every refresh, since their tables are far smaller than
+extractedsource.
+
+If images have been removed from a dataset since the last refresh, the
+summary is rebuilt from scratch.
+"""
+
+import datetime
+from django.db import IntegrityError
+from ..models import DatasetSummary
+
+
+# Summary values for a dataset without images
+EMPTY = {
+    'last_image': None,
+    'last_source': None,
+    'nimages': 0,
+    'ntotalsources': 0,
+    'min_sources_per_image': None,
+    'max_sources_per_image': None,
+    'rms_count': 0,
+    'rms_sum': 0.,
+    'rms_min': None,
+    'rms_max': None,
+    }
+
+
+def _min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def refresh(database, dataset, summary=None, rebuild=False, latest=None):
+    """Bring the summary of a dataset up to date, and return it
+
+    Args:
+
+        database (dbase.DataBase): database of the dataset.
+
+        dataset (int): dataset id.
+
+    Kwargs:
+
+        summary (DatasetSummary or None): the current summary of the
+            dataset, if already obtained.
+
+        rebuild (bool): recompute the summary from scratch.
+
+        latest (tuple or None): the DataBase.latest_ids(), if already
+            obtained.
+    """
+
+    host, port, name = database.key
+    if summary is None:
+        try:
+            summary = DatasetSummary.objects.get(
+                host=host, port=port, database=name, dataset=dataset)
+        except DatasetSummary.DoesNotExist:
+            summary = DatasetSummary(
+                host=host, port=port, database=name, dataset=dataset)
+    if latest is None:
+        latest = database.latest_ids()
+    watermark, source_watermark = summary.last_image, summary.last_source
+    if watermark is not None and (
+        rebuild or source_watermark is None or
+        database.image_count(dataset, watermark) != summary.nimages):
+        # Start over
+        for key, value in EMPTY.iteritems():
+            setattr(summary, key, value)
+
+    # Only count the extracted sources up to the latest id, so that
+    # sources inserted while refreshing are counted by the next refresh,
+    # and only once
+    upto = latest[0]
+    increment = database.dataset_increment(
+        dataset, upto, after=summary.last_image, after_source=summary.last_source)
+    if increment['nimages']:
+        summary.last_image = increment['last_image']
+        summary.nimages += increment['nimages']
+    for key in ('ntotalsources', 'rms_count', 'rms_sum'):
+        setattr(summary, key, getattr(summary, key) + increment[key])
+    for key, combine in (('rms_min', _min), ('rms_max', _max)):
+        setattr(summary, key, combine(getattr(summary, key), increment[key]))
+    if increment['late']:
+        # Sources were added to images that were already counted
+        (summary.min_sources_per_image,
+         summary.max_sources_per_image) = database.sources_per_image(
+            dataset, summary.last_image, upto)
+    elif increment['nimages']:
+        for key, combine in (('min_sources_per_image', _min),
+                             ('max_sources_per_image', _max)):
+            setattr(summary, key, combine(getattr(summary, key), increment[key]))
+    summary.last_source, summary.last_runcat, summary.last_transient = latest
+    counts = database.dataset(id=dataset, extra_info=['nsources', 'ntransients'])
+    if counts:
+        summary.nsources = counts[0]['nsources']
+        summary.ntransients = counts[0]['ntransients']
+
+    # Refreshes of the same summary can run concurrently: only store the
+    # result if the summary was not changed in the meantime, and return
+    # the stored summary otherwise (which is then at least as recent).
+    if summary.pk is None:
+        try:
+            summary.save()
+        except IntegrityError:
+            return DatasetSummary.objects.get(
+                host=host, port=port, database=name, dataset=dataset)
+    else:
+        fields = dict([(field.attname, getattr(summary, field.attname))
+                       for field in DatasetSummary._meta.fields
+                       if field.name != 'id'])
+        fields['updated'] = datetime.datetime.now()
+        if not DatasetSummary.objects.filter(
+            pk=summary.pk, last_image=watermark,
+            last_source=source_watermark).update(**fields):
+            return DatasetSummary.objects.get(pk=summary.pk)
+    return summary
+
+
+def summarised(summary):
+    """Whether a summary has been built, with all of its watermarks"""
+    return summary is not None and None not in (
+        summary.last_source, summary.last_runcat, summary.last_transient)
+
+
+def summaries(database, datasets):
+    """Return up-to-date summaries for several datasets
+
+    Only the summaries of the datasets whose images have changed, or
+    that extracted sources, sources or transients have been added to,
+    since their last refresh are refreshed, incrementally. Datasets that
+    have not been summarised yet are left out: building a summary scans
+    all of the dataset, which is left to the refresh_dataset_summary
+    command (or the rebuild button of a dataset) rather than done while
+    serving a page.
+
+    Args:
+
+        database (dbase.DataBase): database of the datasets.
+
+        datasets (list of ints): dataset ids.
+
+    Returns:
+
+        dict of dataset id: DatasetSummary, for the datasets that have
+        been summarised
+    """
+
+    host, port, name = database.key
+    current = dict([(summary.dataset, summary) for summary in
+                    DatasetSummary.objects.filter(
+                        host=host, port=port, database=name,
+                        dataset__in=datasets)
+                    if summarised(summary)])
+    if not current:
+        return {}
+    versions = database.dataset_versions()
+    latest = database.latest_ids()
+    result = {}
+    unchecked = []
+    for dataset, summary in current.iteritems():
+        version = versions.get(dataset, (0, None))
+        if (summary.nimages, summary.last_image) != version:
+            summary = refresh(database, dataset, summary=summary, latest=latest)
+        elif (summary.last_source, summary.last_runcat,
+              summary.last_transient) != latest:
+            unchecked.append(summary)
+        result[dataset] = summary
+
+    if unchecked:
+        # Rows were added since these summaries were refreshed, but not
+        # necessarily to their datasets: find the datasets they were
+        # added to with a single query, from the oldest watermarks on
+        changed = database.changed_datasets(
+            min([summary.last_source for summary in unchecked]),
+            min([summary.last_runcat for summary in unchecked]),
+            min([summary.last_transient for summary in unchecked]))
+        unchanged = []
+        for summary in unchecked:
+            if summary.dataset in changed:
+                result[summary.dataset] = refresh(
+                    database, summary.dataset, summary=summary, latest=latest)
+            else:
+                summary.last_source, summary.last_runcat, \
+                    summary.last_transient = latest
+                unchanged.append(summary.pk)
+        if unchanged:
+            DatasetSummary.objects.filter(pk__in=unchanged).update(
+                last_source=latest[0], last_runcat=latest[1],
+                last_transient=latest[2])
+    return result
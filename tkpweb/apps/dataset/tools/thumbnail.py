@@ -0,0 +1,138 @@
+"""
+Thumbnails of extracted sources
+
+Rendering every thumbnail as a separate matplotlib figure, and opening
+its image for every thumbnail, is slow for sources with many
+datapoints. Instead, the cutouts for all sources are taken with each
+image opened only once, reading only the pixels of the cutouts from FITS
+files (see image.FitsSections), coloured directly with the colour map, and
+combined into a single image (a sprite sheet), which is encoded as PNG
+without matplotlib.
+"""
+
+import struct
+import zlib
+import numpy
+from matplotlib import cm
+from matplotlib.colors import Normalize
+from .image import FitsSections
+from .image import open_sections
+from .plot import Plot
+
+from tkpweb.settings import MONGODB
+if MONGODB["enabled"]:
+    from .mongo import fetch_file_from_mongo
+
+
+# Number of image pixels on either side of the source
+BOXSIZE = 40
+# Number of thumbnails in a row of the sprite sheet
+COLUMNS = 20
+
+
+def png(rgba):
+    """Encode an array of shape (height, width, 4) and type uint8 as an
+    RGBA PNG image"""
+
+    height, width = rgba.shape[:2]
+    # Every scanline starts with its filter type; 0 is no filtering
+    scanlines = numpy.zeros((height, 4 * width + 1), dtype=numpy.uint8)
+    scanlines[:, 1:] = rgba.reshape(height, 4 * width)
+
+    def chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data +
+                struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+    return ("\x89PNG\r\n\x1a\n" +
+            chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)) +
+            chunk("IDAT", zlib.compress(scanlines.tostring(), 6)) +
+            chunk("IEND", ""))
+
+
+def open_image(filename):
+    """Open an image for reading cutouts"""
+
+    if MONGODB["enabled"]:
+        return FitsSections(fetch_file_from_mongo(filename))
+    return open_sections(filename)
+
+
+def cutouts(sources, boxsize=BOXSIZE):
+    """Cut out the thumbnails for several sources, opening each image
+    only once
+
+    Args:
+
+        sources (list): (ra, dec, filename) for each source.
+
+    Returns:
+
+        list of arrays, in the order of sources; None for the sources
+        whose image could not be opened.
+    """
+
+    thumbnails = [None] * len(sources)
+    files = {}
+    for i, (ra, dec, filename) in enumerate(sources):
+        files.setdefault(filename, []).append(i)
+    for filename, indices in files.iteritems():
+        try:
+            image = open_image(filename)
+        except Exception, e:
+            # Unable to access file
+            print e
+            continue
+        try:
+            for i in indices:
+                thumbnails[i] = image.cutout(sources[i][:2], boxsize)
+        finally:
+            image.close()
+    return thumbnails
+
+
+def colour(data):
+    """Map data onto the default colour map, scaled between its minimum
+    and maximum (as imshow() does); returns RGBA bytes"""
+
+    data = numpy.ma.masked_invalid(data)
+    return cm.get_cmap()(Normalize()(data), bytes=True)
+
+
+def sprite(thumbnails, size=2 * BOXSIZE, columns=COLUMNS):
+    """Combine thumbnails into a sprite sheet, columns thumbnails wide
+
+    Thumbnail i is at row i // columns and column i % columns, in a cell
+    of size by size pixels; cells of missing or empty thumbnails are
+    transparent. The sheet is always columns cells wide, even with fewer
+    thumbnails, since the pages position the cells assuming that width.
+    """
+
+    rows = (len(thumbnails) + columns - 1) // columns
+    sheet = numpy.zeros((rows * size, columns * size, 4), dtype=numpy.uint8)
+    for i, data in enumerate(thumbnails):
+        if data is None or not data.any():
+            continue
+        row, column = divmod(i, columns)
+        rgba = colour(data[:size, :size])
+        sheet[row * size:row * size + rgba.shape[0],
+              column * size:column * size + rgba.shape[1]] = rgba
+    return sheet
+
+
+class ThumbnailSprite(Plot):
+    """Sprite sheet with the thumbnails of several sources (see sprite())"""
+
+    def setup(self):
+        # No matplotlib figure needed
+        pass
+
+    def plot(self, sources):
+        if not sources:
+            return False
+        thumbnails = cutouts(sources)
+        if any(thumbnail is None for thumbnail in thumbnails):
+            self.cacheable = False
+        self.sheet = sprite(thumbnails)
+
+    def print_figure(self, format='png'):
+        return png(self.sheet)
@@ -1,36 +1,55 @@
 from django.conf.urls.defaults import patterns, include, url
 from .views import DatasetsView
 from .views import DatasetView
+from .views import DatasetPlotView
+from .views import DatasetRefreshView
 from .views import ImagesView
 from .views import ImageView
 from .views import ImagePlotView
 from .views import ExtractedSourcesView
 from .views import ExtractedSourceView
 from .views import SourceLightcurveView
+from .views import LightcurvesView
 from .views import SourcesView
 from .views import SourceView
 from .views import TransientLightcurveView
+from .views import TransientThumbnailsView
 from .views import TransientsView
 from .views import TransientView
 from .views import MonitoringListView
+from .views import MonitoringListImportView
 from .views import TransientLightsurfaceView
+from .views import ApiView
+from .views import ConeSearchView
+from .views import CrossMatchView
 
 
 urlpatterns = patterns(
    'tkpweb.apps.dataset.views',
+   url(r'^(?P<dataset>\d+)/monitoringlist/import/$', view=MonitoringListImportView.as_view(), name='monitoringlist-import'),
    url(r'^(?P<dataset>\d+)/monitoringlist/$', view=MonitoringListView.as_view(), name='monitoringlist'),
-   url(r'^(?P<dataset>\d+)/image/(?P<id>\d+)/image$', view=ImagePlotView.as_view(), name='image-single'),
+   url(r'^(?P<dataset>\d+)/plot/(?P<plot>rms|sourcesperimage|sourcesdistribution|counterparts)/$', view=DatasetPlotView.as_view(), name='dataset-plot'),
+   url(r'^(?P<dataset>\d+)/image/(?P<id>\d+)/image$', view=ImagePlotView.as_view(), kwargs={'plot': 'large'}, name='image-single'),
+   url(r'^(?P<dataset>\d+)/image/(?P<id>\d+)/(?P<plot>quickview|sources)/$', view=ImagePlotView.as_view(), name='image-plot'),
    url(r'^(?P<dataset>\d+)/image/(?P<id>\d+)/$', view=ImageView.as_view(), name='image'),
    url(r'^(?P<dataset>\d+)/image/$', view=ImagesView.as_view(), name='images'),
    url(r'^(?P<dataset>\d+)/transient/(?P<id>\d+)/lightcurve/$', view=TransientLightcurveView.as_view(), name='transient-lightcurve'),
+   url(r'^(?P<dataset>\d+)/transient/(?P<id>\d+)/thumbnails/$', view=TransientThumbnailsView.as_view(), name='transient-thumbnails'),
    url(r'^(?P<dataset>\d+)/transient/(?P<id>\d+)/lightsurface/$', view=TransientLightsurfaceView.as_view(), name='transient-lightsurface'),
    url(r'^(?P<dataset>\d+)/transient/(?P<id>\d+)/$', view=TransientView.as_view(), name='transient'),
    url(r'^(?P<dataset>\d+)/transient/$', view=TransientsView.as_view(), name='transients'),
+   url(r'^(?P<dataset>\d+)/lightcurves/$', view=LightcurvesView.as_view(), name='lightcurves'),
    url(r'^(?P<dataset>\d+)/source/(?P<runcat>\d+)/lightcurve/$', view=SourceLightcurveView.as_view(), name='source-lightcurve'),
    url(r'^(?P<dataset>\d+)/source/(?P<runcat>\d+)/$', view=SourceView.as_view(), name='source'),
    url(r'^(?P<dataset>\d+)/source/$', view=SourcesView.as_view(), name='sources'),
    url(r'^(?P<dataset>\d+)/extractedsource/(?P<id>\d+)/$', view=ExtractedSourceView.as_view(), name='extractedsource'),
    url(r'^(?P<dataset>\d+)/extractedsource/$', view=ExtractedSourcesView.as_view(), name='extractedsources'),
+   url(r'^api/(?P<resource>datasets)/(?:(?P<id>\d+)/)?$', view=ApiView.as_view(), name='api-datasets'),
+   url(r'^(?P<dataset>\d+)/api/(?P<resource>images|transients|sources|extractedsources|monitoringlist|lightcurves)/(?:(?P<id>\d+)/)?$', view=ApiView.as_view(), name='api'),
+   url(r'^conesearch/$', view=ConeSearchView.as_view(), name='conesearch'),
+   url(r'^(?P<dataset>\d+)/conesearch/$', view=ConeSearchView.as_view(), name='dataset-conesearch'),
+   url(r'^(?P<dataset>\d+)/crossmatch/$', view=CrossMatchView.as_view(), name='crossmatch'),
+   url(r'^(?P<id>\d+)/refresh/$', view=DatasetRefreshView.as_view(), name='dataset-refresh'),
    url(r'^(?P<id>\d+)/$', view=DatasetView.as_view(), name='dataset'),
    url(r'^$', view=DatasetsView.as_view(), name='datasets'),
    )
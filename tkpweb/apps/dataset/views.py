@@ -1,34 +1,228 @@
+import json
+import numpy
 from django.views.generic import TemplateView
 from django.views.generic.edit import FormMixin
 from django.core.urlresolvers import reverse
 from django.http import Http404
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
 from django.http import HttpResponseForbidden
+from django.http import HttpResponseNotModified
 from django.http import HttpResponseRedirect
+from django.utils.http import urlencode
+from django.utils.cache import patch_cache_control
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from .tools import api
 from .tools import dbase
 from .tools import plot
 from .tools import quality
+from .tools import export
+from .tools import thumbnail
+from .tools import summary
+from .tools import spatial
+from .tools import catalogue
+from .tools.pool import connection_pool
 from .forms import MonitoringListForm
+from .forms import CrossMatchForm
+from .forms import MonitoringListImportForm
 
 class BaseView(TemplateView):
+    # Number of rows per page for paginated listings
+    paginate_by = 100
 
     def get_context_data(self, **kwargs):
         context = super(BaseView, self).get_context_data(**kwargs)
         self.database = self.get_database(self.request.session.get('dblogin', None))
         return context
 
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            response = super(BaseView, self).dispatch(request, *args, **kwargs)
+        except:
+            self.release_database()
+            raise
+        if getattr(response, 'streaming',
+                   getattr(response, '_base_content_is_iter', False)):
+            # The content is still to be read from the database; release
+            # the connection once the response has been sent, after
+            # closing the content iterator, so that its cursor is closed
+            # while the connection is still ours
+            content = getattr(response, '_iterator',
+                              getattr(response, '_container', None))
+
+            def close(close=response.close):
+                try:
+                    try:
+                        if hasattr(content, 'close'):
+                            content.close()
+                    finally:
+                        close()
+                finally:
+                    self.release_database()
+            response.close = close
+        else:
+            if hasattr(response, 'render'):
+                try:
+                    response.render()
+                except:
+                    self.release_database()
+                    raise
+            self.release_database()
+        return response
+
     def get_database(self, dblogin=None):
+        """Return the database for this request, with a connection from
+        the pool; the connection is released by dispatch()"""
         try:
             return self.database
         except AttributeError:
-            return dbase.DataBase(dblogin=dblogin)
+            self.database = dbase.DataBase(
+                dblogin=dblogin, db=connection_pool().acquire(dblogin))
+            return self.database
 
-    def set_template(self, name):
+    def release_database(self):
+        database = self.__dict__.pop('database', None)
+        if database is not None:
+            connection_pool().release(database.db, database.dblogin)
+
+    def plot_key(self, *parts):
+        """Cache key for a plot of the data identified by parts (in the
+        current database)"""
+        return (self.database.key,) + parts
+
+    def set_template(self, name, formats=('html', 'csv')):
         format = self.request.GET.get('format', 'html')
-        if not format in ['html', 'csv']:
+        if not format in formats:
             raise Http404
+        self.format = format
         self.template_name = "dataset/%s.%s" % (name, format)
 
+    def paginate(self, context, listing, **kwargs):
+        """Obtain a single page of a listing from the database
+
+        The page is selected by the 'order' GET parameter (a column
+        name, prefixed with '-' for descending order) and either the
+        'after' or 'before' keyset cursors (when ordering on id) or the
+        'page' number (when ordering on any other column). Only HTML
+        output is paginated; other formats obtain the full, ordered,
+        listing.
+
+        Args:
+
+            context (dict): template context; the 'ordering' and
+                'pagination' entries are set for the templates.
+
+            listing (string): name of the DataBase method that produces
+                the listing, and key into dbase.ORDERING.
+
+        Further keyword arguments are passed to the DataBase method.
+        """
+
+        columns = dbase.ORDERING[listing]
+        order = self.request.GET.get('order', 'id')
+        name = order.lstrip('-')
+        if name not in columns:
+            raise Http404
+        keyset = columns[name] == columns['id']
+        context['ordering'] = (name, 'DESC' if order.startswith('-') else 'ASC')
+        page = {'order': order}
+        paginated = getattr(self, 'format', 'html') == 'html'
+        if paginated:
+            # Obtain one extra row to find out if there is a next page
+            page['limit'] = self.paginate_by + 1
+            try:
+                if keyset:
+                    for cursor in ('after', 'before'):
+                        if cursor in self.request.GET:
+                            page[cursor] = int(self.request.GET[cursor])
+                else:
+                    number = int(self.request.GET.get('page', 1))
+                    if number < 1:
+                        raise ValueError
+                    page['offset'] = (number - 1) * self.paginate_by
+            except ValueError:
+                raise Http404
+        kwargs.update(page)
+        try:
+            rows = getattr(self.database, listing)(**kwargs)
+        except ValueError:
+            raise Http404
+        if not paginated:
+            return rows
+
+        more = len(rows) > self.paginate_by
+        previous = next = None
+        if keyset:
+            if 'before' in page:
+                # Paging backwards: the extra row is at the start
+                if more:
+                    rows = rows[1:]
+                has_previous, has_next = more, True
+            else:
+                if more:
+                    rows = rows[:-1]
+                has_previous, has_next = 'after' in page, more
+            if rows and has_previous:
+                previous = {'order': order, 'before': rows[0]['id']}
+            if rows and has_next:
+                next = {'order': order, 'after': rows[-1]['id']}
+        else:
+            if more:
+                rows = rows[:-1]
+            if number > 1:
+                previous = {'order': order, 'page': number - 1}
+            if more:
+                next = {'order': order, 'page': number + 1}
+        context['pagination'] = {
+            'first': urlencode({'order': order}),
+            'previous': urlencode(previous) if previous else None,
+            'next': urlencode(next) if next else None,
+            }
+        return rows
+
+
+class ListingView(BaseView):
+    """A paginated listing of one of the tables of a dataset
+
+    Besides as an HTML page, the listing can be exported as a whole in
+    any of the export.FORMATS.
+    """
+
+    # Name of the DataBase method that produces the listing
+    listing = None
+    # Name of the template; also used as file name for exports
+    name = None
+
+    def get_listing_kwargs(self, **kwargs):
+        """Arguments for the DataBase method, from the URL arguments"""
+        return {'dataset': kwargs['dataset']}
+
+    def get(self, request, *args, **kwargs):
+        format = request.GET.get('format', 'html')
+        if format not in export.FORMATS:
+            return super(ListingView, self).get(request, *args, **kwargs)
+        self.database = self.get_database(request.session.get('dblogin', None))
+        order = request.GET.get('order', 'id')
+        if order.lstrip('-') not in dbase.ORDERING[self.listing]:
+            raise Http404
+        return export.FORMATS[format](
+            self.database, self.listing,
+            "%s_%s" % (self.name, kwargs['dataset']), order=order,
+            **self.get_listing_kwargs(**kwargs))
+
+    def get_context_data(self, **kwargs):
+        context = super(ListingView, self).get_context_data(**kwargs)
+        self.set_template(self.name, formats=('html',))
+        try:
+            context['dataset'] = self.database.dataset(id=kwargs['dataset'])[0]
+        except IndexError:
+            raise Http404
+        context[self.name] = self.paginate(
+            context, self.listing, **self.get_listing_kwargs(**kwargs))
+        return context
+
 
 class DatasetsView(BaseView):
     def get_context_data(self, **kwargs):
@@ -36,9 +230,15 @@ class DatasetsView(BaseView):
         extra information"""
         context = super(DatasetsView, self).get_context_data(**kwargs)
         self.set_template('datasets')
-        context['datasets'] = self.database.dataset(
-            extra_info=["ntransients", "nimages"]
-        )
+        datasets = self.database.dataset()
+        summaries = summary.summaries(
+            self.database, [dataset['id'] for dataset in datasets])
+        for dataset in datasets:
+            # Datasets without a summary are shown as not yet summarised
+            dataset['summarised'] = dataset['id'] in summaries
+            if dataset['summarised']:
+                dataset.update(summaries[dataset['id']].counts())
+        context['datasets'] = datasets
         return context
 
 
@@ -49,30 +249,42 @@ class DatasetView(BaseView):
         context = super(DatasetView, self).get_context_data(**kwargs)
         self.set_template('dataset')
         dsid = int(kwargs['id'])
-        dataset = self.database.dataset(id=dsid, extra_info=[
-            "ntransients", "nimages", "nsources", "ntotalsources"])
+        dataset = self.database.dataset(id=dsid)
         if not dataset:
             raise Http404
         else:
             dataset = dataset[0]
+        context['summary'] = summary.summaries(self.database, [dsid]).get(dsid)
+        if context['summary'] is not None:
+            dataset.update(context['summary'].counts())
         context['dataset'] = dataset
-        context['rmsplot'] = quality.plot_rms_distance_from_fieldcentre(
-            self.database, dsid)
-        context['histimageplot'] = quality.HistSourcesPerImagePlot().render(
-            self.database, dsid)
-        context['scattallplot'] = quality.ScatterPosAllCounterpartsPlot().render(
-            self.database, dsid)
 
         return context
 
 
-class ImagesView(BaseView):
-    def get_context_data(self, **kwargs):
-        context = super(ImagesView, self).get_context_data(**kwargs)
-        self.set_template('images')
-        context['images'] = self.database.image(dataset=kwargs['dataset'], extra_info=['ntotalsources', 'reject'])
-        context['dataset'] = self.database.dataset(id=kwargs['dataset'])[0]
-        return context
+class DatasetRefreshView(BaseView):
+    """Rebuild the summary of a dataset"""
+
+    http_method_names = ['post']
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.has_perm('dataset.change_datasetsummary'):
+            return HttpResponseForbidden()
+        self.database = self.get_database(request.session.get('dblogin', None))
+        dsid = int(kwargs['id'])
+        if not self.database.dataset(id=dsid):
+            raise Http404
+        summary.refresh(self.database, dsid, rebuild=True)
+        return HttpResponseRedirect(reverse('dataset:dataset', kwargs={'id': dsid}))
+
+
+class ImagesView(ListingView):
+    listing = 'image'
+    name = 'images'
+
+    def get_listing_kwargs(self, **kwargs):
+        return {'dataset': kwargs['dataset'],
+                'extra_info': ['ntotalsources', 'reject']}
 
 
 class ImageView(BaseView):
@@ -84,12 +296,8 @@ class ImageView(BaseView):
             raise Http404
         else:
             image = image[0]
-        image['png'] = plot.ImagePlot().render(image, database=self.database)
         dataset = self.database.dataset(id=kwargs['dataset'])[0]
         extractedsources = self.database.extractedsource(image=image['id'])
-
-
-        image['extractedsources'] = plot.ImagePlot().render(image, plotsources=extractedsources)
         context['image'] = image
         context['extractedsources'] = extractedsources
         context['dataset'] = dataset
@@ -97,17 +305,9 @@ class ImageView(BaseView):
 
 
 
-class TransientsView(BaseView):
-    def get_context_data(self, **kwargs):
-        context = super(TransientsView, self).get_context_data(**kwargs)
-        self.set_template('transients')
-        dataset = kwargs['dataset']
-        try:
-            context['dataset'] = self.database.dataset(id=dataset)[0]
-        except IndexError:
-            raise Http404
-        context['transients'] = self.database.transient(dataset=dataset)
-        return context
+class TransientsView(ListingView):
+    listing = 'transient'
+    name = 'transients'
 
 
 class TransientView(BaseView):
@@ -121,32 +321,17 @@ class TransientView(BaseView):
             raise Http404
         else:
             transient = transient[0]
-        images = self.database.image_times(dataset=dataset)
         lightcurve = self.database.lightcurve(int(transient['trigger_xtrsrc']))
-        trigger_index = [i for i, lc in enumerate(lightcurve)
-                         if lc[4] == transient['trigger_xtrsrc']][0]
-        context['lightcurve'] = {
-            'plot': plot.LightcurvePlot().render(
-                lightcurve, images=images, trigger_index=trigger_index),
-            'data': lightcurve
-            }
+        context['lightcurve'] = {'data': lightcurve,
+                                 'columns': thumbnail.COLUMNS}
         context['dataset'] = self.database.dataset(id=dataset)[0]
         context['transient'] = transient
-        context['lightcurve']['thumbnails'] = []
-        for point in context['lightcurve']['data']:
-            ra, dec, filename = self.database.thumbnail(point[4])
-            context['lightcurve']['thumbnails'].append(
-                plot.ThumbnailPlot(size=(4, 4)).render(filename, (ra, dec)))
         return context
 
 
-class SourcesView(BaseView):
-    def get_context_data(self, **kwargs):
-        context = super(SourcesView, self).get_context_data(**kwargs)
-        self.set_template('sources')
-        context['sources'] = self.database.source(dataset=kwargs['dataset'])
-        context['dataset'] = self.database.dataset(id=kwargs['dataset'])[0]
-        return context
+class SourcesView(ListingView):
+    listing = 'source'
+    name = 'sources'
 
 
 class SourceView(BaseView):
@@ -158,24 +343,16 @@ class SourceView(BaseView):
             raise Http404
         else:
             source = source[0]
-        images = self.database.image_times(dataset=kwargs['dataset'])
         lightcurve = self.database.lightcurve(int(source['xtrsrc']))
-        context['lightcurve'] = {
-            'plot': plot.LightcurvePlot().render(lightcurve, images=images),
-            'data': lightcurve
-            }
+        context['lightcurve'] = {'data': lightcurve}
         context['source'] = source
         context['dataset'] = self.database.dataset(id=kwargs['dataset'])[0]
         return context
 
 
-class ExtractedSourcesView(BaseView):
-    def get_context_data(self, **kwargs):
-        context = super(ExtractedSourcesView, self).get_context_data(**kwargs)
-        self.set_template('extractedsources')
-        context['extractedsources'] = self.database.extractedsource(dataset=kwargs['dataset'])
-        context['dataset'] = self.database.dataset(id=kwargs['dataset'])[0]
-        return context
+class ExtractedSourcesView(ListingView):
+    listing = 'extractedsource'
+    name = 'extractedsources'
 
 
 class ExtractedSourceView(BaseView):
@@ -239,78 +416,470 @@ class MonitoringListView(BaseView, FormMixin):
         context['sources'] = self.database.monitoringlist(dataset=kwargs['dataset'])
         context['dataset'] = self.database.dataset(id=kwargs['dataset'])[0]
         context['form'] = kwargs['form']
+        context['import_form'] = MonitoringListImportForm()
+        for key in ('added', 'skipped'):
+            if key in self.request.GET:
+                context[key] = self.request.GET[key]
         return context
 
 
-class TransientLightcurveView(BaseView):
+class MonitoringListImportView(BaseView):
+    """Add the positions in an uploaded catalogue (see
+    tools/catalogue.py) to the monitoring list of a dataset
 
-    def get_context_data(self, **kwargs):
-        context = super(TransientLightcurveView, self).get_context_data(**kwargs)
-        transient = self.database.transient(id=kwargs['id'], dataset=kwargs['dataset'])
-        if not transient:
+    Positions within the given radius of an entry already in the list,
+    or of an earlier position in the catalogue, are skipped; the others
+    are added in a single transaction.
+    """
+
+    http_method_names = ['post']
+    max_rows = 100000
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.has_perm('monitoringlist.change_monitoringlist'):
+            return HttpResponseForbidden()
+        form = MonitoringListImportForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return HttpResponseBadRequest("invalid import: %s" % form.errors,
+                                          content_type="text/plain")
+        upload = form.cleaned_data['catalogue']
+        try:
+            positions = catalogue.positions(
+                catalogue.read_table(upload, upload.name), None,
+                max_rows=self.max_rows)
+        except ValueError, e:
+            return HttpResponseBadRequest("invalid catalogue: %s" % e,
+                                          content_type="text/plain")
+        dataset = kwargs['dataset']
+        self.database = self.get_database(request.session.get('dblogin', None))
+        if not self.database.dataset(id=dataset):
             raise Http404
-        else:
-            transient = transient[0]
-        context['transient'] = transient
-        context['id'] = transient['trigger_xtrsrc']
-        return context
+        entries = self.database.monitoringlist(dataset)
+        keep = catalogue.new_positions(
+            positions,
+            numpy.array([entry['ra'] for entry in entries], dtype=float),
+            numpy.array([entry['decl'] for entry in entries], dtype=float),
+            form.cleaned_data['radius'])
+        self.database.add_monitoringlist(
+            zip(positions['ra'][keep], positions['decl'][keep]), dataset)
+        return HttpResponseRedirect("%s?%s" % (
+            reverse('dataset:monitoringlist', kwargs={'dataset': dataset}),
+            urlencode({'added': int(keep.sum()),
+                       'skipped': int((~keep).sum())})))
+
+
+class PlotView(BaseView):
+    """Base view for a single plot, served as a PNG image
+
+    Subclasses implement get_plot(), which returns the (cacheable) plot,
+    and get_plot_data(), which returns the arguments to render the plot
+    with; the latter is only called when the plot is not in the plot
+    cache.
+
+    The cache key of the plot also serves as its ETag, so that browsers
+    can revalidate their copy of a plot without it being rendered, or
+    even retrieved from the cache. Since the key includes the version of
+    the data (see DataBase.dataset_version()), no Last-Modified date is
+    sent: no timestamp in the database changes with all of the data.
+    """
+
+    # Number of seconds browsers may use their copy of a plot without
+    # revalidating it
+    max_age = 600
+
+    def get_plot(self, response, **kwargs):
+        raise NotImplementedError
+
+    def get_plot_data(self, **kwargs):
+        """Return the positional and keyword arguments for Plot.render()"""
+        raise NotImplementedError
 
-    def render_to_response(self, context, **kwargs):
+    def get(self, request, *args, **kwargs):
+        self.database = self.get_database(request.session.get('dblogin', None))
         response = HttpResponse(mimetype="image/png")
-        plot.LightcurvePlot(response=response).render(
-            self.database.lightcurve(context['id']))
+        figure = self.get_plot(response, **kwargs)
+        etag = '"%s"' % figure.key()
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        not_modified = if_none_match is not None and etag in [
+            tag.strip() for tag in if_none_match.split(',')]
+        if not_modified:
+            response = HttpResponseNotModified()
+        else:
+            if not figure.cached():
+                args, plotkwargs = self.get_plot_data(**kwargs)
+                figure.render(*args, **plotkwargs)
+            if figure.image is None:
+                # Nothing to plot
+                raise Http404
+        response['ETag'] = etag
+        # The plots depend on the database selected in the session
+        patch_cache_control(response, private=True, max_age=self.max_age)
         return response
 
 
-class SourceLightcurveView(BaseView):
+class DatasetPlotView(PlotView):
+    """Quality control plots for a dataset"""
 
-    def get_context_data(self, **kwargs):
-        context = super(SourceLightcurveView, self).get_context_data(**kwargs)
-        context['id'] = kwargs['id']
-        return context
+    # Plot class, size and plot arguments for each plot
+    plots = {
+        'rms': (quality.RmsDistancePlot, (8, 8), {}),
+        'sourcesperimage': (quality.HistSourcesPerImagePlot, (5, 5), {}),
+        'sourcesdistribution': (quality.HistSourcesPerImagePlot, (5, 5),
+                                {'mode': 'distribution'}),
+        'counterparts': (quality.ScatterPosAllCounterpartsPlot, (5, 5), {}),
+        }
 
-    def render_to_response(self, context, **kwargs):
-        response = HttpResponse(mimetype="image/png")
-        plot.LightcurvePlot(response=response).render(
-            self.database.lightcurve(context['id']))
-        return response
+    def get_plot(self, response, **kwargs):
+        dsid = int(kwargs['dataset'])
+        plotclass, size, plotkwargs = self.plots[kwargs['plot']]
+        return plotclass(response=response, size=size, cache_key=self.plot_key(
+            kwargs['plot'], dsid, self.database.dataset_version(dsid)))
 
+    def get_plot_data(self, **kwargs):
+        plotclass, size, plotkwargs = self.plots[kwargs['plot']]
+        return (self.database, int(kwargs['dataset'])), plotkwargs
 
-class ImagePlotView(BaseView):
 
-    def get_context_data(self, **kwargs):
-        context = super(ImagePlotView, self).get_context_data(**kwargs)
-        context['id'] = kwargs['id']
+class ImagePlotView(PlotView):
+    """The image itself ('quickview'), or the image with its detected
+    sources overplotted ('sources' and, larger, 'large')"""
 
-    def render_to_response(self, context, **kwargs):
-        response = HttpResponse(mimetype="image/png")
+    sizes = {'quickview': (5, 5), 'sources': (5, 5), 'large': (12, 12)}
+
+    def get_plot(self, response, **kwargs):
         image = self.database.image(
-            id=self.kwargs['id'], dataset=self.kwargs['dataset'],
+            id=kwargs['id'], dataset=kwargs['dataset'],
             extra_info=['ntotalsources'])
         if not image:
             raise Http404
+        self.image = image[0]
+        if kwargs['plot'] == 'quickview':
+            key = self.plot_key(self.image['id'])
         else:
-            image = image[0]
-        sources = self.database.extractedsource(image=image['id'])
-        plot.ImagePlot(response=response, size=(12, 12)).render(
-            image, plotsources=sources)
-        return response
+            key = self.plot_key(self.image['id'], self.image['ntotalsources'])
+        return plot.ImagePlot(response=response, size=self.sizes[kwargs['plot']],
+                              cache_key=key)
 
-class TransientLightsurfaceView(BaseView):
+    def get_plot_data(self, **kwargs):
+        if kwargs['plot'] == 'quickview':
+            return (self.image,), {'database': self.database}
+        sources = self.database.extractedsource(image=self.image['id'])
+        return (self.image,), {'plotsources': sources}
 
-    def get_context_data(self, **kwargs):
-        context = super(TransientLightsurfaceView, self).get_context_data(**kwargs)
+
+class TransientLightcurveView(PlotView):
+
+    def get_transient(self, **kwargs):
         transient = self.database.transient(id=kwargs['id'], dataset=kwargs['dataset'])
         if not transient:
             raise Http404
+        return transient[0]
+
+    def get_plot(self, response, **kwargs):
+        self.transient = self.get_transient(**kwargs)
+        self.version = self.database.dataset_version(kwargs['dataset'])
+        return plot.LightcurvePlot(response=response, cache_key=self.plot_key(
+            'transient', int(kwargs['id']), self.version))
+
+    def get_plot_data(self, **kwargs):
+        images = self.database.image_times(kwargs['dataset'], self.version)
+        trigger_xtrsrc = self.transient['trigger_xtrsrc']
+        lightcurve = dbase.lightcurve_array(
+            self.database.lightcurve(int(trigger_xtrsrc)))
+        trigger_index = (lightcurve['xtrsrc'] == trigger_xtrsrc).nonzero()[0][0]
+        return (lightcurve,), {'images': images, 'trigger_index': trigger_index}
+
+
+class SourceLightcurveView(PlotView):
+
+    def get_plot(self, response, **kwargs):
+        source = self.database.source(runcat=kwargs['runcat'], dataset=kwargs['dataset'])
+        if not source:
+            raise Http404
+        self.source = source[0]
+        self.version = self.database.dataset_version(kwargs['dataset'])
+        return plot.LightcurvePlot(response=response, cache_key=self.plot_key(
+            'source', int(kwargs['runcat']), self.version))
+
+    def get_plot_data(self, **kwargs):
+        images = self.database.image_times(kwargs['dataset'], self.version)
+        lightcurve = self.database.lightcurve(int(self.source['xtrsrc']))
+        return (lightcurve,), {'images': images}
+
+
+class LightcurvesView(BaseView):
+    """All lightcurves of a dataset, or of the sources (runcat ids) in
+    the comma-separated ?runcat= parameter, in one of the
+    export.LIGHTCURVE_FORMATS (?format=, npz by default)"""
+
+    def get(self, request, *args, **kwargs):
+        format = request.GET.get('format', 'npz')
+        if format not in export.LIGHTCURVE_FORMATS:
+            raise Http404
+        runcats = request.GET.get('runcat')
+        if runcats is not None:
+            try:
+                runcats = [int(runcat) for runcat in runcats.split(',')
+                           if runcat.strip()]
+            except ValueError:
+                raise Http404
+        self.database = self.get_database(request.session.get('dblogin', None))
+        if not self.database.dataset(id=kwargs['dataset']):
+            raise Http404
+        return export.LIGHTCURVE_FORMATS[format](
+            *self.database.lightcurves(kwargs['dataset'], runcats),
+            filename="lightcurves_%s" % kwargs['dataset'])
+
+
+class TransientThumbnailsView(TransientLightcurveView):
+    """Sprite sheet of the thumbnails of all lightcurve points"""
+
+    def get_plot(self, response, **kwargs):
+        self.transient = self.get_transient(**kwargs)
+        return thumbnail.ThumbnailSprite(response=response, cache_key=self.plot_key(
+            'thumbnails', int(kwargs['id']),
+            self.database.dataset_version(kwargs['dataset'])))
+
+    def get_plot_data(self, **kwargs):
+        lightcurve = self.database.lightcurve(int(self.transient['trigger_xtrsrc']))
+        srcids = [point[4] for point in lightcurve]
+        positions = self.database.thumbnails(srcids)
+        return ([positions[srcid] for srcid in srcids],), {}
+
+
+class TransientLightsurfaceView(TransientLightcurveView):
+
+    def get_plot(self, response, **kwargs):
+        self.transient = self.get_transient(**kwargs)
+        return plot.LightcurvePlot(response=response, cache_key=self.plot_key(
+            'trigger', int(self.transient['trigger_xtrsrc']),
+            self.database.dataset_version(kwargs['dataset'])))
+
+    def get_plot_data(self, **kwargs):
+        return (self.database.lightcurve(self.transient['trigger_xtrsrc']),), {}
+
+
+class ApiView(BaseView):
+    """JSON API for the dataset resources (see tools/api.py)
+
+    The resource is given by the URL, optionally with a dataset and the
+    id of a single row. The GET parameters are:
+
+        fields: comma-separated names of the columns to return; all
+            columns by default.
+
+        order, after, before, offset: ordering and paging, as for the
+            HTML listings (see dbase.paging()).
+
+        limit: number of rows per page; at most max_limit.
+
+        <column>__<operator>: filters on a column, where the operator is
+            one of exact, gte, lte, gt and lt.
+
+    The response is a JSON object with the 'fields', the 'rows' (as
+    lists of values in the order of the fields), and the query strings
+    of the 'next' and 'previous' pages (null if there are none).
+    Invalid parameters result in a 400 response.
+    """
+
+    limit = 1000
+    max_limit = 10000
+
+    def json_response(self, data, response_class=HttpResponse):
+        return response_class(
+            json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':')),
+            content_type="application/json")
+
+    def get(self, request, *args, **kwargs):
+        resource = kwargs['resource']
+        self.database = self.get_database(request.session.get('dblogin', None))
+        params = request.GET
+        try:
+            fields = params.get('fields')
+            if fields:
+                fields = [name.strip() for name in fields.split(',')]
+            filters = api.parse_filters(resource, params)
+            if kwargs.get('id') is not None:
+                filters.append(('id', 'exact', int(kwargs['id'])))
+            limit = min(int(params.get('limit', self.limit)), self.max_limit)
+            if limit < 1:
+                raise ValueError("invalid limit: %d" % limit)
+            order = params.get('order', 'id')
+            # Obtain one extra row to find out if there is a next page
+            page = {'order': order, 'limit': limit + 1}
+            for key in ('after', 'before', 'offset'):
+                if key in params:
+                    page[key] = int(params[key])
+            # The id is needed for the paging cursors
+            columns = fields
+            if fields and 'id' not in fields:
+                columns = fields + ['id']
+            rows = api.select(self.database, resource, fields=columns,
+                              dataset=kwargs.get('dataset'), filters=filters,
+                              **page)
+        except ValueError, e:
+            return self.json_response({'error': str(e)}, HttpResponseBadRequest)
+        if columns is None:
+            columns = [name for name, expression in
+                       api.RESOURCES[resource]['columns']]
+        if kwargs.get('id') is not None and not rows:
+            raise Http404
+
+        more = len(rows) > limit
+        if 'before' in page:
+            # Paging backwards: the extra row is at the start
+            rows = rows[1:] if more else rows
+            has_previous, has_next = more, True
         else:
-            transient = transient[0]
-        context['transient'] = transient
-        context['id'] = transient['trigger_xtrsrc']
-        return context
+            rows = rows[:-1] if more else rows
+            has_previous = 'after' in page or page.get('offset', 0) > 0
+            has_next = more
+        ids = [row[columns.index('id')] for row in rows]
+        previous = next = None
+        if rows and (has_previous or has_next):
+            keyset = order.lstrip('-') == 'id'
+            query = params.copy()
+            for key in ('after', 'before', 'offset'):
+                query.pop(key, None)
+            if has_previous:
+                previous = query.copy()
+                if keyset:
+                    previous['before'] = ids[0]
+                elif page.get('offset', 0) > limit:
+                    previous['offset'] = page['offset'] - limit
+                previous = previous.urlencode()
+            if has_next:
+                next = query.copy()
+                if keyset:
+                    next['after'] = ids[-1]
+                else:
+                    next['offset'] = page.get('offset', 0) + limit
+                next = next.urlencode()
+        if fields and 'id' not in fields:
+            rows = [row[:-1] for row in rows]
+        return self.json_response({
+            'fields': fields or columns,
+            'rows': rows,
+            'next': next,
+            'previous': previous,
+            })
+
+
+class ConeSearchView(ApiView):
+    """Sources within a radius around a position, as JSON
+
+    The GET parameters are ra, decl and radius (in degrees; at most
+    max_radius), and optionally catalogue: 'sources' (the default) or
+    'extractedsources'. Within a dataset, the search uses the in-memory
+    index of the dataset (see tools/spatial.py), which is built on the
+    first search; otherwise, the database is searched directly.
+
+    The response has the same form as for the other API resources, with
+    the distance to the centre (in arcseconds) as last field; the rows
+    are ordered by distance.
+    """
+
+    max_radius = 5.
+    catalogues = {
+        'sources': 'runningcatalog',
+        'extractedsources': 'extractedsource',
+        }
 
-    def render_to_response(self, context, **kwargs):
-        response = HttpResponse(mimetype="image/png")
-        plot.LightcurvePlot(response=response).render(
-            self.database.lightcurve(context['id']))
-        return response
+    def get(self, request, *args, **kwargs):
+        try:
+            ra = float(request.GET['ra'])
+            decl = float(request.GET['decl'])
+            radius = float(request.GET['radius'])
+            if not -90 <= decl <= 90 or not 0 < radius <= self.max_radius:
+                raise ValueError("position or radius out of range")
+            catalogue = self.catalogues[request.GET.get('catalogue', 'sources')]
+        except (KeyError, ValueError), e:
+            return self.json_response({'error': "invalid cone: %s" % e},
+                                      HttpResponseBadRequest)
+        self.database = self.get_database(request.session.get('dblogin', None))
+        fields = [name for name, expression, type in
+                  dbase.CONE_SEARCH[catalogue]['columns']]
+        dataset = kwargs.get('dataset')
+        if dataset is not None:
+            if not self.database.dataset(id=dataset):
+                raise Http404
+            sources, distances = spatial.source_index(
+                self.database, dataset, catalogue).cone_search(ra, decl, radius)
+            columns = [api.json_values(sources[name]) for name in fields]
+            columns.append(api.json_values(distances))
+            rows = [list(row) for row in zip(*columns)]
+        else:
+            rows = [api.json_values([source[name] for name in fields] +
+                                    [source['distance']])
+                    for source in self.database.cone_search(
+                        ra, decl, radius, catalogue=catalogue)]
+        return self.json_response({
+            'fields': fields + ['distance'],
+            'rows': rows,
+            'next': None,
+            'previous': None,
+            })
+
+
+class CrossMatchView(ApiView):
+    """Cross-match an uploaded catalogue of positions (see
+    tools/catalogue.py) with the sources of a dataset, as JSON
+
+    The catalogue is POSTed as the 'catalogue' file, optionally with a
+    default matching 'radius' in arcseconds for positions without one.
+    The response contains, with the fields of the sources as in the cone
+    search:
+
+        nearest: for every position, its name, ra, decl and radius, and
+            the distance (in arcseconds) and fields of the nearest source
+            within its radius (nulls if there is none).
+
+        matches: for every source within the radius of a position, the
+            name of the position, the distance and the fields of the
+            source; ordered by position and distance.
+    """
+
+    http_method_names = ['post']
+    # Default and maximum matching radius, in arcseconds
+    radius = 10.
+    max_radius = 3600.
+    max_rows = 100000
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        # Intended for scripts, which post without a CSRF token
+        return super(CrossMatchView, self).dispatch(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        form = CrossMatchForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return self.json_response({'error': form.errors},
+                                      HttpResponseBadRequest)
+        upload = form.cleaned_data['catalogue']
+        radius = form.cleaned_data['radius'] or self.radius
+        try:
+            positions = catalogue.positions(
+                catalogue.read_table(upload, upload.name), radius,
+                max_radius=self.max_radius, max_rows=self.max_rows)
+        except ValueError, e:
+            return self.json_response({'error': "invalid catalogue: %s" % e},
+                                      HttpResponseBadRequest)
+        self.database = self.get_database(request.session.get('dblogin', None))
+        if not self.database.dataset(id=kwargs['dataset']):
+            raise Http404
+        index = spatial.source_index(self.database, kwargs['dataset'])
+        nearest, matches = catalogue.cross_match(index, positions)
+        fields = [name for name, expression, type in
+                  dbase.CONE_SEARCH['runningcatalog']['columns']]
+        nearest_rows, match_rows = catalogue.match_rows(
+            index, positions, fields, nearest, matches)
+        return self.json_response({
+            'nearest': {
+                'fields': ['name', 'ra', 'decl', 'radius', 'distance'] + fields,
+                'rows': nearest_rows,
+                },
+            'matches': {
+                'fields': ['name', 'distance'] + fields,
+                'rows': match_rows,
+                },
+            })